@@ -0,0 +1,76 @@
+"""Цветокоррекция: прежняя реализация с переводом в HSV через копии float32 и
+int16 на каждую опцию против ColorCorrectionEngine с одним переводом в HSV и
+таблицами cv2.LUT для каналов. Отдельной строкой - таблица cv2.LUT против
+convertScaleAbs для яркости на всем изображении. Замеряются только
+преобразования, без кодирования.
+
+Запуск из корня проекта:
+    python -m benchmarks.color_benchmark --size 5472x3648 --variants 4
+"""
+import argparse
+
+import cv2
+import numpy as np
+
+from benchmarks.common import parse_size, peak_memory, synthetic_image, timeit
+from image_processing.image_processing_methods import COLOR_CORRECTION_OPTIONS, ColorCorrectionEngine
+
+
+def color_correction_reference(image_array, opt):
+    """Прежняя реализация одной опции из color_correction_images"""
+    if opt == "grayscale":
+        return cv2.cvtColor(image_array, cv2.COLOR_BGR2GRAY)
+    if opt == "brightness":
+        return cv2.convertScaleAbs(image_array, alpha=1, beta=np.random.randint(-50, 50))
+    if opt == "contrast":
+        return cv2.convertScaleAbs(image_array, alpha=np.random.uniform(0.5, 1.5), beta=0)
+    if opt == "saturation":
+        hsv = cv2.cvtColor(image_array, cv2.COLOR_BGR2HSV).astype(np.float32)
+        hsv[..., 1] = np.clip(hsv[..., 1] * np.random.uniform(0.5, 1.5), 0, 255)
+        return cv2.cvtColor(hsv.astype(np.uint8), cv2.COLOR_HSV2BGR)
+    if opt == "hue":
+        hsv = cv2.cvtColor(image_array, cv2.COLOR_BGR2HSV).astype(np.int16)
+        hsv[..., 0] = (hsv[..., 0] + np.random.randint(-20, 20)) % 180
+        return cv2.cvtColor(hsv.astype(np.uint8), cv2.COLOR_HSV2BGR)
+    if opt == "inversion":
+        return cv2.bitwise_not(image_array)
+
+
+def reference_variants(image_array, options, count):
+    return [color_correction_reference(image_array, opt) for opt in options for _ in range(count)]
+
+
+def engine_variants(image_array, options, count):
+    return ColorCorrectionEngine(image_array).variants(options, count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк цветокоррекции")
+    parser.add_argument("--size", default="5472x3648", help="размер изображения ШxВ (по умолчанию 20 Мп)")
+    parser.add_argument("--variants", type=int, default=1, help="вариантов каждой опции")
+    parser.add_argument("--repeat", type=int, default=3, help="количество повторов замера")
+    args = parser.parse_args()
+
+    width, height = parse_size(args.size)
+    image_array = synthetic_image(width, height)
+    print(f"Изображение {width}x{height} ({image_array.nbytes / 2 ** 20:.0f} МБ), вариантов: {args.variants}")
+    print(f"{'опции':<24}{'прежняя, мс':>14}{'новая, мс':>12}{'ускорение':>12}{'пик прежней, МБ':>18}{'пик новой, МБ':>14}")
+
+    groups = [(opt, [opt]) for opt in COLOR_CORRECTION_OPTIONS] + [("все", list(COLOR_CORRECTION_OPTIONS))]
+    for label, options in groups:
+        reference = timeit(lambda: reference_variants(image_array, options, args.variants), repeat=args.repeat)
+        engine = timeit(lambda: engine_variants(image_array, options, args.variants), repeat=args.repeat)
+        reference_peak = peak_memory(lambda: reference_variants(image_array, options, args.variants))
+        engine_peak = peak_memory(lambda: engine_variants(image_array, options, args.variants))
+        print(f"{label:<24}{reference * 1000:>14.1f}{engine * 1000:>12.1f}{reference / engine:>12.2f}"
+              f"{reference_peak / 2 ** 20:>18.0f}{engine_peak / 2 ** 20:>14.0f}")
+
+    # точечные операции над всем изображением: таблица против арифметики OpenCV
+    lut = cv2.convertScaleAbs(np.arange(256, dtype=np.uint8).reshape(1, 256), alpha=1, beta=20)
+    lut_time = timeit(lambda: cv2.LUT(image_array, lut), repeat=args.repeat)
+    scale_time = timeit(lambda: cv2.convertScaleAbs(image_array, alpha=1, beta=20), repeat=args.repeat)
+    print(f"яркость одним проходом: cv2.LUT {lut_time * 1000:.1f} мс, convertScaleAbs {scale_time * 1000:.1f} мс")
+
+
+if __name__ == "__main__":
+    main()
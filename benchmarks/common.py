@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+# бенчмарки запускаются из корня проекта: python -m benchmarks.<имя>
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(ROOT_DIR)
+sys.path.append(os.path.join(ROOT_DIR, 'image_processing'))
+
+
+def synthetic_image(width, height, channels=3, seed=0):
+    """Синтетическое изображение: плавные градиенты с шумом, чтобы JPEG
+       сжимался примерно как фотография, а не как чистый шум"""
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)
+    base = (x[None, :] + y[:, None]) / 2
+    planes = [base, base[::-1], base[:, ::-1]][:channels]
+    image = np.stack(planes, axis=-1) if channels > 1 else base
+    image = image + rng.normal(0, 8, image.shape).astype(np.float32)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def parse_size(value):
+    """Разбор размера вида 1920x1080"""
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def timeit(fn, repeat=3):
+    """Лучшее время выполнения функции из repeat запусков, в секундах"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def peak_memory(fn):
+    """Пиковый прирост памяти при выполнении функции, в байтах. Учитываются
+       выделения через аллокаторы Python и numpy (в том числе выходные массивы
+       OpenCV), но не внутренние временные буферы OpenCV"""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
@@ -0,0 +1,73 @@
+"""Время и пиковая память эластичной деформации: прежняя реализация на
+scipy.ndimage.gaussian_filter во float64 с полной сеткой np.meshgrid против
+поля смещений float32 в уменьшенном разрешении.
+
+Запуск из корня проекта:
+    python -m benchmarks.elastic_benchmark --size 5472x3648
+"""
+import argparse
+
+import cv2
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+from benchmarks.common import parse_size, peak_memory, synthetic_image, timeit
+from image_processing.image_processing_methods import elastic_array
+
+
+def elastic_reference(image_array, sigma=5, alpha=35):
+    """Прежняя реализация эластичной деформации из distortion_images"""
+    shape = image_array.shape
+    dx = gaussian_filter((np.random.rand(*shape[:2]) * 2 - 1), sigma, mode="constant", cval=0) * alpha
+    dy = gaussian_filter((np.random.rand(*shape[:2]) * 2 - 1), sigma, mode="constant", cval=0) * alpha
+
+    x, y = np.meshgrid(np.arange(shape[1]), np.arange(shape[0]))
+    indices = (np.clip(y + dy, 0, shape[0] - 1).astype(np.float32),
+               np.clip(x + dx, 0, shape[1] - 1).astype(np.float32))
+    return cv2.remap(image_array, indices[1], indices[0], interpolation=cv2.INTER_LINEAR,
+                     borderMode=cv2.BORDER_REFLECT)
+
+
+def displacement_std(image_array, fn):
+    """Среднеквадратичное смещение пикселя: деформируем изображение координат
+       и сравниваем с исходными координатами"""
+    height, width = image_array.shape[:2]
+    cols = np.tile(np.arange(width, dtype=np.float32), (height, 1))
+    moved = fn(cols)
+    # края отражаются, смотрим только на внутреннюю часть
+    margin = 64
+    return float(np.std((moved - cols)[margin:-margin, margin:-margin]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк эластичной деформации")
+    parser.add_argument("--size", default="5472x3648", help="размер изображения ШxВ (по умолчанию 20 Мп)")
+    parser.add_argument("--sigma", type=float, default=5, help="сглаживание поля смещений")
+    parser.add_argument("--alpha", type=float, default=35, help="сила смещений")
+    parser.add_argument("--repeat", type=int, default=3, help="количество повторов замера")
+    args = parser.parse_args()
+
+    width, height = parse_size(args.size)
+    image_array = synthetic_image(width, height)
+    print(f"Изображение {width}x{height} ({image_array.nbytes / 2 ** 20:.0f} МБ), "
+          f"sigma={args.sigma}, alpha={args.alpha}")
+
+    variants = [
+        ("прежняя (float64)", lambda arr: elastic_reference(arr, args.sigma, args.alpha)),
+        ("float32, полное разрешение", lambda arr: elastic_array(arr, args.sigma, args.alpha, downscale=1)),
+        ("float32, уменьшенное поле", lambda arr: elastic_array(arr, args.sigma, args.alpha)),
+    ]
+
+    print(f"{'реализация':<30}{'время, с':>10}{'пик памяти, МБ':>16}{'смещение, пикс':>16}")
+    reference_time = None
+    for label, fn in variants:
+        elapsed = timeit(lambda: fn(image_array), repeat=args.repeat)
+        peak = peak_memory(lambda: fn(image_array))
+        shift = displacement_std(image_array, fn)
+        reference_time = reference_time or elapsed
+        print(f"{label:<30}{elapsed:>10.3f}{peak / 2 ** 20:>16.0f}{shift:>16.2f}"
+              f"   x{reference_time / elapsed:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Время кодирования и размер результата для форматов и настроек качества.
+
+Запуск из корня проекта:
+    python -m benchmarks.encode_benchmark --size 1920x1080 --count 8
+"""
+import argparse
+
+from benchmarks.common import parse_size, synthetic_image, timeit
+from image_processing.image_codecs import ImageEncoding
+from image_processing.image_processing_methods import encode_arrays, encode_cv_to_db
+from image_processing.parallel import shutdown_executors
+
+# настройки по умолчанию: (подпись, параметры ImageEncoding)
+DEFAULT_ENCODINGS = [
+    ("jpeg q=95", {"output_format": "jpeg", "quality": 95}),
+    ("jpeg q=85", {"output_format": "jpeg", "quality": 85}),
+    ("jpeg q=85 opt", {"output_format": "jpeg", "quality": 85, "optimize": True}),
+    ("jpeg q=70", {"output_format": "jpeg", "quality": 70}),
+    ("png c=1", {"output_format": "png", "png_compression": 1}),
+    ("png c=3", {"output_format": "png", "png_compression": 3}),
+    ("png c=9", {"output_format": "png", "png_compression": 9}),
+    ("webp q=90", {"output_format": "webp", "quality": 90}),
+    ("webp q=75", {"output_format": "webp", "quality": 75}),
+    ("webp lossless", {"output_format": "webp", "lossless": True}),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк кодеков изображений")
+    parser.add_argument("--size", default="1920x1080", help="размер изображения ШxВ")
+    parser.add_argument("--gray", action="store_true", help="изображение в оттенках серого")
+    parser.add_argument("--count", type=int, default=8, help="количество изображений для параллельного кодирования")
+    parser.add_argument("--workers", type=int, default=0, help="потоки параллельного кодирования, 0 - не замерять")
+    parser.add_argument("--repeat", type=int, default=3, help="количество повторов замера")
+    args = parser.parse_args()
+
+    width, height = parse_size(args.size)
+    image_array = synthetic_image(width, height, channels=1 if args.gray else 3)
+    raw_size = image_array.nbytes
+    print(f"Изображение {width}x{height}, {'серое' if args.gray else 'цветное'}, "
+          f"без сжатия {raw_size / 2 ** 20:.1f} МБ")
+
+    header = f"{'настройки':<16}{'время, мс':>12}{'МБ/с':>10}{'размер, КБ':>12}{'сжатие':>10}"
+    if args.workers:
+        header += f"{'параллельно, мс':>18}{'ускорение':>12}"
+    print(header)
+
+    arrays = [image_array] * args.count
+    for label, params in DEFAULT_ENCODINGS:
+        encoding = ImageEncoding(**params)
+        size = len(encode_cv_to_db(image_array, encoding))
+        elapsed = timeit(lambda: encode_cv_to_db(image_array, encoding), repeat=args.repeat)
+        line = (f"{label:<16}{elapsed * 1000:>12.1f}{raw_size / 2 ** 20 / elapsed:>10.1f}"
+                f"{size / 1024:>12.1f}{raw_size / size:>10.1f}")
+
+        if args.workers:
+            # кодирование count результатов одной обработки, как в color_correction/distortion
+            serial = timeit(lambda: encode_arrays(arrays, encoding, workers=1), repeat=args.repeat)
+            parallel = timeit(lambda: encode_arrays(arrays, encoding, workers=args.workers), repeat=args.repeat)
+            line += f"{parallel * 1000:>18.1f}{serial / parallel:>12.2f}"
+        print(line)
+
+    shutdown_executors()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""Нагрузочный тест HTTP-эндпоинтов сервиса: сколько загрузок и генераций
+выдерживает один процесс и какие задержки у страниц во время генерации.
+
+Сервер uvicorn с main:app запускается локально на свободном порту с
+временными файлами БД и хранилища блобов (или используется уже запущенный,
+--url). Виртуальные пользователи работают параллельно, у каждого своя
+cookie сессии и свой сценарий:
+
+    upload   - загрузка оригинала
+    generate - загрузка один раз, дальше /do_rotate, /do_color_correction, /do_distortion
+    view     - загрузка и генерация один раз, дальше страницы и изображения галереи
+    save     - загрузка и генерация один раз, дальше скачивание архивов
+
+Запуск из корня проекта:
+    python -m benchmarks.load_test --users generate=2,view=8 --duration 30
+    python -m benchmarks.load_test --users upload=4,generate=4,view=8,save=1 --workers 2 --output load.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import cv2
+import httpx
+
+from benchmarks.common import ROOT_DIR, parse_size, synthetic_image
+
+SCENARIOS = ("upload", "generate", "view", "save")
+
+GENERATE_REQUESTS = [
+    ("/do_rotate", {"angle": 15, "count": 4}),
+    ("/do_color_correction", {"options": ["grayscale", "brightness", "saturation"]}),
+    ("/do_distortion", {"options": "blur"}),
+]
+PAGES = ["/", "/rotate", "/color_correction", "/distortion"]
+ARCHIVES = ["/save_rotate", "/save_color_correction", "/save_distortion"]
+
+# адреса изображений и превью в разметке галерей
+IMAGE_URL_PATTERN = re.compile(r'(?:src|href)="(/images/[a-z_]+/\d+[^"]*)"')
+
+
+class Recorder:
+    """Задержки и коды ответов по подписям запросов"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    async def request(self, client, label, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+            status = response.status_code
+        except httpx.HTTPError:
+            response, status = None, "error"
+        self.latencies[label].append(time.perf_counter() - start)
+        self.statuses[label][status] += 1
+        return response
+
+
+def percentile(sorted_values, fraction):
+    """Перцентиль по ближайшему рангу"""
+    if not sorted_values:
+        return float("nan")
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+async def upload(recorder, client, image_data):
+    await recorder.request(client, "POST / (upload)", "POST", "/",
+                           files={"file": ("load.jpg", image_data, "image/jpeg")})
+
+
+async def generate_once(recorder, client):
+    for url, data in GENERATE_REQUESTS:
+        await recorder.request(client, f"POST {url}", "POST", url, data=data)
+
+
+async def run_user(scenario, base_url, image_data, deadline, recorder, think_time):
+    """Цикл сценария одного пользователя до истечения времени теста"""
+    async with httpx.AsyncClient(base_url=base_url, timeout=120) as client:
+        if scenario != "upload":
+            await upload(recorder, client, image_data)
+        if scenario in ("view", "save"):
+            await generate_once(recorder, client)
+
+        step = 0
+        while time.perf_counter() < deadline:
+            if scenario == "upload":
+                await upload(recorder, client, image_data)
+            elif scenario == "generate":
+                url, data = GENERATE_REQUESTS[step % len(GENERATE_REQUESTS)]
+                await recorder.request(client, f"POST {url}", "POST", url, data=data)
+            elif scenario == "view":
+                url = PAGES[step % len(PAGES)]
+                response = await recorder.request(client, f"GET {url}", "GET", url)
+                # браузер загружает превью галереи вслед за страницей
+                if response is not None and response.status_code == 200:
+                    for image_url in IMAGE_URL_PATTERN.findall(response.text)[:4]:
+                        label = "GET /images/{kind}/{id}" + ("/preview" if "/preview" in image_url else "")
+                        await recorder.request(client, label, "GET", image_url)
+            elif scenario == "save":
+                url = ARCHIVES[step % len(ARCHIVES)]
+                await recorder.request(client, f"POST {url}", "POST", url)
+            step += 1
+            if think_time:
+                await asyncio.sleep(think_time)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, workers, tmp_dir):
+    """Запуск uvicorn с main:app на временных файлах БД и хранилища блобов"""
+    env = dict(os.environ,
+               DATABASE_URL="sqlite:///" + os.path.join(tmp_dir, "load.db"),
+               BLOB_STORE_DIR=os.path.join(tmp_dir, "blobs"))
+    command = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+               "--workers", str(workers), "--log-level", "warning"]
+    return subprocess.Popen(command, cwd=ROOT_DIR, env=env)
+
+
+def wait_for_server(base_url, process, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise SystemExit("Сервер uvicorn завершился при запуске")
+        try:
+            if httpx.get(base_url + "/stats/executors", timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            time.sleep(0.3)
+    raise SystemExit("Сервер не ответил за отведенное время")
+
+
+def report(recorder, elapsed):
+    """Таблица и словарь результатов по подписям запросов"""
+    rows = []
+    print(f"\n{'запрос':<34}{'кол-во':>8}{'ошибки':>8}{'503':>6}{'в сек':>8}"
+          f"{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'макс, мс':>10}")
+    for label in sorted(recorder.latencies):
+        latencies = sorted(recorder.latencies[label])
+        statuses = recorder.statuses[label]
+        errors = sum(count for status, count in statuses.items()
+                     if status == "error" or not 200 <= status < 400)
+        row = {
+            "request": label,
+            "count": len(latencies),
+            "errors": errors,
+            "rejected": statuses.get(503, 0),
+            "per_second": len(latencies) / elapsed,
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1],
+            "statuses": {str(status): count for status, count in statuses.items()},
+        }
+        rows.append(row)
+        print(f"{label:<34}{row['count']:>8}{row['errors']:>8}{row['rejected']:>6}{row['per_second']:>8.1f}"
+              f"{row['p50'] * 1000:>10.0f}{row['p95'] * 1000:>10.0f}{row['p99'] * 1000:>10.0f}"
+              f"{row['max'] * 1000:>10.0f}")
+    total = sum(row["count"] for row in rows)
+    print(f"\nВсего запросов: {total} за {elapsed:.1f} с ({total / elapsed:.1f} в секунду)")
+    return rows
+
+
+def parse_users(value):
+    """Разбор состава пользователей вида generate=2,view=8"""
+    users = {}
+    for item in value.split(","):
+        scenario, _, count = item.partition("=")
+        if scenario not in SCENARIOS:
+            raise SystemExit(f"Неизвестный сценарий: {scenario}. Доступны: {', '.join(SCENARIOS)}")
+        users[scenario] = int(count or 1)
+    return users
+
+
+async def run_load(base_url, users, image_data, duration, think_time):
+    recorder = Recorder()
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(*(run_user(scenario, base_url, image_data, deadline, recorder, think_time)
+                           for scenario, count in users.items() for _ in range(count)))
+    return recorder, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест HTTP-эндпоинтов")
+    parser.add_argument("--users", default="upload=1,generate=2,view=8,save=1",
+                        help="пользователи по сценариям: " + ", ".join(SCENARIOS))
+    parser.add_argument("--duration", type=float, default=30, help="длительность теста в секундах")
+    parser.add_argument("--think-time", type=float, default=0, help="пауза пользователя между запросами")
+    parser.add_argument("--size", default="1920x1080", help="размер загружаемого изображения ШxВ")
+    parser.add_argument("--url", default="", help="адрес уже запущенного сервера вместо локального uvicorn")
+    parser.add_argument("--workers", type=int, default=1, help="воркеры локального uvicorn")
+    parser.add_argument("--output", default="", help="файл JSON для сохранения отчета")
+    args = parser.parse_args()
+
+    users = parse_users(args.users)
+    width, height = parse_size(args.size)
+    image_data = cv2.imencode(".jpg", synthetic_image(width, height))[1].tobytes()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        process = None
+        base_url = args.url.rstrip("/")
+        if not base_url:
+            port = free_port()
+            base_url = f"http://127.0.0.1:{port}"
+            process = start_server(port, args.workers, tmp_dir)
+        try:
+            wait_for_server(base_url, process)
+            print(f"Сервер {base_url}, пользователи: {users}, длительность {args.duration:.0f} с, "
+                  f"изображение {width}x{height}")
+            recorder, elapsed = asyncio.run(run_load(base_url, users, image_data, args.duration, args.think_time))
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait(timeout=30)
+
+    rows = report(recorder, elapsed)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump({"users": users, "duration": elapsed, "size": args.size, "results": rows},
+                      file, ensure_ascii=False, indent=2)
+        print(f"Отчет сохранен в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""Масштабирование параллельного поворота по числу ядер.
+
+Запуск из корня проекта:
+    python -m benchmarks.rotate_benchmark --size 6000x4000 --count 100
+"""
+import argparse
+import os
+
+from benchmarks.common import parse_size, synthetic_image, timeit
+from image_processing.image_processing_methods import rotate_array_images
+from image_processing.parallel import shutdown_executors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк параллельного поворота")
+    parser.add_argument("--size", default="6000x4000", help="размер изображения ШxВ")
+    parser.add_argument("--count", type=int, default=100, help="количество поворотов")
+    parser.add_argument("--angle", type=int, default=3, help="шаг угла")
+    parser.add_argument("--pools", default="thread,process", help="типы пулов через запятую")
+    parser.add_argument("--workers", default="", help="числа воркеров через запятую, по умолчанию 2^k до числа ядер")
+    parser.add_argument("--repeat", type=int, default=1, help="количество повторов замера")
+    args = parser.parse_args()
+
+    width, height = parse_size(args.size)
+    image_array = synthetic_image(width, height)
+    cpu_count = os.cpu_count() or 1
+    if args.workers:
+        worker_counts = [int(w) for w in args.workers.split(",")]
+    else:
+        worker_counts = sorted({*[2 ** i for i in range(1, cpu_count.bit_length())], cpu_count})
+
+    serial = timeit(lambda: rotate_array_images(image_array, args.angle, args.count, pool="serial"),
+                    repeat=args.repeat)
+    print(f"Изображение {width}x{height}, поворотов: {args.count}, ядер: {cpu_count}")
+    print(f"{'пул':<10}{'воркеры':>10}{'время, с':>12}{'изобр./с':>12}{'ускорение':>12}")
+    print(f"{'serial':<10}{1:>10}{serial:>12.3f}{args.count / serial:>12.1f}{1.0:>12.2f}")
+
+    for pool in args.pools.split(","):
+        for workers in worker_counts:
+            if workers == 1:
+                continue
+            # прогрев: создание пула и запуск процессов не входит в замер
+            rotate_array_images(image_array, args.angle, min(args.count, workers), workers=workers, pool=pool)
+            elapsed = timeit(lambda: rotate_array_images(image_array, args.angle, args.count,
+                                                         workers=workers, pool=pool),
+                             repeat=args.repeat)
+            print(f"{pool:<10}{workers:>10}{elapsed:>12.3f}{args.count / elapsed:>12.1f}{serial / elapsed:>12.2f}")
+
+    shutdown_executors()
+
+
+if __name__ == "__main__":
+    main()
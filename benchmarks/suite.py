@@ -0,0 +1,216 @@
+"""Набор микробенчмарков image_processing_methods: декодирование,
+кодирование, поворот и каждая ветка опций цветокоррекции и искажений на
+синтетических изображениях от 256 пикселей до 8K, серых и цветных.
+
+Для каждого случая замеряются время (лучшее и медиана из repeat запусков),
+пропускная способность в мегапикселях исходного изображения в секунду и
+пиковая память отдельным запуском под tracemalloc. Оригинал, как и в
+сервисе, берется из кэша декодированных изображений, поэтому время функций
+обработки не включает декодирование (оно замеряется отдельным случаем).
+
+Результаты сохраняются в JSON и сравниваются с сохраненными ранее:
+    python -m benchmarks.suite --output before.json
+    python -m benchmarks.suite --output after.json --compare before.json
+    python -m benchmarks.suite --sizes 256,1080p --modes color --cases rotate,distortion_noise
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+
+from benchmarks.common import ROOT_DIR, peak_memory, synthetic_image
+from database.blob_store import hash_blob
+from image_processing.image_cache import decoded_cache
+from image_processing.image_processing_methods import (COLOR_CORRECTION_OPTIONS, color_correction_images,
+                                                       decode_bytes_to_cv, decode_db_to_cv, distortion_images,
+                                                       encode_cv_to_db, rotate_images)
+from image_processing.parallel import shutdown_executors
+from image_processing.result_cache import result_cache
+
+# размеры изображений: имя -> (ширина, высота)
+SIZES = {
+    "256": (256, 256),
+    "1024": (1024, 1024),
+    "1080p": (1920, 1080),
+    "4k": (3840, 2160),
+    "8k": (7680, 4320),
+}
+
+MODES = ("gray", "color")
+
+DISTORTION_OPTIONS = ("distortion", "blur", "noise")
+
+
+def build_cases():
+    """Случаи набора: имя -> функция (оригинал из БД, байты оригинала) -> результат"""
+    cases = {
+        "decode": lambda orig, data: decode_bytes_to_cv(data),
+        "decode_db_cached": lambda orig, data: decode_db_to_cv(orig),
+        "encode": lambda orig, data: encode_cv_to_db(decode_db_to_cv(orig)),
+        "rotate": lambda orig, data: rotate_images(orig, angle=15, count=4),
+    }
+    for opt in COLOR_CORRECTION_OPTIONS:
+        cases[f"color_correction_{opt}"] = lambda orig, data, opt=opt: color_correction_images(orig, [opt], seed=0)
+    cases["color_correction_all"] = lambda orig, data: color_correction_images(
+        orig, list(COLOR_CORRECTION_OPTIONS), seed=0)
+    for opt in DISTORTION_OPTIONS:
+        cases[f"distortion_{opt}"] = lambda orig, data, opt=opt: distortion_images(orig, opt, seed=0)
+    return cases
+
+
+CASES = build_cases()
+
+
+def make_original(width, height, mode):
+    """Оригинал как строка БД: байты PNG и декодированный массив в кэше"""
+    image_array = synthetic_image(width, height, channels=1 if mode == "gray" else 3)
+    image_data = cv2.imencode(".png", image_array)[1].tobytes()
+    orig = SimpleNamespace(id=-1, content_hash=hash_blob(image_data), image_data=image_data)
+    decoded_cache.invalidate()
+    image_array.flags.writeable = False
+    decoded_cache.put(orig.id, orig.content_hash, image_array)
+    return orig, image_data
+
+
+def measure(fn, repeat):
+    """Времена repeat запусков в секундах и результат последнего"""
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return times, result
+
+
+def run_case(name, size, mode, repeat, with_memory=True):
+    width, height = SIZES[size]
+    orig, image_data = make_original(width, height, mode)
+    fn = lambda: CASES[name](orig, image_data)
+
+    fn()  # прогрев: пулы потоков, таблицы координат, кэши OpenCV
+    times, result = measure(fn, repeat)
+    outputs = len(result) if isinstance(result, list) else 1
+    best = min(times)
+    return {
+        "case": name,
+        "size": size,
+        "mode": mode,
+        "width": width,
+        "height": height,
+        "seconds": best,
+        "median_seconds": statistics.median(times),
+        "megapixels_per_second": width * height / 1e6 / best,
+        "outputs": outputs,
+        "outputs_per_second": outputs / best,
+        "peak_memory_bytes": peak_memory(fn) if with_memory else None,
+    }
+
+
+def environment():
+    """Описание ревизии и окружения для сравнения результатов"""
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True,
+                                  text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        revision = None
+    return {
+        "revision": revision,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def result_key(result):
+    return result["case"], result["size"], result["mode"]
+
+
+def compare(results, baseline, threshold):
+    """Сравнение с прежними результатами. Возвращает список регрессий:
+       случаев, ставших медленнее больше чем на threshold (доля)"""
+    previous = {result_key(result): result for result in baseline["results"]}
+    regressions = []
+    print(f"\nСравнение с ревизией {baseline['environment'].get('revision')}:")
+    print(f"{'случай':<30}{'размер':>8}{'режим':>7}{'было, мс':>12}{'стало, мс':>12}{'изменение':>12}")
+    for result in results:
+        before = previous.get(result_key(result))
+        if before is None:
+            continue
+        change = result["seconds"] / before["seconds"] - 1
+        mark = ""
+        if change > threshold:
+            regressions.append(result)
+            mark = "  регрессия"
+        print(f"{result['case']:<30}{result['size']:>8}{result['mode']:>7}{before['seconds'] * 1000:>12.1f}"
+              f"{result['seconds'] * 1000:>12.1f}{change:>+12.1%}{mark}")
+    return regressions
+
+
+def parse_list(value, allowed, what):
+    items = [item for item in value.split(",") if item]
+    unknown = [item for item in items if item not in allowed]
+    if unknown:
+        raise SystemExit(f"Неизвестные {what}: {', '.join(unknown)}. Доступны: {', '.join(allowed)}")
+    return items
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Набор микробенчмарков обработки изображений")
+    parser.add_argument("--sizes", default=",".join(SIZES), help="размеры через запятую: " + ", ".join(SIZES))
+    parser.add_argument("--modes", default=",".join(MODES), help="gray, color через запятую")
+    parser.add_argument("--cases", default=",".join(CASES), help="случаи через запятую, по умолчанию все")
+    parser.add_argument("--repeat", type=int, default=3, help="количество замеров времени")
+    parser.add_argument("--no-memory", action="store_true", help="не замерять пиковую память")
+    parser.add_argument("--output", default="", help="файл JSON для сохранения результатов")
+    parser.add_argument("--compare", default="", help="файл JSON с прежними результатами")
+    parser.add_argument("--threshold", type=float, default=0.1, help="замедление, считающееся регрессией (доля)")
+    args = parser.parse_args()
+
+    sizes = parse_list(args.sizes, SIZES, "размеры")
+    modes = parse_list(args.modes, MODES, "режимы")
+    cases = parse_list(args.cases, CASES, "случаи")
+    # замеряем преобразования, а не повторную выдачу из кэша результатов
+    result_cache.enabled = False
+
+    print(f"{'случай':<30}{'размер':>8}{'режим':>7}{'время, мс':>12}{'медиана, мс':>13}"
+          f"{'Мп/с':>10}{'изобр./с':>10}{'пик, МБ':>10}")
+    results = []
+    for size in sizes:
+        for mode in modes:
+            for name in cases:
+                result = run_case(name, size, mode, args.repeat, with_memory=not args.no_memory)
+                results.append(result)
+                peak = result["peak_memory_bytes"]
+                print(f"{name:<30}{size:>8}{mode:>7}{result['seconds'] * 1000:>12.1f}"
+                      f"{result['median_seconds'] * 1000:>13.1f}{result['megapixels_per_second']:>10.1f}"
+                      f"{result['outputs_per_second']:>10.1f}"
+                      f"{peak / 2 ** 20 if peak is not None else float('nan'):>10.1f}")
+
+    shutdown_executors()
+    report = {"environment": environment(), "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты сохранены в {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            baseline = json.load(file)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
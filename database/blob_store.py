@@ -0,0 +1,178 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from settings import BLOB_STORE, BLOB_STORE_DIR, BLOB_GC_GRACE_SECONDS
+
+
+def hash_blob(data):
+    """Адрес блоба в хранилище - хэш sha256 его содержимого"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class BlobStore(ABC):
+    """Базовый класс хранилища байтов изображений по адресу-хэшу содержимого.
+       Одинаковые данные хранятся в одном экземпляре"""
+
+    @abstractmethod
+    def put(self, data):
+        """Сохранение данных, возвращает хэш содержимого"""
+        pass
+
+    @abstractmethod
+    def get(self, content_hash):
+        """Получение данных по хэшу, None если блоба нет"""
+        pass
+
+    @abstractmethod
+    def touch(self, content_hash):
+        """Обновление времени записи блоба, чтобы сборщик мусора его не удалил.
+           False, если блоба нет и данные нужно сохранить через put"""
+        pass
+
+    @abstractmethod
+    def delete(self, content_hash):
+        pass
+
+    @abstractmethod
+    def stored_hashes(self, older_than=None):
+        """Хэши всех блобов, при older_than - только записанных раньше этого времени"""
+        pass
+
+    def collect_garbage(self, referenced_hashes, grace_seconds=BLOB_GC_GRACE_SECONDS):
+        """Удаление блобов, на которые не ссылается ни одна строка БД.
+           Недавно записанные блобы не трогаем: строки для них может еще
+           не успеть закоммитить параллельный запрос"""
+        removed = 0
+        for content_hash in self.stored_hashes(older_than=time.time() - grace_seconds):
+            if content_hash not in referenced_hashes:
+                self.delete(content_hash)
+                removed += 1
+        return removed
+
+
+class FileSystemBlobStore(BlobStore):
+    """Хранилище блобов в файловой системе: root/ab/cd/abcd..."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, content_hash):
+        return os.path.join(self.root, content_hash[:2], content_hash[2:4], content_hash)
+
+    def put(self, data):
+        content_hash = hash_blob(data)
+        path = self.path(content_hash)
+        if os.path.exists(path):
+            # такие данные уже сохранены, обновляем время для сборщика мусора
+            os.utime(path)
+            return content_hash
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # пишем во временный файл и атомарно переименовываем, чтобы читатели
+        # никогда не увидели частично записанный блоб
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return content_hash
+
+    def get(self, content_hash):
+        try:
+            with open(self.path(content_hash), "rb") as blob_file:
+                return blob_file.read()
+        except FileNotFoundError:
+            return None
+
+    def touch(self, content_hash):
+        try:
+            os.utime(self.path(content_hash))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def delete(self, content_hash):
+        try:
+            os.remove(self.path(content_hash))
+        except FileNotFoundError:
+            pass
+
+    def stored_hashes(self, older_than=None):
+        for dir_path, _, file_names in os.walk(self.root):
+            for file_name in file_names:
+                if file_name.endswith(".tmp"):
+                    continue
+                if older_than is not None and os.path.getmtime(os.path.join(dir_path, file_name)) >= older_than:
+                    continue
+                yield file_name
+
+
+class MemoryBlobStore(BlobStore):
+    """Хранилище блобов в памяти процесса, используется в тестах"""
+
+    def __init__(self):
+        self._blobs = {}  # хэш -> (данные, время записи)
+        self._lock = threading.Lock()
+
+    def put(self, data):
+        content_hash = hash_blob(data)
+        with self._lock:
+            self._blobs[content_hash] = (bytes(data), time.time())
+        return content_hash
+
+    def get(self, content_hash):
+        blob = self._blobs.get(content_hash)
+        return blob[0] if blob is not None else None
+
+    def touch(self, content_hash):
+        with self._lock:
+            blob = self._blobs.get(content_hash)
+            if blob is None:
+                return False
+            self._blobs[content_hash] = (blob[0], time.time())
+        return True
+
+    def delete(self, content_hash):
+        with self._lock:
+            self._blobs.pop(content_hash, None)
+
+    def stored_hashes(self, older_than=None):
+        with self._lock:
+            return [content_hash for content_hash, (_, stored_at) in self._blobs.items()
+                    if older_than is None or stored_at < older_than]
+
+
+def create_blob_store(kind=BLOB_STORE, root=BLOB_STORE_DIR):
+    """Создание хранилища блобов по настройке BLOB_STORE"""
+    if kind == "filesystem":
+        return FileSystemBlobStore(root)
+    elif kind == "memory":
+        return MemoryBlobStore()
+    else:
+        raise ValueError(f"Неподдерживаемый тип хранилища блобов: {kind}")
+
+
+_blob_store = None
+
+
+def get_blob_store():
+    """Текущее хранилище блобов, создается при первом обращении"""
+    global _blob_store
+    if _blob_store is None:
+        _blob_store = create_blob_store()
+    return _blob_store
+
+
+def set_blob_store(store):
+    """Замена хранилища блобов, например на MemoryBlobStore в тестах"""
+    global _blob_store
+    _blob_store = store
@@ -4,22 +4,85 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../database')))
 from fastapi import FastAPI
 
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import make_url
 
 from sqlalchemy.orm import sessionmaker
 from contextlib import asynccontextmanager
 from database_models import Base
+from database.blob_store import get_blob_store
+from database.eviction import EvictionTask
+from settings import (CLEAR_DATABASE_ON_SHUTDOWN, DATABASE_URL, DATABASE_PROFILE, DATABASE_SYNCHRONOUS,
+                      DATABASE_MMAP_SIZE, DATABASE_CACHE_SIZE, DATABASE_POOL_SIZE, DATABASE_MAX_OVERFLOW,
+                      DATABASE_POOL_TIMEOUT, DATABASE_ECHO)
+
+
+# Профили прагм SQLite, None - значение SQLite по умолчанию.
+# WAL позволяет читать параллельно с записью, а synchronous=NORMAL в режиме WAL
+# делает fsync только при контрольной точке: после сбоя питания теряются
+# последние транзакции, но файл БД остается целым. auto_vacuum=INCREMENTAL
+# позволяет фоновой очистке возвращать свободные страницы понемногу, без VACUUM
+SQLITE_PROFILES = {
+    "legacy": {},
+    "production": {
+        "auto_vacuum": "INCREMENTAL",
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 2 ** 20,  # чтение страниц через отображение файла в память
+        "cache_size": -64 * 2 ** 10,  # отрицательное значение - размер кэша в КБ (64 МБ)
+        "busy_timeout": 5000,  # ожидание блокировки записи вместо ошибки database is locked
+        "temp_store": "MEMORY",
+    },
+    "durable": {
+        "auto_vacuum": "INCREMENTAL",
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "cache_size": -64 * 2 ** 10,
+        "busy_timeout": 5000,
+    },
+}
+
+
+# значения PRAGMA auto_vacuum, которые возвращает SQLite
+AUTO_VACUUM_MODES = {"NONE": 0, "FULL": 1, "INCREMENTAL": 2}
+
+
+def sqlite_pragmas(profile=DATABASE_PROFILE):
+    """Прагмы профиля с учетом переопределений из переменных окружения"""
+    if profile not in SQLITE_PROFILES:
+        raise ValueError(f"Неизвестный профиль БД: {profile}")
+    pragmas = dict(SQLITE_PROFILES[profile])
+    overrides = {"synchronous": DATABASE_SYNCHRONOUS, "mmap_size": DATABASE_MMAP_SIZE,
+                 "cache_size": DATABASE_CACHE_SIZE}
+    pragmas.update({name: value for name, value in overrides.items() if value is not None})
+    return pragmas
 
 
 class Database:
     """Класс для управления базой данных и сессиями."""
 
-    def __init__(self):
-        # Подключаемся к базе SQLite
-        # check_same_thread=False — позволяет использовать одно соединение с базой
-        #                           в разных потоках (нужно для FastAPI)
-        self.DATABASE_URL = "sqlite:///./database/images.db"
-        self.engine = create_engine(self.DATABASE_URL, connect_args={"check_same_thread": False}, echo=True)
+    def __init__(self, url=None, profile=None, echo=DATABASE_ECHO):
+        # Адрес и профиль берутся из настроек, параметры нужны бенчмаркам и тестам
+        self.DATABASE_URL = url or DATABASE_URL
+        self.profile = profile or DATABASE_PROFILE
+        database_url = make_url(self.DATABASE_URL)
+        self.is_sqlite = database_url.get_backend_name() == "sqlite"
+
+        engine_options = {"echo": echo}
+        if self.is_sqlite:
+            # check_same_thread=False — позволяет использовать одно соединение с базой
+            #                           в разных потоках (нужно для FastAPI)
+            engine_options["connect_args"] = {"check_same_thread": False}
+        if not (self.is_sqlite and database_url.database in (None, "", ":memory:")):
+            # БД в памяти живет в одном соединении, для файла и сервера БД
+            # держим пул по числу потоков, которые работают с БД
+            engine_options.update(pool_size=DATABASE_POOL_SIZE, max_overflow=DATABASE_MAX_OVERFLOW,
+                                  pool_timeout=DATABASE_POOL_TIMEOUT, pool_pre_ping=not self.is_sqlite)
+        self.engine = create_engine(self.DATABASE_URL, **engine_options)
+
+        if self.is_sqlite:
+            self.pragmas = sqlite_pragmas(self.profile)
+            event.listen(self.engine, "connect", self._apply_pragmas)
 
         # Создаём сессии для работы с БД
         # autocommit=False — изменения в БД требуют commit().
@@ -29,25 +92,90 @@ class Database:
         # Создаём таблицы, если их ещё нет
         self.create_tables()
 
+    def _apply_pragmas(self, dbapi_connection, connection_record):
+        """Прагмы профиля для каждого нового соединения SQLite"""
+        cursor = dbapi_connection.cursor()
+        for name, value in self.pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
     def create_tables(self):
         """ Создает таблицы в базе данных, если их ещё нет """
+        self.drop_outdated_tables()
         Base.metadata.create_all(bind=self.engine)
+        self.ensure_auto_vacuum()
+
+    def ensure_auto_vacuum(self):
+        """Режим auto_vacuum файла, созданного без него, меняется только
+           полным VACUUM: выполняем его один раз при первом запуске"""
+        mode = self.pragmas.get("auto_vacuum") if self.is_sqlite else None
+        if mode is None:
+            return
+        with self.engine.connect() as conn:
+            current = conn.execute(text("PRAGMA auto_vacuum")).scalar()
+            if current != AUTO_VACUUM_MODES[mode]:
+                conn.execute(text(f"PRAGMA auto_vacuum={mode}"))
+                conn.execute(text("VACUUM"))
+                conn.commit()
+
+    def incremental_vacuum(self, pages=None):
+        """Возврат системе не больше pages свободных страниц файла SQLite
+           (все при pages=None). Без auto_vacuum=INCREMENTAL ничего не делает"""
+        if not self.is_sqlite or self.pragmas.get("auto_vacuum") != "INCREMENTAL":
+            return
+        with self.engine.connect() as conn:
+            conn.execute(text("PRAGMA incremental_vacuum" + (f"({pages})" if pages else "")))
+            conn.commit()
+
+    def drop_outdated_tables(self):
+        """Удаляет таблицы, набор колонок которых не совпадает с моделями.
+           Данные в таблицах временные, поэтому вместо миграций таблица
+           просто пересоздается по актуальной модели"""
+        inspector = inspect(self.engine)
+        existing_tables = set(inspector.get_table_names())
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            if existing_columns != set(table.columns.keys()):
+                table.drop(bind=self.engine)
 
     def clear_database(self):
-        """Очищает таблицу перед завершением работы сервера."""
+        """Очищает все таблицы (тесты, остановка с CLEAR_DATABASE_ON_SHUTDOWN)."""
         with self.engine.connect() as conn:
             conn.execute(text("DELETE FROM images"))  # Удаляем все записи images
             conn.execute(text("DELETE FROM rotate_images"))  # Удаляем все записи rotate_images
             conn.execute(text("DELETE FROM color_correction_images"))  # Удаляем все записи color_correction_images
             conn.execute(text("DELETE FROM distortion_images"))  # Удаляем все записи distortion_images
+            conn.execute(text("DELETE FROM sessions"))  # Удаляем все сессии пользователей
             conn.commit()
-            # Освобождаем неиспользуемое пространство
-            conn.execute(text("VACUUM"))  # Уменьшаем размер файла БД
-            conn.commit()
+            # Удаляем байты изображений из хранилища блобов
+            get_blob_store().collect_garbage(set(), grace_seconds=0)
+            if self.is_sqlite and self.pragmas.get("auto_vacuum") == "INCREMENTAL":
+                # Освобождаем страницы без перезаписи всего файла
+                conn.execute(text("PRAGMA incremental_vacuum"))
+                conn.commit()
+            elif self.is_sqlite:
+                # Освобождаем неиспользуемое пространство
+                conn.execute(text("VACUUM"))  # Уменьшаем размер файла БД
+                conn.commit()
+            if self.is_sqlite and self.pragmas.get("journal_mode") == "WAL":
+                # переносим журнал в файл БД и обрезаем его
+                conn.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
+                conn.commit()
 
     @asynccontextmanager
-    async def lifespan(self, app: FastAPI):
-        """Очистка БД после работы сервера"""
+    async def lifespan(self, app: FastAPI, on_evicted=None):
+        """Фоновая очистка БД во время работы сервера. Полная очистка при
+           остановке - только с CLEAR_DATABASE_ON_SHUTDOWN. on_evicted
+           получает id оригиналов, удаленных фоновой очисткой"""
+        eviction = EvictionTask(self, on_evicted=on_evicted)
+        eviction.start()
         yield
+        await eviction.stop()
+        # при нескольких воркерах один остановленный воркер не должен
+        # удалять изображения пользователей, которых обслуживают остальные
+        if not CLEAR_DATABASE_ON_SHUTDOWN:
+            return
         print("Очищаем базу перед остановкой сервера...")
         self.clear_database()
@@ -1,44 +1,119 @@
+import time
+
 from sqlalchemy.orm import declarative_base
-from sqlalchemy import Column, Integer, LargeBinary, String
+from sqlalchemy import Column, Float, Integer, String, Text
+
+from database.blob_store import get_blob_store
 
 Base = declarative_base()
 
 
+# Байты изображений хранятся вне SQLite в хранилище блобов по хэшу содержимого,
+# в таблицах остаются только метаданные и хэш
+class StoredImageMixin:
+    """Доступ к байтам изображения через хранилище блобов"""
+
+    @property
+    def image_data(self):
+        return get_blob_store().get(self.content_hash)
+
+    @image_data.setter
+    def image_data(self, data):
+        self.content_hash = get_blob_store().put(data)
+
+
+class StoredPreviewMixin:
+    """Доступ к байтам превью через хранилище блобов"""
+
+    @property
+    def preview_data(self):
+        return get_blob_store().get(self.preview_hash) if self.preview_hash else None
+
+    @preview_data.setter
+    def preview_data(self, data):
+        self.preview_hash = get_blob_store().put(data) if data is not None else None
+
+
 # Определение модели хранения изображений
 # Модель ImageDB представляет собой таблицу с именем images
-class ImageDB(Base):
+class ImageDB(StoredImageMixin, Base):
     __tablename__ = "images"  # имя таблицы
     id = Column(Integer, primary_key=True, index=True)  # уникальный ID
+    session_id = Column(String, nullable=False, index=True)  # сессия пользователя, загрузившего изображение
     file_name = Column(String, nullable=False)  # имя загруженного файла
-    image_data = Column(LargeBinary, nullable=False)  # хранение байтовых данных изображения
     mime_type = Column(String, nullable=False)  # тип изображения
+    content_hash = Column(String, nullable=False)  # sha256 байтовых данных изображения в хранилище блобов
+    created_at = Column(Float, nullable=False, default=time.time, index=True)  # время записи, для срока хранения
 
 
 # Определение модели хранения повернутых изображений
 # Модель ImageRotate представляет собой таблицу с именем rotate_images
-class ImageRotate(Base):
+class ImageRotate(StoredImageMixin, StoredPreviewMixin, Base):
     __tablename__ = "rotate_images"  # имя таблицы
     file_name = Column(String, nullable=False)  # имя загруженного файла
     id = Column(Integer, primary_key=True, index=True)  # уникальный ID
-    image_data = Column(LargeBinary, nullable=False)  # хранение байтовых данных изображения
+    session_id = Column(String, nullable=False, index=True)  # сессия пользователя
     mime_type = Column(String, nullable=False)  # тип изображения
+    content_hash = Column(String, nullable=False)  # sha256 байтовых данных изображения в хранилище блобов
+    created_at = Column(Float, nullable=False, default=time.time, index=True)  # время записи, для срока хранения
+    preview_hash = Column(String, nullable=True)  # sha256 байтовых данных превью в хранилище блобов
 
 
 # Определение модели хранения изображений c цветовой коррекцией
 # Модель ImageColorCorrection представляет собой таблицу с именем color_correction_images
-class ImageColorCorrection(Base):
+class ImageColorCorrection(StoredImageMixin, StoredPreviewMixin, Base):
     __tablename__ = "color_correction_images"  # имя таблицы
     file_name = Column(String, nullable=False)  # имя загруженного файла
     id = Column(Integer, primary_key=True, index=True)  # уникальный ID
-    image_data = Column(LargeBinary, nullable=False)  # хранение байтовых данных изображения
+    session_id = Column(String, nullable=False, index=True)  # сессия пользователя
     mime_type = Column(String, nullable=False)  # тип изображения
+    content_hash = Column(String, nullable=False)  # sha256 байтовых данных изображения в хранилище блобов
+    created_at = Column(Float, nullable=False, default=time.time, index=True)  # время записи, для срока хранения
+    preview_hash = Column(String, nullable=True)  # sha256 байтовых данных превью в хранилище блобов
 
 
 # Определение модели хранения изображений с искажениями
 # Модель ImageDistortion представляет собой таблицу с именем distortion_images
-class ImageDistortion(Base):
+class ImageDistortion(StoredImageMixin, StoredPreviewMixin, Base):
     __tablename__ = "distortion_images"  # имя таблицы
     file_name = Column(String, nullable=False)  # имя загруженного файла
     id = Column(Integer, primary_key=True, index=True)  # уникальный ID
-    image_data = Column(LargeBinary, nullable=False)  # хранение байтовых данных изображения
+    session_id = Column(String, nullable=False, index=True)  # сессия пользователя
     mime_type = Column(String, nullable=False)  # тип изображения
+    content_hash = Column(String, nullable=False)  # sha256 байтовых данных изображения в хранилище блобов
+    created_at = Column(Float, nullable=False, default=time.time, index=True)  # время записи, для срока хранения
+    preview_hash = Column(String, nullable=True)  # sha256 байтовых данных превью в хранилище блобов
+
+
+# Определение модели сессии пользователя
+# Модель WorkspaceSession представляет собой таблицу с именем sessions
+class WorkspaceSession(Base):
+    __tablename__ = "sessions"  # имя таблицы
+    id = Column(String, primary_key=True)  # id сессии из cookie
+    created_at = Column(Float, nullable=False)  # время создания
+    last_seen = Column(Float, nullable=False, index=True)  # время последнего запроса, для истечения срока
+    options = Column(Text, nullable=False, default="{}")  # опции обработок в JSON: вид обработки -> опции
+
+
+# Соответствие вида изображения в URL (/images/{kind}/{id}) и модели хранения
+IMAGE_MODELS = {
+    "original": ImageDB,
+    "rotate": ImageRotate,
+    "color_correction": ImageColorCorrection,
+    "distortion": ImageDistortion,
+}
+
+
+def referenced_blob_hashes(db):
+    """Хэши всех блобов, на которые ссылаются строки таблиц"""
+    hashes = set()
+    for model in IMAGE_MODELS.values():
+        hashes.update(content_hash for (content_hash,) in db.query(model.content_hash))
+        if hasattr(model, "preview_hash"):
+            hashes.update(preview_hash for (preview_hash,) in db.query(model.preview_hash) if preview_hash)
+    return hashes
+
+
+def collect_blob_garbage(db):
+    """Удаление из хранилища блобов, оставшихся без строк в таблицах"""
+    return get_blob_store().collect_garbage(referenced_blob_hashes(db))
@@ -0,0 +1,92 @@
+import asyncio
+import time
+from contextlib import suppress
+
+from database.database_models import collect_blob_garbage
+from database.repository import IMAGE_REPOSITORIES, originals
+from database.sessions import delete_session_images, expire_sessions
+from settings import EVICTION_INTERVAL, EVICTION_MAX_ROWS, EVICTION_TTL_SECONDS, EVICTION_VACUUM_PAGES
+
+# Размер БД и хранилища блобов ограничивается во время работы сервера:
+# фоновая задача удаляет сессии с истекшим сроком, строки старше срока
+# хранения своей таблицы и самые старые строки сверх ограничения таблицы,
+# а освободившиеся страницы файла SQLite возвращает системе понемногу
+
+
+def evict(db, ttl_seconds=None, max_rows=None, now=None):
+    """Один проход очистки. Возвращает id удаленных оригиналов, чтобы убрать
+       их из кэша декодированных изображений"""
+    ttl_seconds = EVICTION_TTL_SECONDS if ttl_seconds is None else ttl_seconds
+    max_rows = EVICTION_MAX_ROWS if max_rows is None else max_rows
+    now = time.time() if now is None else now
+
+    original_ids = expire_sessions(db, collect_garbage=False)
+
+    # оригинал удаляется вместе с результатами сессии, сама сессия и ее опции остаются
+    evicted_sessions = set()
+    if ttl_seconds.get("original"):
+        evicted_sessions |= originals.sessions_older_than(db, now - ttl_seconds["original"])
+    if max_rows.get("original"):
+        last_id = originals.overflow_id(db, max_rows["original"])
+        if last_id is not None:
+            evicted_sessions |= originals.sessions_up_to(db, last_id)
+    for session_id in evicted_sessions:
+        original_ids.extend(delete_session_images(db, session_id))
+
+    for kind, repository in IMAGE_REPOSITORIES.items():
+        if repository is originals:
+            continue
+        if ttl_seconds.get(kind):
+            repository.delete_older_than(db, now - ttl_seconds[kind])
+        if max_rows.get(kind):
+            last_id = repository.overflow_id(db, max_rows[kind])
+            if last_id is not None:
+                repository.delete_up_to(db, last_id)
+    db.commit()
+
+    collect_blob_garbage(db)
+    return original_ids
+
+
+class EvictionTask:
+    """Фоновая очистка БД раз в interval секунд. Проход выполняется в
+       отдельном потоке, чтобы не блокировать цикл событий"""
+
+    def __init__(self, database, interval=EVICTION_INTERVAL, on_evicted=None):
+        self.database = database
+        self.interval = interval
+        self.on_evicted = on_evicted  # вызывается со списком id удаленных оригиналов
+        self._task = None
+
+    def run_once(self):
+        db = self.database.SessionLocal()
+        try:
+            original_ids = evict(db)
+        finally:
+            db.close()
+        self.database.incremental_vacuum(EVICTION_VACUUM_PAGES)
+        if self.on_evicted is not None:
+            self.on_evicted(original_ids)
+        return original_ids
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(self.run_once)
+            except Exception as exc:
+                # ошибка одного прохода не должна останавливать очистку
+                print(f"Ошибка фоновой очистки БД: {exc}")
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановка без ожидания следующего прохода"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
@@ -0,0 +1,89 @@
+from sqlalchemy import exists, insert
+
+from database.database_models import IMAGE_MODELS
+
+
+# Байты изображений лежат в хранилище блобов и читаются только при обращении
+# к image_data/preview_data, поэтому запросы репозитория выбирают одни
+# метаданные строк. Все запросы ограничены сессией пользователя
+class ImageRepository:
+    """Запросы к таблице изображений одного вида"""
+
+    def __init__(self, model):
+        self.model = model
+
+    def _session_rows(self, db, session_id):
+        return db.query(self.model).filter(self.model.session_id == session_id)
+
+    def first(self, db, session_id):
+        """Первая строка сессии или None, для оригинала - единственная"""
+        return self._session_rows(db, session_id).order_by(self.model.id).limit(1).one_or_none()
+
+    def get(self, db, session_id, image_id):
+        """Строка по id, None если ее нет или она принадлежит другой сессии"""
+        return (self._session_rows(db, session_id)
+                .filter(self.model.id == image_id)
+                .one_or_none())
+
+    def exists(self, db, session_id):
+        """Есть ли у сессии строки, одним запросом EXISTS без чтения строк"""
+        return db.query(exists().where(self.model.session_id == session_id)).scalar()
+
+    def count(self, db, session_id):
+        return self._session_rows(db, session_id).count()
+
+    def page(self, db, session_id, limit=None, after_id=None):
+        """Строки сессии по возрастанию id. Следующая страница начинается
+           после id последней строки, поэтому запрос не пропускает offset строк"""
+        query = self._session_rows(db, session_id)
+        if after_id is not None:
+            query = query.filter(self.model.id > after_id)
+        query = query.order_by(self.model.id)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+
+    def ids(self, db, session_id):
+        return [image_id for (image_id,) in db.query(self.model.id).filter(self.model.session_id == session_id)]
+
+    def insert_many(self, db, rows):
+        """Вставка списка словарей колонок одним INSERT executemany, без
+           объектов ORM и единицы работы на каждую строку. Коммит - за вызывающим"""
+        if rows:
+            db.execute(insert(self.model), rows)
+
+    def delete(self, db, session_id):
+        """Удаление строк сессии без загрузки их в сессию SQLAlchemy"""
+        return self._session_rows(db, session_id).delete(synchronize_session=False)
+
+    # Запросы фоновой очистки, они работают по всей таблице, а не по сессии
+
+    def sessions_older_than(self, db, cutoff):
+        """Сессии, у которых есть строки, записанные раньше cutoff"""
+        return {session_id for (session_id,) in
+                db.query(self.model.session_id).filter(self.model.created_at < cutoff).distinct()}
+
+    def delete_older_than(self, db, cutoff):
+        return db.query(self.model).filter(self.model.created_at < cutoff).delete(synchronize_session=False)
+
+    def overflow_id(self, db, max_rows):
+        """id самой новой строки за пределами max_rows последних строк,
+           None если таблица в ограничение укладывается"""
+        return (db.query(self.model.id)
+                .order_by(self.model.id.desc())
+                .offset(max_rows)
+                .limit(1)
+                .scalar())
+
+    def sessions_up_to(self, db, last_id):
+        return {session_id for (session_id,) in
+                db.query(self.model.session_id).filter(self.model.id <= last_id).distinct()}
+
+    def delete_up_to(self, db, last_id):
+        return db.query(self.model).filter(self.model.id <= last_id).delete(synchronize_session=False)
+
+
+# Репозиторий для каждого вида изображения в URL (/images/{kind}/{id})
+IMAGE_REPOSITORIES = {kind: ImageRepository(model) for kind, model in IMAGE_MODELS.items()}
+
+originals = IMAGE_REPOSITORIES["original"]
@@ -0,0 +1,95 @@
+import json
+import re
+import time
+import uuid
+
+from sqlalchemy.exc import IntegrityError
+
+from database.database_models import WorkspaceSession, collect_blob_garbage
+from database.repository import IMAGE_REPOSITORIES, originals
+from settings import SESSION_TOUCH_INTERVAL, SESSION_TTL_SECONDS
+
+# Состояние пользователя (оригинал, результаты, опции) привязано к сессии и
+# хранится в БД, а не в памяти процесса, поэтому запросы одного пользователя
+# могут обслуживать разные воркеры uvicorn
+
+_SESSION_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+def is_valid_session_id(session_id):
+    """id сессии из cookie принимаем только в том виде, в каком сами выдаем"""
+    return bool(session_id) and _SESSION_ID_PATTERN.match(session_id) is not None
+
+
+def touch_session(db, session_id):
+    """Создание сессии при первом запросе и продление срока ее жизни.
+       Время последнего запроса пишется не чаще раза в SESSION_TOUCH_INTERVAL"""
+    now = time.time()
+    updated = (db.query(WorkspaceSession)
+               .filter(WorkspaceSession.id == session_id,
+                       WorkspaceSession.last_seen < now - SESSION_TOUCH_INTERVAL)
+               .update({"last_seen": now}, synchronize_session=False))
+    if not updated and db.get(WorkspaceSession, session_id) is None:
+        db.add(WorkspaceSession(id=session_id, created_at=now, last_seen=now, options="{}"))
+    try:
+        db.commit()
+    except IntegrityError:
+        # сессию одновременно создал параллельный запрос
+        db.rollback()
+
+
+def get_session_options(db, session_id, kind, default=None):
+    """Опции обработки kind, сохраненные в сессии"""
+    session = db.get(WorkspaceSession, session_id)
+    if session is None:
+        return default
+    return json.loads(session.options).get(kind, default)
+
+
+def set_session_options(db, session_id, kind, options):
+    """Сохранение опций обработки kind в сессии"""
+    session = db.get(WorkspaceSession, session_id)
+    if session is None:
+        now = time.time()
+        session = WorkspaceSession(id=session_id, created_at=now, last_seen=now, options="{}")
+        db.add(session)
+    stored = json.loads(session.options or "{}")
+    stored[kind] = options
+    session.options = json.dumps(stored, ensure_ascii=False)
+    db.commit()
+
+
+def delete_session_images(db, session_id, kinds=None):
+    """Удаление изображений сессии из таблиц видов kinds (по умолчанию из всех).
+       Возвращает id удаленных оригиналов, чтобы убрать их из кэша"""
+    kinds = IMAGE_REPOSITORIES if kinds is None else kinds
+    original_ids = originals.ids(db, session_id)
+    for kind in kinds:
+        IMAGE_REPOSITORIES[kind].delete(db, session_id)
+    return original_ids
+
+
+def expire_sessions(db, ttl=SESSION_TTL_SECONDS, collect_garbage=True):
+    """Удаление сессий без запросов дольше ttl секунд вместе с изображениями.
+       Возвращает id удаленных оригиналов. collect_garbage=False оставляет
+       сборку мусора в хранилище блобов вызывающему"""
+    cutoff = time.time() - ttl
+    expired = [session_id for (session_id,) in
+               db.query(WorkspaceSession.id).filter(WorkspaceSession.last_seen < cutoff)]
+    if not expired:
+        return []
+
+    original_ids = []
+    for session_id in expired:
+        original_ids.extend(delete_session_images(db, session_id))
+    db.query(WorkspaceSession).filter(WorkspaceSession.id.in_(expired)).delete(synchronize_session=False)
+    db.commit()
+
+    if collect_garbage:
+        collect_blob_garbage(db)
+    return original_ids
+
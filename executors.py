@@ -0,0 +1,87 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from profiling import current_profile
+from settings import DB_WORKERS, PROCESSING_WORKERS, PROCESSING_MAX_QUEUE
+
+
+class ExecutorOverloaded(Exception):
+    """Очередь пула заполнена, новая задача не принимается"""
+    pass
+
+
+class BoundedExecutor:
+    """Пул потоков для блокирующей работы из async обработчиков. Количество
+       одновременно выполняемых задач ограничено числом потоков, длина
+       очереди ограничена max_queue. Считает задачи в очереди и в работе"""
+
+    def __init__(self, name, max_workers, max_queue=None):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self.queued = 0  # задачи, ожидающие свободный поток
+        self.running = 0  # задачи в работе
+        self.completed = 0  # завершенные задачи
+        self.rejected = 0  # задачи, отклоненные из-за переполнения очереди
+
+    async def run(self, fn, *args, **kwargs):
+        """Выполнение блокирующей функции в пуле без блокировки event loop"""
+        with self._lock:
+            if self.max_queue is not None and self.queued >= self.max_queue:
+                self.rejected += 1
+                raise ExecutorOverloaded(f"Очередь пула {self.name} заполнена")
+            self.queued += 1
+
+        # контекст запроса (contextvars) передаем в поток пула
+        context = contextvars.copy_context()
+        # задача профилируемого запроса попадает в его профиль
+        profile = current_profile()
+
+        def task():
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                with profile.thread() if profile is not None else nullcontext():
+                    return context.run(fn, *args, **kwargs)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        future = self._executor.submit(task)
+        future.add_done_callback(self._forget_cancelled)
+        # отмена ожидания (клиент отключился) отменяет и задачу, если она еще в очереди
+        return await asyncio.wrap_future(future)
+
+    def _forget_cancelled(self, future):
+        """Задача отменена до запуска: task не выполнится и очередь не уменьшит"""
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+
+    def stats(self):
+        """Текущее состояние пула"""
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+# быстрые запросы к БД и хранилищу не ждут в одной очереди с тяжелой генерацией
+db_executor = BoundedExecutor("db", DB_WORKERS)
+processing_executor = BoundedExecutor("processing", PROCESSING_WORKERS, PROCESSING_MAX_QUEUE)
+EXECUTORS = [db_executor, processing_executor]
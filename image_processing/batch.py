@@ -0,0 +1,88 @@
+import os
+import shutil
+import tempfile
+import zipfile
+from collections import deque
+from types import SimpleNamespace
+
+from image_processing.image_codecs import DEFAULT_ENCODING
+from image_processing.image_processing_methods import run_image_tasks
+from image_processing.parallel import get_executor
+from settings import BATCH_MAX_IN_FLIGHT, BATCH_WORKERS
+
+# расширения файлов, которые считаются изображениями внутри архива
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tif", ".tiff"}
+
+
+def spool_upload(upload_file):
+    """Копирование загруженного файла во временный файл. Файлы формы
+       закрываются после возврата ответа, а архив отдается потоково дольше"""
+    spooled = tempfile.TemporaryFile()
+    upload_file.seek(0)
+    shutil.copyfileobj(upload_file, spooled, length=1024 * 1024)
+    spooled.seek(0)
+    return spooled
+
+
+def iter_dataset_images(files):
+    """Ленивый обход изображений набора: пары (имя файла, байты). files -
+       список (имя, файловый объект), zip-архивы раскрываются по одному файлу"""
+    for file_name, file_obj in files:
+        if zipfile.is_zipfile(file_obj):
+            file_obj.seek(0)
+            with zipfile.ZipFile(file_obj) as archive:
+                for info in archive.infolist():
+                    if info.is_dir() or os.path.splitext(info.filename)[1].lower() not in IMAGE_EXTENSIONS:
+                        continue
+                    yield info.filename, archive.read(info)
+        else:
+            file_obj.seek(0)
+            yield file_name, file_obj.read()
+
+
+def augment_dataset(images, processes, workers=BATCH_WORKERS, max_in_flight=BATCH_MAX_IN_FLIGHT,
+                    encoding=DEFAULT_ENCODING):
+    """Применение выбранных обработок к каждому изображению набора в пуле
+       процессов. processes - список (ImageProcessing, опции). Генератор пар
+       (имя файла в архиве, байты) в порядке исходных изображений. В работе
+       одновременно не больше max_in_flight изображений, поэтому память не
+       зависит от размера набора. Результаты кодируются по настройкам encoding"""
+    plans = [(process, options, process.plan_tasks(options, encoding)) for process, options in processes]
+    tasks = [task for _, _, process_tasks in plans for task in process_tasks]
+
+    executor = get_executor("process", workers)
+    pending = deque()
+    skipped = []
+
+    def collect(file_name, future):
+        """Разбор результатов одного изображения по процессам обработки"""
+        results = future.result()
+        if results is None:
+            skipped.append(file_name)
+            return
+
+        # имена файлов совпадают с генерацией на страницах сервиса
+        stem = SimpleNamespace(file_name=os.path.splitext(file_name)[0])
+        offset = 0
+        for process, options, process_tasks in plans:
+            process_results = results[offset:offset + len(process_tasks)]
+            offset += len(process_tasks)
+            changed_images = [image_data for task_images in process_results for image_data in task_images]
+            for name, image_data in zip(process.file_names(stem, options, changed_images), changed_images):
+                yield name + encoding.extension, image_data
+
+    try:
+        for file_name, image_data in images:
+            pending.append((file_name, executor.submit(run_image_tasks, image_data, tasks)))
+            if len(pending) >= max_in_flight:
+                yield from collect(*pending.popleft())
+
+        while pending:
+            yield from collect(*pending.popleft())
+    finally:
+        # клиент прервал скачивание - снимаем необработанные изображения с пула
+        for _, future in pending:
+            future.cancel()
+
+    if skipped:
+        yield "skipped.txt", "\n".join(skipped).encode("utf-8")
@@ -0,0 +1,76 @@
+import threading
+from collections import OrderedDict
+
+from settings import DECODED_CACHE_MAX_MB
+
+
+class DecodedImageCache:
+    """Кэш декодированных оригинальных изображений с ограничением по памяти.
+       Ключ - пара (id изображения, хэш содержимого), значение - массив numpy
+       только для чтения. При переполнении вытесняются давно не используемые
+       изображения (LRU)"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, image_id, content_hash):
+        """Получение массива из кэша, None если изображения в кэше нет"""
+        key = (image_id, content_hash)
+        with self._lock:
+            image_array = self._entries.get(key)
+            if image_array is not None:
+                self._entries.move_to_end(key)  # отмечаем как недавно использованное
+            return image_array
+
+    def find(self, content_hash):
+        """Массив любого изображения с таким содержимым, None если его нет.
+           Одинаковые байты, загруженные разными сессиями, не декодируются повторно"""
+        with self._lock:
+            for key, image_array in self._entries.items():
+                if key[1] == content_hash:
+                    return image_array
+        return None
+
+    def put(self, image_id, content_hash, image_array):
+        """Помещение массива в кэш. Массив переводится в режим только для чтения,
+           чтобы ни одна обработка не изменила общий для всех оригинал"""
+        image_array.flags.writeable = False
+
+        # изображение больше всего кэша не сохраняем
+        if image_array.nbytes > self.max_bytes:
+            return image_array
+
+        key = (image_id, content_hash)
+        with self._lock:
+            old_array = self._entries.pop(key, None)
+            if old_array is not None:
+                self.current_bytes -= old_array.nbytes
+            self._entries[key] = image_array
+            self.current_bytes += image_array.nbytes
+
+            # вытесняем давно не используемые изображения
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+        return image_array
+
+    def invalidate(self, image_id=None):
+        """Удаление из кэша всех версий изображения с указанным id,
+           без id - полная очистка кэша"""
+        with self._lock:
+            if image_id is None:
+                self._entries.clear()
+                self.current_bytes = 0
+                return
+            for key in [key for key in self._entries if key[0] == image_id]:
+                self.current_bytes -= self._entries.pop(key).nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# общий для всех процессов обработки кэш декодированных оригиналов
+decoded_cache = DecodedImageCache(DECODED_CACHE_MAX_MB * 1024 * 1024)
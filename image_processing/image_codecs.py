@@ -0,0 +1,74 @@
+import cv2
+
+from settings import OUTPUT_FORMAT, JPEG_QUALITY, PNG_COMPRESSION, WEBP_QUALITY
+
+
+# форматы вывода: имя -> (расширение для OpenCV и имени файла, тип содержимого)
+IMAGE_FORMATS = {
+    "jpeg": (".jpg", "image/jpeg"),
+    "png": (".png", "image/png"),
+    "webp": (".webp", "image/webp"),
+}
+
+# расширение файла по типу содержимого, для строк, записанных в разных форматах
+MIME_EXTENSIONS = {mime_type: extension for extension, mime_type in IMAGE_FORMATS.values()}
+
+
+class ImageEncoding:
+    """Настройки кодирования результатов: формат, качество JPEG/WebP,
+       оптимизация таблиц Хаффмана JPEG, степень сжатия PNG, WebP без потерь.
+       Объект передается в пулы процессов, поэтому хранит только простые поля"""
+
+    def __init__(self, output_format=OUTPUT_FORMAT, quality=None, optimize=False,
+                 png_compression=PNG_COMPRESSION, lossless=False):
+        if output_format not in IMAGE_FORMATS:
+            raise ValueError(f"Неподдерживаемый формат изображения: {output_format}")
+        if lossless and output_format == "jpeg":
+            raise ValueError("Формат jpeg не поддерживает сжатие без потерь")
+        if quality is not None and not 1 <= quality <= 100:
+            raise ValueError("Качество должно быть от 1 до 100")
+        if not 0 <= png_compression <= 9:
+            raise ValueError("Степень сжатия PNG должна быть от 0 до 9")
+
+        self.output_format = output_format
+        self.quality = quality
+        self.optimize = optimize
+        self.png_compression = png_compression
+        self.lossless = lossless
+
+    def __repr__(self):
+        return (f"ImageEncoding({self.output_format!r}, quality={self.quality}, optimize={self.optimize}, "
+                f"png_compression={self.png_compression}, lossless={self.lossless})")
+
+    @property
+    def extension(self):
+        return IMAGE_FORMATS[self.output_format][0]
+
+    @property
+    def mime_type(self):
+        return IMAGE_FORMATS[self.output_format][1]
+
+    def cache_key(self):
+        """Фактические настройки кодирования для ключей кэша: качество по
+           умолчанию подставляется из настроек, как при кодировании"""
+        return self.output_format, tuple(self.params())
+
+    def params(self):
+        """Параметры cv2.imencode для выбранного формата"""
+        if self.output_format == "jpeg":
+            quality = JPEG_QUALITY if self.quality is None else self.quality
+            return [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_OPTIMIZE, int(self.optimize)]
+        if self.output_format == "png":
+            return [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]
+        # качество WebP выше 100 означает сжатие без потерь
+        quality = WEBP_QUALITY if self.quality is None else self.quality
+        return [cv2.IMWRITE_WEBP_QUALITY, 101 if self.lossless else quality]
+
+
+# кодирование по умолчанию, как до появления настроек
+DEFAULT_ENCODING = ImageEncoding()
+
+
+def extension_for_mime(mime_type):
+    """Расширение файла для типа содержимого строки таблицы"""
+    return MIME_EXTENSIONS.get(mime_type, ".jpg")
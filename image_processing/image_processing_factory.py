@@ -4,216 +4,267 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../image_processing')))
 
 from abc import ABC, abstractmethod
-from database.database_models import ImageDB, ImageRotate, ImageColorCorrection, ImageDistortion
-import base64
-from image_processing_methods import rotate_images, color_correction_images, distortion_images
-import os
+from database.database_models import ImageRotate, ImageColorCorrection, ImageDistortion
+from database.repository import IMAGE_REPOSITORIES, originals
+from image_processing_methods import (rotate_images, color_correction_images, distortion_images,
+                                      decode_db_to_cv, make_preview, COLOR_CORRECTION_OPTIONS)
+from database.blob_store import get_blob_store
+from image_processing.image_codecs import DEFAULT_ENCODING, extension_for_mime
+from metrics import timed, track_stage
+from settings import (PREVIEW_MAX_EDGE, PREVIEW_QUALITY, ARCHIVE_BATCH_ROWS, STORE_BATCH_ROWS,
+                      STREAM_GENERATED_IMAGES)
+
+
+def image_url(kind, image_entry):
+    """Адрес бинарного эндпоинта изображения. Хэш в параметре v меняет адрес
+       при смене содержимого, поэтому браузер может кэшировать картинку"""
+    return f"/images/{kind}/{image_entry.id}?v={image_entry.content_hash[:16]}"
+
+
+def preview_url(kind, image_entry):
+    """Адрес превью изображения для галереи"""
+    return f"/images/{kind}/{image_entry.id}/preview?v={image_entry.preview_hash[:16]}"
+
+
+def image_info(kind, image_entry):
+    """Метаданные и адреса строки изображения для шаблонов и JSON-ответов"""
+    preview_hash = getattr(image_entry, "preview_hash", None)
+    return {
+        "id": image_entry.id,
+        "file_name": image_entry.file_name,
+        "mime_type": image_entry.mime_type,
+        "url": image_url(kind, image_entry),
+        "preview_url": preview_url(kind, image_entry) if preview_hash else image_url(kind, image_entry)
+    }
 
 
 class ImageProcessing(ABC):
     """Базовый класс для всех типов обработки изображений"""
+    model = None  # модель таблицы с результатами обработки
+    kind = None  # вид изображений в адресе /images/{kind}/{id}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # полное время генерации каждого вида обработки попадает в метрики
+        if "generate_images" in cls.__dict__:
+            cls.generate_images = timed("generate", cls.kind)(cls.generate_images)
+
+    @property
+    def repository(self):
+        """Запросы к таблице с результатами обработки"""
+        return IMAGE_REPOSITORIES[self.kind]
 
     @abstractmethod
-    def generate_images(self, db, options):
+    def generate_images(self, db, session_id, options, encoding=None, seed=None):
         pass
 
     @abstractmethod
-    def get_images(self, db):
+    def file_names(self, orig_image, options, changed_images, variants=1):
+        """Имена файлов для сгенерированных изображений, variants - число
+           вариантов каждой опции"""
         pass
 
     @abstractmethod
-    def save_images(self, db, save_dir):
+    def plan_tasks(self, options, encoding=None, seed=None, variants=1):
+        """Разбиение генерации на независимые задачи (имя задачи, параметры)
+           для пула процессов фоновых заданий. Результаты задач по порядку
+           дают тот же список изображений, что и generate_images с теми же
+           seed и variants"""
         pass
 
+    @staticmethod
+    def build_preview(image_data, shape):
+        """Создание превью для строки таблицы с результатами обработки"""
+        return make_preview(image_data, shape, PREVIEW_MAX_EDGE, PREVIEW_QUALITY)
+
+    def store_images(self, db, orig_image, options, changed_images, encoding=None, batch_size=STORE_BATCH_ROWS,
+                     variants=1):
+        """Замена результатов сессии сгенерированными изображениями и их превью
+           одной транзакцией. Сначала байты и превью уходят в хранилище блобов,
+           и только потом короткая транзакция удаляет старые строки и вставляет
+           новые INSERT executemany порциями по batch_size, поэтому кодирование
+           и превью не держат блокировку записи БД. changed_images может быть
+           генератором: в памяти остаются только хэши, а не байты изображений.
+           Возвращает хэши записанных изображений по порядку"""
+        encoding = DEFAULT_ENCODING if encoding is None else encoding
+        store = get_blob_store()
+        shape = decode_db_to_cv(orig_image).shape
+
+        rows = [{
+            "session_id": orig_image.session_id,
+            "file_name": file_name,
+            "mime_type": encoding.mime_type,
+            "content_hash": store.put(img),
+            "preview_hash": store.put(self.build_preview(img, shape)),
+        } for file_name, img in zip(self.file_names(orig_image, options, changed_images, variants), changed_images)]
+
+        # блобы новых строк защищены от очистки сроком BLOB_GC_GRACE_SECONDS
+        with track_stage("db_write", self.kind):
+            self.repository.delete(db, orig_image.session_id)
+            for start in range(0, len(rows), batch_size):
+                self.repository.insert_many(db, rows[start:start + batch_size])
+            db.commit()
+        # блобы прошлой генерации удаляет фоновая очистка (database/eviction.py)
+        return [row["content_hash"] for row in rows]
+
+    def get_images(self, db, session_id, limit=None, after_id=None):
+        """Получение адресов текущих изображений сессии из таблицы с результатами
+           обработки. limit и after_id задают страницу: не больше limit строк
+           с id больше after_id. Байты изображений при этом не читаются"""
+        # получаем изображения сессии одним запросом, пустой результат и есть проверка наличия
+        with track_stage("db_read", self.kind):
+            image_entry = self.repository.page(db, session_id, limit, after_id)
+
+        if not image_entry:
+            print(f"Таблица {self.model.__tablename__} данных пуста")
+            return None
+
+        return [image_info(self.kind, img) for img in image_entry]
+
+    def archive_entries(self, session_factory, session_id, batch_size=ARCHIVE_BATCH_ROWS):
+        """Пары (имя файла, байты) для zip-архива с результатами обработки.
+           Строки читаются порциями по id в короткой сессии, байты берутся из
+           хранилища по одному, поэтому память не зависит от числа изображений,
+           а длинная загрузка не держит блокировку чтения БД"""
+        store = get_blob_store()
+        last_id = 0
+        empty = True
+        while True:
+            db = session_factory()
+            try:
+                rows = self.repository.page(db, session_id, batch_size, last_id)
+            finally:
+                db.close()
+
+            if not rows:
+                break
+
+            for row in rows:
+                data = store.get(row.content_hash)
+                if data is None:
+                    # строку перезаписала новая генерация, пока шла загрузка
+                    continue
+                empty = False
+                yield row.file_name + extension_for_mime(row.mime_type), data
+            last_id = rows[-1].id
+
+        if empty:
+            print(f"Таблица {self.model.__tablename__} данных пуста")
+
 
 class Rotate(ImageProcessing):
     """Класс поворота изображения"""
+    model = ImageRotate
+    kind = "rotate"
 
-    def generate_images(self, db, options):
+    def generate_images(self, db, session_id, options, encoding=None, seed=None):
         """Получение загруженного пользователем оригинального изображения,
            шага угла поворота и количества изображений. На основе этих данных
            генерация повернутых изображений и запись их в базу данных"""
-        # очищаем таблицу с повернутыми изображениями перед генерацией новых
-        db.query(ImageRotate).delete()
-
         # достаем загруженное пользователем оригинальное изображение
-        orig_image = db.query(ImageDB).first()
+        orig_image = originals.first(db, session_id)
 
-        if db.query(ImageDB).count() == 0:
-            print(f"Таблица {ImageDB.__tablename__} данных пуста")
+        if orig_image is None:
+            # без оригинала прежние результаты сессии тоже не нужны
+            self.repository.delete(db, session_id)
+            db.commit()
+            print(f"Таблица {originals.model.__tablename__} данных пуста")
             return None
 
-        # поворачиваем изображение
-        changed_images = rotate_images(orig_image=orig_image, angle=options["angle"], count=options["count"])
-
-        # добавляем повернутые изображения в таблицу
-        for i, img in enumerate(changed_images):
-            file_name = orig_image.file_name + "_rotate_" + str((i + 1) * options["angle"]) + "_degrees"
-            new_image = ImageRotate(file_name=file_name, image_data=img, mime_type="image/jpeg")
-            db.add(new_image)
-
-        db.commit()
-
-    def get_images(self, db):
-        """Получение текущих изображений из таблицы с повернутыми изображениями"""
-        # получаем все изображения из таблицы
-        image_entry = db.query(ImageRotate).all()
-
-        if db.query(ImageRotate).count() == 0:
-            print(f"Таблица {ImageRotate.__tablename__} данных пуста")
-            return None
+        # поворачиваем изображение; при потоковой записи повороты приходят
+        # генератором и уходят в хранилище блобов по мере кодирования
+        changed_images = rotate_images(orig_image=orig_image, angle=options["angle"], count=options["count"],
+                                       encoding=encoding, stream=STREAM_GENERATED_IMAGES)
 
-        images = []
-        for img in image_entry:
-            encoded_image = base64.b64encode(img.image_data).decode("utf-8")
-            images.append({
-                "mime_type": img.mime_type,
-                "encoded_image": encoded_image
-            })
-        return images
-
-    def save_images(self, db, save_dir):
-        """Сохранение повернутых изображений на жесткий диск пользователя"""
-        # получаем все изображения из таблицы
-        image_entry = db.query(ImageRotate).all()
-
-        if db.query(ImageRotate).count() == 0:
-            print(f"Таблица {ImageRotate.__tablename__} данных пуста")
-            return None
+        # заменяем прежние повернутые изображения новыми вместе с превью
+        self.store_images(db, orig_image, options, changed_images, encoding)
 
-        # сохраняем в файл
-        for img in image_entry:
-            image_data = img.image_data
-            file_path = os.path.join(save_dir, img.file_name + ".jpg")
+    def file_names(self, orig_image, options, changed_images, variants=1):
+        # имена по углам из опций: повороты могут прийти генератором без длины
+        return [orig_image.file_name + "_rotate_" + str((i + 1) * options["angle"]) + "_degrees"
+                for i in range(options["count"])]
 
-            with open(file_path, "wb") as image_file:
-                image_file.write(image_data)
+    def plan_tasks(self, options, encoding=None, seed=None, variants=1):
+        # каждая задача - один поворот на свой угол, случайных параметров у поворота нет
+        return [("rotate", {"angle": i * options["angle"], "encoding": encoding})
+                for i in range(1, options["count"] + 1)]
 
 
 class ColorCorrection(ImageProcessing):
     """Класс цветокоррекции изображений"""
+    model = ImageColorCorrection
+    kind = "color_correction"
 
-    def generate_images(self, db, options):
+    def generate_images(self, db, session_id, options, encoding=None, seed=None, variants=1):
         """Получение загруженного пользователем оригинального изображения и
            опций цветокоррекции из нажатых чекбоксов. На основе этих данных
            генерация изображений c цветовой коррекцией и запись их в базу данных"""
-        # очищаем таблицу изображений с цветокоррекцией перед генерацией новых
-        db.query(ImageColorCorrection).delete()
-
         # достаем загруженное пользователем оригинальное изображение
-        orig_image = db.query(ImageDB).first()
-        if db.query(ImageDB).count() == 0:
-            print(f"Таблица {ImageDB.__tablename__} данных пуста")
+        orig_image = originals.first(db, session_id)
+        if orig_image is None:
+            # без оригинала прежние результаты сессии тоже не нужны
+            self.repository.delete(db, session_id)
+            db.commit()
+            print(f"Таблица {originals.model.__tablename__} данных пуста")
             return None
 
         # цветокоррекция изображения
-        changed_images = color_correction_images(orig_image=orig_image, options=options)
-
-        # добавляем изображения с цветокоррекцией в таблицу
-        for opt, img in zip(options, changed_images):
-            file_name = orig_image.file_name + "_color_correction_" + opt
-            new_image = ImageColorCorrection(file_name=file_name, image_data=img, mime_type="image/jpeg")
-            db.add(new_image)
-
-        db.commit()
-
-    def get_images(self, db):
-        """Получение текущих изображений из таблицы изображений с цветокоррекцией"""
-        # получаем все изображения из таблицы
-        image_entry = db.query(ImageColorCorrection).all()
-
-        if db.query(ImageColorCorrection).count() == 0:
-            print(f"Таблица {ImageColorCorrection.__tablename__} данных пуста")
-            return None
-
-        images = []
-        for img in image_entry:
-            encoded_image = base64.b64encode(img.image_data).decode("utf-8")
-            images.append({
-                "mime_type": img.mime_type,
-                "encoded_image": encoded_image
-            })
-        return images
-
-    def save_images(self, db, save_dir):
-        """Сохранение изображений с цветокоррекцией на жесткий диск пользователя"""
-
-        # получаем все изображения из таблицы
-        image_entry = db.query(ImageColorCorrection).all()
-
-        if db.query(ImageColorCorrection).count() == 0:
-            print(f"Таблица {ImageColorCorrection.__tablename__} данных пуста")
-            return None
-
-        # сохраняем в файл
-        for img in image_entry:
-            image_data = img.image_data
-            file_path = os.path.join(save_dir, img.file_name + ".jpg")
-
-            with open(file_path, "wb") as image_file:
-                image_file.write(image_data)
+        changed_images = color_correction_images(orig_image=orig_image, options=options, encoding=encoding,
+                                                 variants=variants, seed=seed)
+
+        # заменяем прежние изображения с цветокоррекцией новыми вместе с превью
+        self.store_images(db, orig_image, options, changed_images, encoding, variants=variants)
+
+    def file_names(self, orig_image, options, changed_images, variants=1):
+        # неизвестные опции цветокоррекция пропускает, поэтому имен для них нет;
+        # при нескольких вариантах каждой опции к имени добавляется номер варианта
+        options = [opt for opt in options if opt in COLOR_CORRECTION_OPTIONS]
+        if variants <= 1:
+            return [orig_image.file_name + "_color_correction_" + opt for opt in options]
+        return [orig_image.file_name + "_color_correction_" + opt + "_" + str(i + 1)
+                for opt in options for i in range(variants)]
+
+    def plan_tasks(self, options, encoding=None, seed=None, variants=1):
+        # с зерном все опции берут значения из одного генератора по порядку,
+        # поэтому совпадение с generate_images дает только одна общая задача
+        if seed is not None:
+            return [("color_correction", {"options": options, "encoding": encoding, "variants": variants,
+                                          "seed": seed})]
+        # без зерна каждая задача - одна опция цветокоррекции
+        return [("color_correction", {"options": [opt], "encoding": encoding, "variants": variants})
+                for opt in options]
 
 
 class Distortion(ImageProcessing):
     """Класс искажения изображений"""
+    model = ImageDistortion
+    kind = "distortion"
 
-    def generate_images(self, db, options):
+    def generate_images(self, db, session_id, options, encoding=None, seed=None):
         """Получение загруженного пользователем оригинального изображения и
            типа искажения выбранного в выпадающем меню. На основе этих данных
            генерация изображений c искажениями и запись их в базу данных"""
-        # очищаем таблицу изображений с искажениями перед генерацией новых
-        db.query(ImageDistortion).delete()
-
         # достаем загруженное пользователем оригинальное изображение
-        orig_image = db.query(ImageDB).first()
-        if db.query(ImageDB).count() == 0:
-            print(f"Таблица {ImageDB.__tablename__} данных пуста")
+        orig_image = originals.first(db, session_id)
+        if orig_image is None:
+            # без оригинала прежние результаты сессии тоже не нужны
+            self.repository.delete(db, session_id)
+            db.commit()
+            print(f"Таблица {originals.model.__tablename__} данных пуста")
             return None
 
         # искажение изображения
-        changed_images = distortion_images(orig_image=orig_image, options=options)
-
-        # добавляем изображения с искажениями в таблицу
-        for i, img in enumerate(changed_images):
-            file_name = orig_image.file_name + "_" + options + "_" + str(i + 1)
-            new_image = ImageDistortion(file_name=file_name, image_data=img, mime_type="image/jpeg")
-            db.add(new_image)
-
-        db.commit()
-
-    def get_images(self, db):
-        """Получение текущих изображений из таблицы изображений с искажениями"""
-        # получаем все изображения из таблицы
-        image_entry = db.query(ImageDistortion).all()
-        if db.query(ImageDistortion).count() == 0:
-            print(f"Таблица {ImageDistortion.__tablename__} данных пуста")
-            return None
+        changed_images = distortion_images(orig_image=orig_image, options=options, encoding=encoding, seed=seed)
 
-        images = []
-        for img in image_entry:
-            encoded_image = base64.b64encode(img.image_data).decode("utf-8")
-            images.append({
-                "mime_type": img.mime_type,
-                "encoded_image": encoded_image
-            })
-        return images
-
-    def save_images(self, db, save_dir):
-        """Сохранение изображений после искажения на жесткий диск пользователя"""
-        # получаем все изображения из таблицы
-        image_entry = db.query(ImageDistortion).all()
-
-        if db.query(ImageDistortion).count() == 0:
-            print(f"Таблица {ImageDistortion.__tablename__} данных пуста")
-            return None
+        # заменяем прежние изображения с искажениями новыми вместе с превью
+        self.store_images(db, orig_image, options, changed_images, encoding)
 
-        # сохраняем в файл
-        for img in image_entry:
-            image_data = img.image_data
-            file_path = os.path.join(save_dir, img.file_name + ".jpg")
+    def file_names(self, orig_image, options, changed_images, variants=1):
+        return [orig_image.file_name + "_" + options + "_" + str(i + 1) for i in range(len(changed_images))]
 
-            with open(file_path, "wb") as image_file:
-                image_file.write(image_data)
+    def plan_tasks(self, options, encoding=None, seed=None, variants=1):
+        # все изображения одного типа искажения генерируются одной задачей
+        return [("distortion", {"options": options, "encoding": encoding, "seed": seed})]
 
 
 # Фабрика обработки оригинального изображения
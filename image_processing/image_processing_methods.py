@@ -1,188 +1,678 @@
 import cv2
 import numpy as np
-from scipy.ndimage import gaussian_filter
 
+from collections import deque
+from concurrent.futures import wait
+from contextlib import ExitStack, closing
+from functools import lru_cache, partial
 
-def decode_db_to_cv(db_image):
-    """Декодирование бинарных данных изображения в массив numpy в формате BRG"""
-    buffer = np.frombuffer(db_image.image_data, np.uint8)
-    return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+from image_processing.image_cache import decoded_cache
+from image_processing.image_codecs import DEFAULT_ENCODING
+from image_processing.parallel import get_executor, run_attached, share_array
+from image_processing.result_cache import result_cache
+from metrics import count_bytes, timed, track_stage
+from settings import ROTATE_POOL, ROTATE_WORKERS, ENCODE_WORKERS
 
 
-def encode_cv_to_db(array_image):
-    """Кодирование изображения из массива numpy в формат который можно сохранить или отобразить"""
-    _, buffer = cv2.imencode('.jpg', array_image)
-    return buffer.tobytes()
+def decode_bytes_to_cv(image_data):
+    """Декодирование байтов изображения в массив numpy в формате BRG"""
+    if image_data is None:
+        return None
+    buffer = np.frombuffer(count_bytes("decode", image_data), np.uint8)
+    with track_stage("decode"):
+        return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
 
 
-def rotate_images(orig_image=None, angle=1, count=4):
-    """Метод принимает оригинальное изображение из БД и создает список из повернутых изображений"""
-    if orig_image.image_data is None:
-        print("There is no image")
-        return
+def decode_db_to_cv(db_image):
+    """Декодирование бинарных данных изображения в массив numpy в формате BRG.
+       Оригиналы берутся из кэша декодированных изображений, возвращаемый
+       массив доступен только для чтения"""
+    image_id = getattr(db_image, "id", None)
+    content_hash = getattr(db_image, "content_hash", None)
+    if image_id is None or content_hash is None:
+        return decode_bytes_to_cv(db_image.image_data)
+
+    image_array = decoded_cache.get(image_id, content_hash)
+    if image_array is None:
+        image_array = decode_bytes_to_cv(db_image.image_data)
+        if image_array is not None:
+            decoded_cache.put(image_id, content_hash, image_array)
+    return image_array
+
+
+def encode_cv_to_db(array_image, encoding=None):
+    """Кодирование изображения из массива numpy в формат который можно сохранить или отобразить.
+       Формат и качество задаются настройками encoding (ImageEncoding)"""
+    encoding = DEFAULT_ENCODING if encoding is None else encoding
+    with track_stage("encode", encoding.output_format):
+        ok, buffer = cv2.imencode(encoding.extension, array_image, encoding.params())
+    if not ok:
+        raise ValueError(f"Не удалось закодировать изображение: {encoding}")
+    return count_bytes("encode", buffer.tobytes(), encoding.output_format)
+
+
+def encode_arrays(arrays, encoding=None, workers=None):
+    """Кодирование нескольких результатов. cv2.imencode отпускает GIL,
+       поэтому изображения кодируются параллельно в пуле потоков"""
+    workers = ENCODE_WORKERS if workers is None else workers
+    if workers <= 1 or len(arrays) <= 1:
+        return [encode_cv_to_db(arr, encoding) for arr in arrays]
+    return list(get_executor("thread", workers).map(partial(encode_cv_to_db, encoding=encoding), arrays))
+
+
+# флаги декодирования JPEG сразу в уменьшенном масштабе
+_REDUCED_DECODE_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    1: cv2.IMREAD_COLOR,
+}
+
+
+@timed("preview")
+def make_preview(image_data, shape, max_edge, quality):
+    """Создание превью изображения со стороной не больше max_edge. Байты
+       декодируются сразу в уменьшенном в 2/4/8 раз масштабе, так что полное
+       разрешение в памяти не восстанавливается"""
+    height, width = shape[:2]
+
+    # выбираем наибольший коэффициент уменьшения, при котором превью не станет меньше max_edge
+    scale = next(s for s in (8, 4, 2, 1) if max(height, width) // s >= max_edge or s == 1)
+    preview = cv2.imdecode(np.frombuffer(image_data, np.uint8), _REDUCED_DECODE_FLAGS[scale])
+
+    # доводим до нужного размера
+    ratio = max_edge / max(preview.shape[:2])
+    if ratio < 1:
+        size = (max(1, round(preview.shape[1] * ratio)), max(1, round(preview.shape[0] * ratio)))
+        preview = cv2.resize(preview, size, interpolation=cv2.INTER_AREA)
+
+    _, buffer = cv2.imencode('.jpg', preview, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buffer.tobytes()
 
-    image_array = decode_db_to_cv(orig_image)
+
+@timed("transform", "rotate")
+def rotate_array(image_array, angle):
+    """Поворот массива изображения вокруг центра на заданный угол"""
     (h, w) = image_array.shape[:2]
     center = (w // 2, h // 2)  # центр вращения
 
-    changed_images = []
-    for i in range(1, count + 1):
-        # вычисляем матрицу преобразования и применяем аффинное преобразование
-        mtrx = cv2.getRotationMatrix2D(center, i * angle, 1.0)
-        rotated = cv2.warpAffine(image_array, mtrx, (w, h))
-        changed_images.append(encode_cv_to_db(rotated))
+    # вычисляем матрицу преобразования и применяем аффинное преобразование
+    mtrx = cv2.getRotationMatrix2D(center, angle, 1.0)
+    return cv2.warpAffine(image_array, mtrx, (w, h))
+
+
+def _rotate_and_encode(image_array, angle, encoding=None):
+    """Задача пула потоков: поворот и кодирование одного изображения"""
+    return encode_cv_to_db(rotate_array(image_array, angle), encoding)
 
-    return changed_images
 
+def _rotate_and_encode_shared(handle, angle, encoding=None):
+    """Задача пула процессов: поворот изображения из разделяемой памяти"""
+    return run_attached(handle, _rotate_and_encode, angle, encoding)
 
-def color_correction_images(orig_image=None, options=None):
+
+def _rotate_angles(image_array, angles, workers, pool, encoding):
+    """Поворот и кодирование на список углов в пуле потоков или процессов"""
+    if pool == "serial" or workers <= 1 or len(angles) <= 1:
+        return [_rotate_and_encode(image_array, a, encoding) for a in angles]
+
+    executor = get_executor(pool, workers)
+    if pool == "process":
+        with share_array(image_array) as handle:
+            return list(executor.map(partial(_rotate_and_encode_shared, handle, encoding=encoding), angles))
+    return list(executor.map(partial(_rotate_and_encode, image_array, encoding=encoding), angles))
+
+
+def _iter_rotate_angles(image_array, angles, workers, pool, encoding):
+    """Поворот на список углов с результатами по одному по мере готовности"""
+    if pool == "serial" or workers <= 1 or len(angles) <= 1:
+        for a in angles:
+            yield _rotate_and_encode(image_array, a, encoding)
+        return
+
+    executor = get_executor(pool, workers)
+    pending = deque()
+    with ExitStack() as stack:
+        if pool == "process":
+            handle = stack.enter_context(share_array(image_array))
+            task = partial(_rotate_and_encode_shared, handle, encoding=encoding)
+        else:
+            task = partial(_rotate_and_encode, image_array, encoding=encoding)
+        try:
+            for a in angles:
+                pending.append(executor.submit(task, a))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # при досрочном закрытии генератора разделяемая память освобождается
+            # только после того, как воркеры закончат с ней работать
+            for future in pending:
+                future.cancel()
+            wait(pending)
+
+
+def _cached_rotations(angles, encoding, content_hash):
+    """Ключи кэша и найденные в кэше повороты (None для промахов) по углам"""
+    if content_hash is None:
+        return [None] * len(angles), [None] * len(angles)
+    keys = [result_cache.key(content_hash, "rotate", float(a), encoding) for a in angles]
+    return keys, [result_cache.get(key) for key in keys]
+
+
+def rotate_array_images(image_array, angle=1, count=4, workers=None, pool=None, encoding=None, content_hash=None):
+    """Поворот массива изображения count раз с шагом angle. Поворот и
+       кодирование распределяются по пулу потоков или процессов, порядок
+       результатов совпадает с порядком углов. С content_hash оригинала
+       повороты на уже встречавшиеся углы берутся из кэша результатов"""
+    workers = ROTATE_WORKERS if workers is None else workers
+    pool = ROTATE_POOL if pool is None else pool
+    angles = [i * angle for i in range(1, count + 1)]
+
+    keys, cached = _cached_rotations(angles, encoding, content_hash)
+    missing = [a for a, data in zip(angles, cached) if data is None]
+    computed = iter(_rotate_angles(image_array, missing, workers, pool, encoding) if missing else ())
+    results = []
+    for key, data in zip(keys, cached):
+        if data is None:
+            data = next(computed)
+            if key is not None:
+                result_cache.put(key, data)
+        results.append(data)
+    return results
+
+
+def iter_rotate_array_images(image_array, angle=1, count=4, workers=None, pool=None, encoding=None,
+                             content_hash=None):
+    """Поворот как в rotate_array_images, но результаты отдаются по одному в
+       порядке углов по мере готовности. В работе не больше 2 * workers
+       поворотов, поэтому весь список закодированных изображений в памяти
+       не собирается"""
+    workers = ROTATE_WORKERS if workers is None else workers
+    pool = ROTATE_POOL if pool is None else pool
+    angles = [i * angle for i in range(1, count + 1)]
+
+    keys, cached = _cached_rotations(angles, encoding, content_hash)
+    missing = [a for a, data in zip(angles, cached) if data is None]
+    with closing(_iter_rotate_angles(image_array, missing, workers, pool, encoding)) as computed:
+        for key, data in zip(keys, cached):
+            if data is None:
+                data = next(computed)
+                if key is not None:
+                    result_cache.put(key, data)
+            yield data
+
+
+def rotate_images(orig_image=None, angle=1, count=4, workers=None, pool=None, encoding=None, stream=False):
+    """Метод принимает оригинальное изображение из БД и создает список из повернутых изображений.
+       С stream=True вместо списка возвращается генератор изображений"""
+    image_array = decode_db_to_cv(orig_image)
+    if image_array is None:
+        print("There is no image")
+        return
+
+    rotate = iter_rotate_array_images if stream else rotate_array_images
+    return rotate(image_array, angle=angle, count=count, workers=workers, pool=pool, encoding=encoding,
+                  content_hash=getattr(orig_image, "content_hash", None))
+
+
+def color_correction_images(orig_image=None, options=None, encoding=None, variants=1, seed=None):
     """Метод принимает оригинальное изображение из БД и создает список из
     скорректированных по цвету изображений"""
-    if orig_image.image_data is None:
+    image_array = decode_db_to_cv(orig_image)
+    if image_array is None:
         print("There is no image")
         return
 
+    return color_correction_array_images(image_array, options, encoding, variants, seed,
+                                         content_hash=getattr(orig_image, "content_hash", None))
+
+
+# ===
+# === Операции цветокоррекции над массивом изображения ===
+# ===
+# все значения uint8 по порядку, из них строятся таблицы для cv2.LUT
+_LUT_RAMP = np.arange(256, dtype=np.uint8).reshape(1, 256)
+
+
+class ColorCorrectionEngine:
+    """Цветокоррекция одного изображения. Перевод в HSV выполняется не больше
+       одного раза и переиспользуется всеми вариантами насыщенности и оттенка,
+       канал S или H меняется таблицей из 256 значений (cv2.LUT) без копий во
+       float32/int16. Яркость, контраст и инверсия остаются одним проходом
+       convertScaleAbs/bitwise_not: на изображении целиком они быстрее cv2.LUT
+       (см. benchmarks/color_benchmark.py). Случайные параметры берутся из
+       генератора rng"""
+
+    def __init__(self, image_array, rng=None):
+        self.image_array = image_array
+        self.rng = np.random.default_rng() if rng is None else rng
+        self._hsv_channels = None
+        self._grayscale = None
+
+    @property
+    def is_gray(self):
+        return self.image_array.ndim == 2
+
+    def hsv_channels(self):
+        """Каналы H, S, V изображения, вычисляются при первом обращении"""
+        if self._hsv_channels is None:
+            self._hsv_channels = cv2.split(cv2.cvtColor(self.image_array, cv2.COLOR_BGR2HSV))
+        return self._hsv_channels
+
+    def grayscale(self):
+        """Перевод в оттенки серого"""
+        if self.is_gray:
+            return self.image_array
+        if self._grayscale is None:
+            self._grayscale = cv2.cvtColor(self.image_array, cv2.COLOR_BGR2GRAY)
+        return self._grayscale
+
+    def brightness(self, beta=None):
+        """Изменение яркости на beta, по умолчанию случайное"""
+        if beta is None:
+            beta = int(self.rng.integers(-50, 50))
+        return cv2.convertScaleAbs(self.image_array, alpha=1, beta=beta)
+
+    def contrast(self, alpha=None):
+        """Изменение контраста в alpha раз, по умолчанию случайное"""
+        if alpha is None:
+            alpha = float(self.rng.uniform(0.5, 1.5))
+        return cv2.convertScaleAbs(self.image_array, alpha=alpha, beta=0)
+
+    def inversion(self):
+        """Инверсия цветов"""
+        return cv2.bitwise_not(self.image_array)
+
+    def saturation(self, factor=None):
+        """Изменение насыщенности в factor раз, по умолчанию случайное.
+           У изображения в оттенках серого насыщенности нет"""
+        if self.is_gray:
+            return self.image_array
+        if factor is None:
+            factor = float(self.rng.uniform(0.5, 1.5))
+        hue, sat, value = self.hsv_channels()
+        lut = np.clip(_LUT_RAMP * np.float32(factor), 0, 255).astype(np.uint8)
+        return cv2.cvtColor(cv2.merge([hue, cv2.LUT(sat, lut), value]), cv2.COLOR_HSV2BGR)
+
+    def hue(self, shift=None):
+        """Сдвиг оттенка на shift, по умолчанию случайный.
+           У изображения в оттенках серого оттенка нет"""
+        if self.is_gray:
+            return self.image_array
+        if shift is None:
+            shift = int(self.rng.integers(-20, 20))
+        hue, sat, value = self.hsv_channels()
+        # оттенок в OpenCV от 0 до 179, значения выше не встречаются
+        lut = _LUT_RAMP.astype(np.int16)
+        lut[:, :180] = (lut[:, :180] + shift) % 180
+        return cv2.cvtColor(cv2.merge([cv2.LUT(hue, lut.astype(np.uint8)), sat, value]), cv2.COLOR_HSV2BGR)
+
+    def variants(self, options, count=1):
+        """count вариантов каждой опции по порядку опций. Для детерминированных
+           опций (grayscale, inversion) вариант вычисляется один раз"""
+        changed_arrays = []
+        for opt in options:
+            if opt not in COLOR_CORRECTION_OPTIONS:
+                continue
+            operation = getattr(self, opt)
+            with track_stage("transform", opt):
+                if opt in _DETERMINISTIC_COLOR_OPTIONS:
+                    changed_arrays.extend([operation()] * count)
+                else:
+                    changed_arrays.extend(operation() for _ in range(count))
+        return changed_arrays
+
+
+# опции цветокоррекции со страницы сервиса
+COLOR_CORRECTION_OPTIONS = ("grayscale", "brightness", "contrast", "saturation", "hue", "inversion")
+_DETERMINISTIC_COLOR_OPTIONS = {"grayscale", "inversion"}
+
+
+@timed("transform", "grayscale")
+def grayscale_array(image_array):
+    """Перевод в оттенки серого"""
+    return ColorCorrectionEngine(image_array).grayscale()
+
+
+@timed("transform", "brightness")
+def brightness_array(image_array, beta=None, rng=None):
+    """Изменение яркости на beta, по умолчанию случайное"""
+    return ColorCorrectionEngine(image_array, rng).brightness(beta)
+
+
+@timed("transform", "contrast")
+def contrast_array(image_array, alpha=None, rng=None):
+    """Изменение контраста в alpha раз, по умолчанию случайное"""
+    return ColorCorrectionEngine(image_array, rng).contrast(alpha)
+
+
+@timed("transform", "saturation")
+def saturation_array(image_array, factor=None, rng=None):
+    """Изменение насыщенности в factor раз, по умолчанию случайное"""
+    return ColorCorrectionEngine(image_array, rng).saturation(factor)
+
+
+@timed("transform", "hue")
+def hue_array(image_array, shift=None, rng=None):
+    """Сдвиг оттенка на shift, по умолчанию случайный"""
+    return ColorCorrectionEngine(image_array, rng).hue(shift)
+
+
+@timed("transform", "inversion")
+def inversion_array(image_array):
+    """Инверсия цветов"""
+    return ColorCorrectionEngine(image_array).inversion()
+
+
+def color_correction_array_images(image_array, options=None, encoding=None, variants=1, seed=None,
+                                  content_hash=None):
+    """Цветокоррекция массива изображения по списку опций: variants
+       случайных вариантов каждой опции, случайные параметры из генератора
+       с зерном seed. С content_hash оригинала результаты берутся из кэша:
+       с зерном - весь список, без зерна - детерминированные опции"""
     if options is None:
         options = []
-
-    image_array = decode_db_to_cv(orig_image)
-
-    changed_images = []
+    if seed is None:
+        return _color_correction_array_images(image_array, options, encoding, variants, seed, content_hash)
+
+    count = variants * sum(opt in COLOR_CORRECTION_OPTIONS for opt in options)
+    return result_cache.results(content_hash, "color_correction", (tuple(options), variants, seed), encoding, count,
+                                lambda: _color_correction_array_images(image_array, options, encoding, variants,
+                                                                       seed, content_hash))
+
+
+def _color_correction_array_images(image_array, options, encoding, variants, seed, content_hash):
+    # детерминированные опции не расходуют случайные числа, поэтому их
+    # результаты из кэша не меняют варианты остальных опций
+    cached = {}
+    if content_hash is not None:
+        for opt in _DETERMINISTIC_COLOR_OPTIONS.intersection(options):
+            data = result_cache.get(result_cache.key(content_hash, opt, encoding=encoding))
+            if data is not None:
+                cached[opt] = data
+
+    engine = ColorCorrectionEngine(image_array, np.random.default_rng(seed))
+    changed_arrays = engine.variants([opt for opt in options if opt not in cached], variants)
+
+    # одинаковые варианты детерминированных опций кодируем один раз
+    unique_arrays = list({id(arr): arr for arr in changed_arrays}.values())
+    encoded = dict(zip((id(arr) for arr in unique_arrays), encode_arrays(unique_arrays, encoding)))
+    computed = iter([encoded[id(arr)] for arr in changed_arrays])
+
+    results = []
     for opt in options:
-        if opt == "grayscale":
-            # конвертируем в оттенки серого
-            grayscale_image = cv2.cvtColor(image_array, cv2.COLOR_BGR2GRAY)
-            changed_images.append(encode_cv_to_db(grayscale_image))
-
-        if opt == "brightness":
-            # случайное изменение яркости
-            brightness_image = cv2.convertScaleAbs(image_array, alpha=1, beta=np.random.randint(-50, 50))
-            changed_images.append(encode_cv_to_db(brightness_image))
-
-        if opt == "contrast":
-            # случайное изменение контраста
-            contrast_image = cv2.convertScaleAbs(image_array, alpha=np.random.uniform(0.5, 1.5), beta=0)
-            changed_images.append(encode_cv_to_db(contrast_image))
-
-        if opt == "saturation":
-            # случайное изменение насыщенности
-            hsv = cv2.cvtColor(image_array, cv2.COLOR_BGR2HSV).astype(np.float32)
-            hsv[..., 1] = np.clip(hsv[..., 1] * np.random.uniform(0.5, 1.5), 0, 255)
-            saturation_image = cv2.cvtColor(hsv.astype(np.uint8), cv2.COLOR_HSV2BGR)
-            changed_images.append(encode_cv_to_db(saturation_image))
-
-        if opt == "hue":
-            # случайный сдвиг насыщенности
-            hsv = cv2.cvtColor(image_array, cv2.COLOR_BGR2HSV).astype(np.int16)
-            hsv[..., 0] = (hsv[..., 0] + np.random.randint(-20, 20)) % 180
-            hsv_shift_image = cv2.cvtColor(hsv.astype(np.uint8), cv2.COLOR_HSV2BGR)
-            changed_images.append(encode_cv_to_db(hsv_shift_image))
-
-        if opt == "inversion":
-            # инвертируем цвета
-            inverted_image = cv2.bitwise_not(image_array)
-            changed_images.append(encode_cv_to_db(inverted_image))
-
-    return changed_images
-
-
-def distortion_images(orig_image=None, options=""):
+        if opt not in COLOR_CORRECTION_OPTIONS:
+            continue
+        if opt in cached:
+            results.extend([cached[opt]] * variants)
+            continue
+        option_results = [next(computed) for _ in range(variants)]
+        if content_hash is not None and opt in _DETERMINISTIC_COLOR_OPTIONS and option_results:
+            result_cache.put(result_cache.key(content_hash, opt, encoding=encoding), option_results[0])
+        results.extend(option_results)
+    return results
+
+
+def distortion_images(orig_image=None, options="", encoding=None, seed=None):
     """ Метод принимает оригинальное изображение из БД и создает список из
     искаженных изображений"""
-    if orig_image.image_data is None:
+    image_array = decode_db_to_cv(orig_image)
+    if image_array is None:
         print("There is no image")
         return
 
-    image_array = decode_db_to_cv(orig_image)
-
-    changed_images = []
+    return distortion_array_images(image_array, options, encoding, seed,
+                                   content_hash=getattr(orig_image, "content_hash", None))
+
+
+# ===
+# === Операции искажения над массивом изображения ===
+# ===
+@timed("transform", "flip")
+def flip_array(image_array):
+    """Горизонтальное зеркальное отражение"""
+    return cv2.flip(image_array, 1)
+
+
+@timed("transform", "perspective")
+def perspective_array(image_array, max_offset=0.2, rng=None):
+    """Случайное искажение перспективы: углы смещаются не больше чем на
+       max_offset от размера изображения"""
+    rng = np.random.default_rng() if rng is None else rng
+    height, width = image_array.shape[:2]
+
+    max_x_offset = max(1, int(width * max_offset))  # максимальное смещение углов по горизонтали
+    max_y_offset = max(1, int(height * max_offset))  # максимальное смещение углов по вертикали
+
+    orig_frame = np.float32([  # исходные координаты углов
+        [0, 0],
+        [width - 1, 0],
+        [0, height - 1],
+        [width - 1, height - 1]
+    ])
+    changed_frame = np.float32([  # измененные координаты углов
+        [rng.integers(0, max_x_offset), rng.integers(0, max_y_offset)],
+        [width - rng.integers(0, max_x_offset), rng.integers(0, max_y_offset)],
+        [rng.integers(0, max_x_offset), height - rng.integers(0, max_y_offset)],
+        [width - rng.integers(0, max_x_offset), height - rng.integers(0, max_y_offset)]
+    ])
+
+    matrix = cv2.getPerspectiveTransform(orig_frame, changed_frame)
+    return cv2.warpPerspective(image_array, matrix, (width, height))
+
+
+@lru_cache(maxsize=8)
+def _coordinate_grid(height, width):
+    """Координаты строк и столбцов для карты remap. Вместо полной сетки
+       np.meshgrid хранятся два вектора, которые складываются со смещениями
+       по правилам broadcasting; векторы переиспользуются для одного размера"""
+    rows = np.arange(height, dtype=np.float32)[:, None]
+    cols = np.arange(width, dtype=np.float32)[None, :]
+    rows.flags.writeable = False
+    cols.flags.writeable = False
+    return rows, cols
+
+
+def _elastic_field(shape, sigma, alpha, downscale, rng):
+    """Сглаженное поле смещений float32 размера shape. Шум генерируется в
+       разрешении, уменьшенном в downscale раз, сглаживается с sigma / downscale
+       и растягивается до полного размера: после сглаживания в поле нет частот,
+       которые потерялись бы при уменьшении"""
+    height, width = shape
+    low_height, low_width = max(1, -(-height // downscale)), max(1, -(-width // downscale))
+
+    field = rng.random((low_height, low_width), dtype=np.float32)
+    field *= 2
+    field -= 1
+    field = cv2.GaussianBlur(field, (0, 0), sigma / downscale, borderType=cv2.BORDER_CONSTANT)
+    # у сглаженного белого шума амплитуда обратно пропорциональна sigma, поэтому
+    # поле, сглаженное в уменьшенном разрешении, ослабляем в downscale раз
+    field *= alpha / downscale
+    if downscale > 1:
+        field = cv2.resize(field, (width, height), interpolation=cv2.INTER_LINEAR)
+    return field
+
+
+@timed("transform", "elastic")
+def elastic_array(image_array, sigma=5, alpha=35, downscale=None, rng=None):
+    """Случайная эластичная деформация: смещения пикселей - случайный шум,
+       сглаженный гауссовым фильтром с sigma и умноженный на alpha. Поле
+       смещений считается во float32 в уменьшенном разрешении (downscale, по
+       умолчанию подбирается по sigma) и растягивается до размера изображения"""
+    if downscale is None:
+        # при sigma / downscale >= 1.25 затухание на частоте Найквиста < 0.1%
+        downscale = max(1, int(sigma / 1.25))
+    rng = np.random.default_rng() if rng is None else rng
+    height, width = image_array.shape[:2]
+
+    # генерируем случайные смещения с гауссовым фильтром
+    dx = _elastic_field((height, width), sigma, alpha, downscale, rng)
+    dy = _elastic_field((height, width), sigma, alpha, downscale, rng)
+
+    # превращаем смещения в карту координат на месте, без лишних копий
+    rows, cols = _coordinate_grid(height, width)
+    dx += cols
+    dy += rows
+    np.clip(dx, 0, width - 1, out=dx)
+    np.clip(dy, 0, height - 1, out=dy)
+    return cv2.remap(image_array, dx, dy, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT)
+
+
+@timed("transform", "gaussian_blur")
+def gaussian_blur_array(image_array, ksize=5):
+    """Гауссово размытие"""
+    return cv2.GaussianBlur(image_array, (ksize, ksize), 0)
+
+
+@timed("transform", "average_blur")
+def average_blur_array(image_array, ksize=9):
+    """Размытие по среднему значению"""
+    return cv2.blur(image_array, (ksize, ksize))
+
+
+@timed("transform", "median_blur")
+def median_blur_array(image_array, ksize=7):
+    """Медианное размытие"""
+    return cv2.medianBlur(image_array, ksize)
+
+
+@timed("transform", "salt_and_pepper")
+def salt_and_pepper_array(image_array, amount=0.02, rng=None, out=None):
+    """Случайный шум "соль и перец": доля amount белых и столько же черных точек.
+       Результат пишется в буфер out (если передан), оригинал не меняется"""
+    rng = np.random.default_rng() if rng is None else rng
+    # оригинал из кэша доступен только для чтения, работаем с копией
+    if out is None:
+        out = image_array.copy()
+    else:
+        np.copyto(out, image_array)
+
+    height, width = image_array.shape[:2]
+    # добавляем белые точки - соль
+    num_salt = int(amount * height * width)
+    out[rng.integers(0, height, num_salt, dtype=np.int32),
+        rng.integers(0, width, num_salt, dtype=np.int32)] = 255
+    # добавляем черные точки - перец
+    num_pepper = int(amount * height * width)
+    out[rng.integers(0, height, num_pepper, dtype=np.int32),
+        rng.integers(0, width, num_pepper, dtype=np.int32)] = 0
+    return out
+
+
+# размер полосы шума: сколько значений генерируется за раз (около 1 МБ float32)
+_NOISE_BAND_VALUES = 1 << 18
+
+
+@timed("transform", "gaussian_noise")
+def gaussian_noise_array(image_array, mean=0, sigma=10, rng=None, out=None, scratch=None):
+    """Гауссов шум со средним mean и отклонением sigma. Шум генерируется
+       полосами строк в небольшой буфер float32 и прибавляется к полосе
+       изображения с насыщением в uint8 (отрицательные значения дают 0, а не
+       переполнение). Результат пишется в out, буфер полосы можно передать
+       в scratch, чтобы переиспользовать его между вызовами"""
+    rng = np.random.default_rng() if rng is None else rng
+    if out is None:
+        out = np.empty_like(image_array)
+
+    height = image_array.shape[0]
+    row_shape = image_array.shape[1:]
+    row_values = int(np.prod(row_shape))
+    band_rows = max(1, min(height, _NOISE_BAND_VALUES // row_values))
+    if scratch is None or scratch.size < band_rows * row_values:
+        scratch = np.empty(band_rows * row_values, dtype=np.float32)
+
+    for top in range(0, height, band_rows):
+        bottom = min(top + band_rows, height)
+        noise = scratch[:(bottom - top) * row_values].reshape((bottom - top,) + row_shape)
+        rng.standard_normal(dtype=np.float32, out=noise)
+        noise *= sigma
+        noise += mean
+        cv2.add(image_array[top:bottom], noise, dst=out[top:bottom], dtype=cv2.CV_8U)
+    return out
+
+
+# количество результатов каждого типа искажения
+DISTORTION_RESULTS = {"distortion": 3, "blur": 3, "noise": 3}
+
+
+def distortion_array_images(image_array, options="", encoding=None, seed=None, content_hash=None):
+    """Искажение массива изображения выбранным типом искажения. Случайные
+       параметры берутся из генератора с зерном seed: с одним зерном
+       результаты повторяются. С content_hash оригинала из кэша берутся
+       размытия, отражение и при заданном зерне весь список"""
+    if options != "blur" and seed is None:
+        return _distortion_array_images(image_array, options, encoding, seed, content_hash)
+
+    # размытия не зависят от зерна
+    params = (options, seed if options != "blur" else None)
+    return result_cache.results(content_hash, "distortion", params, encoding, DISTORTION_RESULTS.get(options, 0),
+                                lambda: _distortion_array_images(image_array, options, encoding, seed, content_hash))
+
+
+def _distortion_array_images(image_array, options, encoding, seed, content_hash):
+    rng = np.random.default_rng(seed)
+    changed_arrays = []
     if options == "distortion":
         # ДЕФОРМАЦИЯ
-
-        # горизонтальное зеркальное отражение
-        flipped_horizontally = cv2.flip(image_array, 1)
-        changed_images.append(encode_cv_to_db(flipped_horizontally))
-
-        # случайное искажение перспективы
-        height, width = image_array.shape[:2]
-
-        max_x_offset = int(width * 0.2)  # максимальное смещение углов 20% от размера
-        max_y_offset = int(height * 0.2)  # максимальное смещение углов 20% от размера
-
-        orig_frame = np.float32([  # исходные координаты углов
-            [0, 0],
-            [width - 1, 0],
-            [0, height - 1],
-            [width - 1, height - 1]
-        ])
-        changed_frame = np.float32([  # измененные координаты углов
-            [np.random.randint(0, max_x_offset), np.random.randint(0, max_y_offset)],
-            [width - np.random.randint(0, max_x_offset), np.random.randint(0, max_y_offset)],
-            [np.random.randint(0, max_x_offset), height - np.random.randint(0, max_y_offset)],
-            [width - np.random.randint(0, max_x_offset), height - np.random.randint(0, max_y_offset)]
-        ])
-
-        matrix = cv2.getPerspectiveTransform(orig_frame, changed_frame)
-        perspective_image = cv2.warpPerspective(image_array, matrix, (width, height))
-        changed_images.append(encode_cv_to_db(perspective_image))
-
-        # случайная эластичная деформация
-        shape = image_array.shape
-            # генерируем случайные смещения с гауссовым фильтром
-        dx = gaussian_filter((np.random.rand(*shape[:2]) * 2 - 1), 5, mode="constant", cval=0) * 35
-        dy = gaussian_filter((np.random.rand(*shape[:2]) * 2 - 1), 5, mode="constant", cval=0) * 35
-
-        x, y = np.meshgrid(np.arange(shape[1]), np.arange(shape[0]))
-        indices = (np.clip(y + dy, 0, shape[0] - 1).astype(np.float32),
-                   np.clip(x + dx, 0, shape[1] - 1).astype(np.float32))
-            # создаем карту смещений
-        distorted_image = cv2.remap(image_array, indices[1], indices[0], interpolation=cv2.INTER_LINEAR,
-                                    borderMode=cv2.BORDER_REFLECT)
-        changed_images.append(encode_cv_to_db(distorted_image))
+        # отражение не расходует случайные числа и берется из кэша отдельно
+        flip_key = result_cache.key(content_hash, "flip", encoding=encoding) if content_hash is not None else None
+        flip = result_cache.get(flip_key) if flip_key is not None else None
+        if flip is None:
+            changed_arrays.append(flip_array(image_array))
+        changed_arrays.append(perspective_array(image_array, rng=rng))
+        changed_arrays.append(elastic_array(image_array, rng=rng))
+        encoded = encode_arrays(changed_arrays, encoding)
+        if flip is None:
+            flip = encoded.pop(0)
+            if flip_key is not None:
+                result_cache.put(flip_key, flip)
+        return [flip] + encoded
 
     if options == "blur":
         # РАЗМЫТИЕ
-
-        # гауссово размытие
-        gauss_blur = cv2.GaussianBlur(image_array, (5, 5), 0)
-        changed_images.append(encode_cv_to_db(gauss_blur))
-
-        # размытие по среднему значению
-        average_blur = cv2.blur(image_array, (9, 9))
-        changed_images.append(encode_cv_to_db(average_blur))
-
-        # медианное размытие
-        median_blur = cv2.medianBlur(image_array, 7)
-        changed_images.append(encode_cv_to_db(median_blur))
+        changed_arrays.append(gaussian_blur_array(image_array))
+        changed_arrays.append(average_blur_array(image_array))
+        changed_arrays.append(median_blur_array(image_array))
 
     if options == "noise":
         # ШУМ
-
-        # случайный шум "соль и перец"
-        height, width = image_array.shape[:2]
-            # добавляем белые точки - соль
-        num_salt = int(0.02 * height * width)
-        salt_coords = (np.random.randint(0, height, num_salt), np.random.randint(0, width, num_salt))
-            # добавляем черные точки - перец
-        num_pepper = int(0.02 * height * width)
-        pepper_coords = (np.random.randint(0, height, num_pepper), np.random.randint(0, width, num_pepper))
-
-        if len(image_array.shape) == 3:
-            image_array[salt_coords[0], salt_coords[1], :] = 255
-            image_array[pepper_coords[0], pepper_coords[1], :] = 0
-        else:
-            image_array[salt_coords] = 255
-            image_array[pepper_coords] = 0
-        changed_images.append(encode_cv_to_db(image_array))
-
-        # гауссов шум (низкая интенсивность)
-        gaussian_low = np.random.normal(20, 20, image_array.shape).astype(np.uint8)
-        gauss_image_low = cv2.add(image_array, gaussian_low)
-        changed_images.append(encode_cv_to_db(gauss_image_low))
-
-        # гауссов шум (высокая интенсивность)
-        gaussian_high = np.random.normal(0, 10, image_array.shape).astype(np.uint8)
-        gauss_image_high = cv2.add(image_array, gaussian_high)
-        changed_images.append(encode_cv_to_db(gauss_image_high))
-
-    return changed_images
+        # каждый вариант строится из оригинала в одном и том же буфере и сразу
+        # кодируется: в памяти одна копия изображения и полоса шума
+        out = np.empty_like(image_array)
+        scratch = np.empty(_NOISE_BAND_VALUES, dtype=np.float32)
+        return [
+            # соль и перец
+            encode_cv_to_db(salt_and_pepper_array(image_array, rng=rng, out=out), encoding),
+            # гауссов шум (низкая интенсивность)
+            encode_cv_to_db(gaussian_noise_array(image_array, mean=20, sigma=20, rng=rng,
+                                                 out=out, scratch=scratch), encoding),
+            # гауссов шум (высокая интенсивность)
+            encode_cv_to_db(gaussian_noise_array(image_array, mean=0, sigma=10, rng=rng,
+                                                 out=out, scratch=scratch), encoding),
+        ]
+
+    return encode_arrays(changed_arrays, encoding)
+
+
+# задачи фоновых заданий: каждая возвращает список закодированных изображений
+_SHARED_TASKS = {
+    "rotate": lambda image_array, angle, encoding=None: [_rotate_and_encode(image_array, angle, encoding)],
+    "color_correction": color_correction_array_images,
+    "distortion": distortion_array_images,
+}
+
+
+def run_shared_task(handle, task, params):
+    """Задача пула процессов: обработка изображения из разделяемой памяти"""
+    return run_attached(handle, _SHARED_TASKS[task], **params)
+
+
+def run_image_tasks(image_data, tasks):
+    """Задача пакетной обработки: декодирование одного изображения набора и
+       выполнение над ним списка задач. None, если байты не декодируются"""
+    image_array = decode_bytes_to_cv(image_data)
+    if image_array is None:
+        return None
+    return [_SHARED_TASKS[task](image_array, **params) for task, params in tasks]
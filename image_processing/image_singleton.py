@@ -1,9 +1,15 @@
-import base64
-from database.database_models import ImageDB, ImageRotate, ImageColorCorrection, ImageDistortion
+from database.blob_store import get_blob_store, hash_blob
+from database.database_models import ImageDB
+from database.repository import originals
+from database.sessions import delete_session_images
+from image_processing.image_cache import decoded_cache
+from image_processing.image_processing_factory import image_url
+from image_processing.image_processing_methods import decode_bytes_to_cv
 
 
 class ImageSingleton:
-    """Класс сохранения в базу данных и получения из базы данных оригинального изображения"""
+    """Класс сохранения в базу данных и получения из базы данных оригинального
+       изображения. У каждой сессии пользователя свой оригинал"""
     __instance = None
 
     def __new__(cls):
@@ -11,30 +17,59 @@ class ImageSingleton:
             cls.__instance = super().__new__(cls)
         return cls.__instance
 
-    def set_image(self, db, file_name, image_data, mime_type):
-        """Загрузка нового изображения, очистив все таблицы в базе данных."""
-        # очищаем таблицы в базе данных
-        db.query(ImageDB).delete()
-        db.query(ImageRotate).delete()
-        db.query(ImageColorCorrection).delete()
-        db.query(ImageDistortion).delete()
+    def set_image(self, db, session_id, file_name, image_data, mime_type, content_hash=None):
+        """Загрузка нового изображения сессии, очистив ее изображения во всех
+           таблицах. Декодированное изображение сразу помещается в кэш оригиналов.
+           Повторная загрузка того же содержимого (по хэшу) оставляет оригинал
+           и его результаты. Возвращает True, если оригинал переиспользован"""
+        content_hash = hash_blob(image_data) if content_hash is None else content_hash
+
+        # тот же оригинал: строка, результаты и декодированный массив остаются
+        current_image = originals.first(db, session_id)
+        if current_image is not None and current_image.content_hash == content_hash:
+            return True
+
+        # очищаем изображения сессии в базе данных и убираем из кэша
+        # декодированные версии заменяемых оригиналов
+        for image_id in delete_session_images(db, session_id):
+            decoded_cache.invalidate(image_id)
 
         # удаляем расширение у имени файла
         file_name = file_name.rsplit('.', 1)[0]
 
         # добавляем новое изображение в таблицу с оригинальных изображением
-        new_image = ImageDB(file_name=file_name, image_data=image_data, mime_type=mime_type)
+        # байты сохраняются в хранилище блобов, в таблицу попадает их хэш.
+        # Уже сохраненные байты (например, загруженные другой сессией) не
+        # записываются повторно, блоб только продлевается для сборщика мусора
+        store = get_blob_store()
+        if not store.touch(content_hash):
+            store.put(image_data)
+        new_image = ImageDB(session_id=session_id, file_name=file_name, content_hash=content_hash,
+                            mime_type=mime_type)
         db.add(new_image)
         db.commit()
         db.refresh(new_image)  # обновляем объект, чтобы получить актуальные данные
 
-    def get_image(self, db):
-        """Получение текущего оригинального изображения и типа изображения из базы данных"""
-        # получаем первый и единственный элемент из таблицы оригинального изображения
-        image_entry = db.query(ImageDB).first()
+        # блобы замененного оригинала удаляет фоновая очистка (database/eviction.py)
+
+        # декодируем один раз при загрузке, дальше все процессы обработки берут массив из кэша.
+        # Массив того же содержимого другой сессии переиспользуется без декодирования
+        image_array = decoded_cache.find(content_hash)
+        if image_array is None:
+            image_array = decode_bytes_to_cv(image_data)
+        if image_array is not None:
+            decoded_cache.put(new_image.id, content_hash, image_array)
+        return False
+
+    def get_image(self, db, session_id):
+        """Получение адреса и типа текущего оригинального изображения сессии из базы данных"""
+        # получаем первый и единственный оригинал сессии
+        image_entry = originals.first(db, session_id)
         if image_entry:
             return {
+                "id": image_entry.id,
+                "file_name": image_entry.file_name,
                 "mime_type": image_entry.mime_type,
-                "encoded_image": base64.b64encode(image_entry.image_data).decode("utf-8")
+                "url": image_url("original", image_entry)
             }
         return None
@@ -0,0 +1,197 @@
+import threading
+import time
+import uuid
+from concurrent.futures import CancelledError, ThreadPoolExecutor, as_completed
+
+from database.database_models import ImageDB
+from database.repository import originals
+from image_processing.image_codecs import DEFAULT_ENCODING
+from image_processing.image_processing_methods import decode_db_to_cv, run_shared_task
+from image_processing.parallel import get_executor, share_array
+from settings import JOB_HISTORY, JOB_MAX_IN_FLIGHT, JOB_WORKERS
+
+
+class JobLimitReached(Exception):
+    """Достигнуто максимальное количество одновременно выполняемых заданий"""
+    pass
+
+
+class Job:
+    """Фоновое задание генерации изображений"""
+
+    def __init__(self, process, options, orig_image_id, total, encoding=None, session_id=None, variants=1):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id  # сессия пользователя, поставившего задание
+        self.process = process  # экземпляр ImageProcessing
+        self.options = options
+        self.variants = variants  # количество вариантов каждой опции
+        self.encoding = DEFAULT_ENCODING if encoding is None else encoding  # ImageEncoding
+        self.orig_image_id = orig_image_id
+        self.status = "queued"  # queued, running, done, cancelled, failed
+        self.error = None
+        self.total = total  # количество задач
+        self.done = 0  # количество выполненных задач
+        # (записаны ли результаты в БД, результаты задач по порядку), None - задача
+        # не готова. После записи в БД вместо байтов хранятся хэши блобов, чтобы
+        # завершенные задания не держали изображения в памяти процесса. Признак и
+        # результаты заменяются одним присваиванием, поэтому читатель никогда не
+        # видит хэши без признака или признак с байтами
+        self.results = (False, [None] * total)
+        self.futures = []
+        self.created_at = time.time()
+        self.finished_at = None
+        self.cancel_requested = False
+
+    @property
+    def finished(self):
+        return self.status in ("done", "cancelled", "failed")
+
+    def partial_images(self):
+        """Готовые изображения: (номер задачи, номер изображения в задаче,
+           байты или хэш блоба, если результаты уже записаны в БД)"""
+        _, results = self.results
+        for task_index, images in enumerate(results):
+            for image_index, image_data in enumerate(images or []):
+                yield task_index, image_index, image_data
+
+    def image(self, task_index, image_index):
+        """Готовое изображение задания: (записано ли в БД, байты или хэш блоба),
+           None, если изображение еще не готово"""
+        stored, results = self.results
+        if not 0 <= task_index < len(results):
+            return None
+        images = results[task_index] or []
+        if not 0 <= image_index < len(images):
+            return None
+        return stored, images[image_index]
+
+    def status_info(self):
+        """Состояние задания для опроса клиентом"""
+        return {
+            "job_id": self.id,
+            "kind": self.process.kind,
+            "status": self.status,
+            "error": self.error,
+            "done": self.done,
+            "total": self.total,
+            "progress": round(self.done / self.total, 3) if self.total else 1.0,
+            "results": [f"/jobs/{self.id}/results/{task_index}/{image_index}"
+                        for task_index, image_index, _ in self.partial_images()],
+        }
+
+
+class JobManager:
+    """Очередь фоновых заданий на основе пула процессов. Задание разбивается
+       на задачи через ImageProcessing.plan_tasks, задачи выполняются в пуле
+       процессов над оригиналом в разделяемой памяти, результаты записываются
+       в БД через ImageProcessing.store_images после выполнения всех задач"""
+
+    def __init__(self, session_factory, workers=JOB_WORKERS, max_in_flight=JOB_MAX_IN_FLIGHT,
+                 history=JOB_HISTORY):
+        self.session_factory = session_factory
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.history = history
+        self._jobs = {}
+        self._lock = threading.Lock()
+        # по одному потоку-наблюдателю на выполняемое задание
+        self._watchers = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="job-watcher")
+
+    def in_flight(self):
+        return sum(1 for job in self._jobs.values() if not job.finished)
+
+    def submit(self, db, session_id, process, options, encoding=None, seed=None, variants=1):
+        """Постановка задания сессии в очередь, возвращает задание сразу"""
+        # оригинал декодируется здесь (обычно берется из кэша) и передается
+        # воркерам через разделяемую память
+        orig_image = originals.first(db, session_id)
+        if orig_image is None:
+            raise ValueError("Оригинальное изображение не загружено")
+        image_array = decode_db_to_cv(orig_image)
+
+        tasks = process.plan_tasks(options, encoding, seed, variants)
+        job = Job(process, options, orig_image.id, len(tasks), encoding, session_id, variants)
+
+        with self._lock:
+            if self.in_flight() >= self.max_in_flight:
+                raise JobLimitReached("Слишком много заданий выполняется, повторите позже")
+            self._jobs[job.id] = job
+            self._forget_old_jobs()
+
+        self._watchers.submit(self._run, job, image_array, tasks)
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Отмена задания: задачи в очереди пула снимаются, результаты не записываются"""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        job.cancel_requested = True
+        for future in job.futures:
+            future.cancel()
+        return job
+
+    def _run(self, job, image_array, tasks):
+        """Выполнение задания в потоке-наблюдателе"""
+        job.status = "running"
+        try:
+            executor = get_executor("process", self.workers)
+            with share_array(image_array) as handle:
+                future_index = {}
+                for index, (task, params) in enumerate(tasks):
+                    future = executor.submit(run_shared_task, handle, task, params)
+                    future_index[future] = index
+                    job.futures.append(future)
+
+                for future in as_completed(future_index):
+                    try:
+                        job.results[1][future_index[future]] = future.result()
+                        job.done += 1
+                    except CancelledError:
+                        pass
+
+            if job.cancel_requested:
+                job.results = (False, [None] * job.total)
+                job.status = "cancelled"
+                return
+
+            content_hashes = iter(self._store(job))
+            job.results = (True, [[next(content_hashes) for _ in images or []] for images in job.results[1]])
+            job.status = "done"
+        except Exception as exc:
+            for future in job.futures:
+                future.cancel()
+            job.results = (False, [None] * job.total)
+            job.status = "failed"
+            job.error = str(exc)
+        finally:
+            job.finished_at = time.time()
+
+    def _store(self, job):
+        """Запись результатов задания в таблицу процесса обработки,
+           возвращает хэши записанных изображений по порядку"""
+        db = self.session_factory()
+        try:
+            orig_image = db.get(ImageDB, job.orig_image_id)
+            if orig_image is None:
+                raise RuntimeError("Оригинальное изображение было заменено во время выполнения задания")
+
+            changed_images = [image_data for _, _, image_data in job.partial_images()]
+            return job.process.store_images(db, orig_image, job.options, changed_images, job.encoding,
+                                            variants=job.variants)
+        finally:
+            db.close()
+
+    def _forget_old_jobs(self):
+        """Удаление самых старых завершенных заданий сверх лимита истории"""
+        finished = sorted((job for job in self._jobs.values() if job.finished), key=lambda job: job.finished_at)
+        for job in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[job.id]
+
+    def shutdown(self):
+        for job in list(self._jobs.values()):
+            self.cancel(job.id)
+        self._watchers.shutdown(wait=True)
@@ -0,0 +1,78 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+# пулы создаются один раз на процесс и переиспользуются между запросами
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def _init_process_worker():
+    """Инициализация процесса пула: OpenCV сам распараллеливает операции,
+       внутри воркера оставляем один поток, чтобы не перегружать ядра"""
+    cv2.setNumThreads(1)
+
+
+def get_executor(pool, workers):
+    """Получение общего пула потоков ("thread") или процессов ("process")
+       с заданным числом воркеров"""
+    key = (pool, workers)
+    with _executors_lock:
+        executor = _executors.get(key)
+        if executor is None:
+            if pool == "thread":
+                executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-processing")
+            elif pool == "process":
+                executor = ProcessPoolExecutor(max_workers=workers,
+                                               mp_context=multiprocessing.get_context("spawn"),
+                                               initializer=_init_process_worker)
+            else:
+                raise ValueError(f"Неподдерживаемый тип пула: {pool}")
+            _executors[key] = executor
+        return executor
+
+
+def shutdown_executors():
+    """Остановка всех созданных пулов"""
+    with _executors_lock:
+        for executor in _executors.values():
+            executor.shutdown(wait=True, cancel_futures=True)
+        _executors.clear()
+
+
+@contextmanager
+def share_array(image_array):
+    """Копирование массива в разделяемую память, чтобы процессы пула читали
+       изображение без сериализации на каждую задачу. Возвращает описание
+       (имя, форма, тип), по которому воркер подключается к массиву"""
+    shm = shared_memory.SharedMemory(create=True, size=max(image_array.nbytes, 1))
+    try:
+        shared = np.ndarray(image_array.shape, dtype=image_array.dtype, buffer=shm.buf)
+        shared[...] = image_array
+        del shared
+        yield shm.name, image_array.shape, image_array.dtype.str
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def run_attached(handle, fn, *args, **kwargs):
+    """Выполнение fn над массивом из разделяемой памяти внутри процесса пула.
+       Память подключается только на время задачи: после unlink в share_array
+       воркеры не держат отображения, и память освобождается сразу. numpy не
+       мешает закрыть память, на которую ссылается массив, поэтому fn должна
+       возвращать новые данные (закодированные байты), а не массив или его срез"""
+    name, shape, dtype = handle
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        image_array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        image_array.flags.writeable = False
+        return fn(image_array, *args, **kwargs)
+    finally:
+        image_array = None
+        shm.close()
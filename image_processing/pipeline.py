@@ -0,0 +1,240 @@
+import sys
+import os
+import inspect
+
+import numpy as np
+from pydantic import AfterValidator, BaseModel, ConfigDict, Field, ValidationError
+from typing import Annotated, Optional
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../image_processing')))
+
+from image_processing.parallel import get_executor
+from image_processing_methods import (encode_cv_to_db, rotate_array, grayscale_array, brightness_array,
+                                      contrast_array, saturation_array, hue_array, inversion_array,
+                                      flip_array, perspective_array, elastic_array, gaussian_blur_array,
+                                      average_blur_array, median_blur_array, salt_and_pepper_array,
+                                      gaussian_noise_array)
+from metrics import timed
+from settings import ENCODE_WORKERS, PIPELINE_MAX_BRANCHES, PIPELINE_MAX_STEPS
+
+
+# операции, доступные в цепочках: имя -> функция (массив, **параметры) -> массив
+OPERATIONS = {
+    "rotate": rotate_array,
+    "grayscale": grayscale_array,
+    "brightness": brightness_array,
+    "contrast": contrast_array,
+    "saturation": saturation_array,
+    "hue": hue_array,
+    "inversion": inversion_array,
+    "flip": flip_array,
+    "perspective": perspective_array,
+    "elastic": elastic_array,
+    "gaussian_blur": gaussian_blur_array,
+    "average_blur": average_blur_array,
+    "median_blur": median_blur_array,
+    "salt_and_pepper": salt_and_pepper_array,
+    "gaussian_noise": gaussian_noise_array,
+}
+
+
+# операции со случайными параметрами, принимающие генератор rng
+_RANDOM_OPERATIONS = {op for op, fn in OPERATIONS.items() if "rng" in inspect.signature(fn).parameters}
+
+
+# ===
+# === Параметры операций в цепочках ===
+# ===
+# Параметры приходят из запроса, поэтому типы и диапазоны проверяются до
+# обработки: неверное значение - ошибка запроса, а не исключение OpenCV
+# посреди обхода дерева. Генератор и буферы (rng, out, scratch) операциям
+# передает сам Pipeline, задать их в цепочке нельзя
+class StepParams(BaseModel):
+    model_config = ConfigDict(extra="forbid", allow_inf_nan=False)
+
+
+def _odd_ksize(ksize):
+    if ksize % 2 == 0:
+        raise ValueError("размер ядра должен быть нечетным")
+    return ksize
+
+
+OddKernel = Annotated[int, Field(ge=1, le=99), AfterValidator(_odd_ksize)]
+
+
+class RotateParams(StepParams):
+    angle: float
+
+
+class BrightnessParams(StepParams):
+    beta: Optional[float] = Field(None, ge=-255, le=255)
+
+
+class ContrastParams(StepParams):
+    alpha: Optional[float] = Field(None, ge=0, le=10)
+
+
+class SaturationParams(StepParams):
+    factor: Optional[float] = Field(None, ge=0, le=10)
+
+
+class HueParams(StepParams):
+    shift: Optional[int] = Field(None, ge=-179, le=179)
+
+
+class PerspectiveParams(StepParams):
+    max_offset: float = Field(0.2, ge=0, le=0.5)
+
+
+class ElasticParams(StepParams):
+    sigma: float = Field(5, gt=0, le=100)
+    alpha: float = Field(35, ge=0, le=1000)
+    downscale: Optional[int] = Field(None, ge=1, le=64)
+
+
+class GaussianBlurParams(StepParams):
+    ksize: OddKernel = 5
+
+
+class AverageBlurParams(StepParams):
+    ksize: int = Field(9, ge=1, le=99)
+
+
+class MedianBlurParams(StepParams):
+    ksize: OddKernel = 7
+
+
+class SaltAndPepperParams(StepParams):
+    amount: float = Field(0.02, ge=0, le=1)
+
+
+class GaussianNoiseParams(StepParams):
+    mean: float = Field(0, ge=-255, le=255)
+    sigma: float = Field(10, ge=0, le=255)
+
+
+# схема параметров каждой операции, у операций без параметров - пустая
+STEP_PARAMS = {
+    "rotate": RotateParams,
+    "grayscale": StepParams,
+    "brightness": BrightnessParams,
+    "contrast": ContrastParams,
+    "saturation": SaturationParams,
+    "hue": HueParams,
+    "inversion": StepParams,
+    "flip": StepParams,
+    "perspective": PerspectiveParams,
+    "elastic": ElasticParams,
+    "gaussian_blur": GaussianBlurParams,
+    "average_blur": AverageBlurParams,
+    "median_blur": MedianBlurParams,
+    "salt_and_pepper": SaltAndPepperParams,
+    "gaussian_noise": GaussianNoiseParams,
+}
+
+
+def _step_key(step):
+    """Ключ шага цепочки: имя операции и проверенные параметры в неизменяемом виде"""
+    if isinstance(step, str):
+        step = {"op": step}
+    op = step.get("op")
+    if not isinstance(op, str) or op not in OPERATIONS:
+        raise ValueError(f"Неизвестная операция: {op}")
+    try:
+        params = STEP_PARAMS[op](**{key: value for key, value in step.items() if key != "op"})
+    except ValidationError as e:
+        errors = "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+        raise ValueError(f"Неверные параметры операции {op}: {errors}")
+    # незаданные параметры операция берет по умолчанию, как и без цепочки
+    return op, tuple(sorted(params.model_dump(exclude_unset=True).items()))
+
+
+class Pipeline:
+    """Набор цепочек операций над одним изображением. Промежуточные
+       результаты остаются массивами в памяти, в JPEG кодируется только
+       конец каждой цепочки. Общие начала цепочек вычисляются один раз:
+       цепочки складываются в префиксное дерево и обходятся в глубину"""
+
+    def __init__(self, branches):
+        if not branches:
+            raise ValueError("Не задано ни одной цепочки операций")
+        if len(branches) > PIPELINE_MAX_BRANCHES:
+            raise ValueError(f"Слишком много цепочек операций: не больше {PIPELINE_MAX_BRANCHES}")
+        if any(len(branch) > PIPELINE_MAX_STEPS for branch in branches):
+            raise ValueError(f"Слишком длинная цепочка операций: не больше {PIPELINE_MAX_STEPS} операций")
+
+        self.branches = [[_step_key(step) for step in branch] for branch in branches]
+        # узел дерева: {ключ шага: (дочерний узел, номера цепочек, заканчивающихся здесь)}
+        self._root = {}
+        self._root_ends = []
+        for index, branch in enumerate(self.branches):
+            node, ends = self._root, self._root_ends
+            for key in branch:
+                if key not in node:
+                    node[key] = ({}, [])
+                node, ends = node[key]
+            ends.append(index)
+
+    def __len__(self):
+        return len(self.branches)
+
+    @timed("generate", "pipeline")
+    def run(self, image_array, encoding=None, workers=None, seed=None):
+        """Применение всех цепочек к массиву изображения. Возвращает
+           закодированные по настройкам encoding результаты в порядке цепочек.
+           Концы цепочек кодируются в пуле потоков, пока обход идет дальше.
+           Случайные операции берут значения из генератора с зерном seed"""
+        rng = np.random.default_rng(seed)
+        workers = ENCODE_WORKERS if workers is None else workers
+        if workers > 1:
+            executor = get_executor("thread", workers)
+            encode = lambda arr: executor.submit(encode_cv_to_db, arr, encoding)
+        else:
+            encode = lambda arr: encode_cv_to_db(arr, encoding)
+
+        results = [None] * len(self.branches)
+        for index in self._root_ends:
+            # пустая цепочка - исходное изображение
+            results[index] = encode(image_array)
+
+        self._walk(self._root, image_array, results, encode, rng)
+        return [result.result() if workers > 1 else result for result in results]
+
+    def _walk(self, node, source, results, encode, rng):
+        """Обход поддерева в глубину без рекурсии: в стеке по итератору
+           дочерних шагов на каждый уровень пути. В памяти одновременно только
+           массивы текущего пути от корня и еще не закодированные концы цепочек.
+           Порядок операций тот же, что и у рекурсивного обхода, поэтому с
+           одним зерном случайные операции дают те же результаты"""
+        stack = [(iter(node.items()), source)]
+        while stack:
+            steps, source = stack[-1]
+            step = next(steps, None)
+            if step is None:
+                stack.pop()
+                continue
+            (op, params), (child, ends) = step
+            params = dict(params)
+            if op in _RANDOM_OPERATIONS:
+                params["rng"] = rng
+            changed = OPERATIONS[op](source, **params)
+            if ends:
+                encoded = encode(changed)
+                for index in ends:
+                    results[index] = encoded
+            if child:
+                stack.append((iter(child.items()), changed))
+
+    def count_operations(self):
+        """Число операций при обходе дерева, для сравнения с суммой длин цепочек"""
+        count, nodes = 0, [self._root]
+        while nodes:
+            node = nodes.pop()
+            count += len(node)
+            nodes.extend(child for child, _ in node.values())
+        return count
+
+
+def run_pipeline(image_array, branches, encoding=None, seed=None):
+    """Применение цепочек операций к массиву изображения"""
+    return Pipeline(branches).run(image_array, encoding, seed=seed)
@@ -0,0 +1,199 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from image_processing.image_codecs import DEFAULT_ENCODING
+from metrics import RESULT_CACHE_REQUESTS
+from settings import RESULT_CACHE_DIR, RESULT_CACHE_DISK_MB, RESULT_CACHE_ENABLED, RESULT_CACHE_MEMORY_MB
+
+
+class ResultCache:
+    """Кэш закодированных результатов операций, которые зависят только от
+       оригинала и параметров. Ключ строится из хэша содержимого оригинала,
+       операции, параметров (включая зерно), настроек кодирования и номера
+       результата, поэтому повторная генерация пропускает и преобразование,
+       и кодирование. Два уровня с вытеснением давно не используемых
+       результатов (LRU): память процесса и файлы на диске, общие для
+       воркеров uvicorn"""
+
+    def __init__(self, max_memory_bytes, max_disk_bytes=0, directory=None, enabled=True):
+        self.enabled = enabled
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes if directory else 0
+        self.directory = directory
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self._memory = OrderedDict()  # ключ -> байты
+        self._disk = None  # имя файла -> размер, читается с диска при первом обращении
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(content_hash, operation, params=None, encoding=None, index=0):
+        """Ключ результата: хэш sha256 от описания операции"""
+        encoding = DEFAULT_ENCODING if encoding is None else encoding
+        # качество по умолчанию берется из настроек, поэтому в ключ идут фактические
+        # параметры кодирования: после смены JPEG_QUALITY диск не отдаст старые результаты
+        description = repr((content_hash, operation, params, encoding.cache_key(), index))
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def get(self, key):
+        """Результат по ключу, None при промахе"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+        if data is not None:
+            RESULT_CACHE_REQUESTS.inc(result="hit", tier="memory")
+            return data
+
+        data = self._read_disk(key)
+        if data is None:
+            RESULT_CACHE_REQUESTS.inc(result="miss", tier="")
+            return None
+        RESULT_CACHE_REQUESTS.inc(result="hit", tier="disk")
+        self._put_memory(key, data)
+        return data
+
+    def put(self, key, data):
+        if not self.enabled or data is None:
+            return
+        self._put_memory(key, data)
+        self._write_disk(key, data)
+
+    def results(self, content_hash, operation, params, encoding, count, compute):
+        """count результатов операции из кэша. Если хотя бы одного нет,
+           все результаты вычисляются compute() и записываются в кэш"""
+        if content_hash is None or not self.enabled:
+            return compute()
+        keys = [self.key(content_hash, operation, params, encoding, index) for index in range(count)]
+        cached = []
+        for key in keys:
+            data = self.get(key)
+            if data is None:
+                break
+            cached.append(data)
+        else:
+            return cached
+
+        results = compute()
+        for key, data in zip(keys, results):
+            self.put(key, data)
+        return results
+
+    def clear(self):
+        """Очистка обоих уровней кэша"""
+        with self._lock:
+            self._memory.clear()
+            self.memory_bytes = 0
+            names = list(self._disk or ())
+            self._disk = None
+            self.disk_bytes = 0
+        for name in names:
+            self._remove_file(name)
+
+    def _put_memory(self, key, data):
+        # результат больше всего кэша не сохраняем
+        if len(data) > self.max_memory_bytes:
+            return
+        with self._lock:
+            old_data = self._memory.pop(key, None)
+            if old_data is not None:
+                self.memory_bytes -= len(old_data)
+            self._memory[key] = data
+            self.memory_bytes += len(data)
+            while self.memory_bytes > self.max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self.memory_bytes -= len(evicted)
+
+    # Дисковый уровень. Файлы пишутся атомарно, поэтому воркеры uvicorn
+    # читают результаты друг друга. Размер каждый процесс учитывает по своим
+    # записям и найденным при запуске файлам, так что при нескольких
+    # воркерах папка может временно превышать ограничение
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _disk_index(self):
+        """Файлы кэша на диске от давно использованных к недавним, под self._lock"""
+        if self._disk is None:
+            files = []
+            for dir_path, _, file_names in os.walk(self.directory):
+                for file_name in file_names:
+                    if file_name.endswith(".tmp"):
+                        continue
+                    try:
+                        stat = os.stat(os.path.join(dir_path, file_name))
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, file_name, stat.st_size))
+            self._disk = OrderedDict((name, size) for _, name, size in sorted(files))
+            self.disk_bytes = sum(self._disk.values())
+        return self._disk
+
+    def _read_disk(self, key):
+        if not self.max_disk_bytes:
+            return None
+        try:
+            with open(self._path(key), "rb") as cache_file:
+                data = cache_file.read()
+            os.utime(self._path(key))  # время доступа для порядка LRU после перезапуска
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            disk = self._disk_index()
+            if key in disk:
+                disk.move_to_end(key)
+        return data
+
+    def _write_disk(self, key, data):
+        if not self.max_disk_bytes or len(data) > self.max_disk_bytes:
+            return
+        path = self._path(key)
+        with self._lock:
+            disk = self._disk_index()
+            if key in disk:
+                disk.move_to_end(key)
+                return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(data)
+            os.replace(tmp_path, path)
+        except OSError as exc:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            # без дискового уровня кэш продолжает работать в памяти
+            print(f"Ошибка записи в кэш результатов: {exc}")
+            return
+
+        evicted = []
+        with self._lock:
+            disk = self._disk_index()
+            if key not in disk:
+                disk[key] = len(data)
+                self.disk_bytes += len(data)
+            while self.disk_bytes > self.max_disk_bytes:
+                name, size = disk.popitem(last=False)
+                self.disk_bytes -= size
+                evicted.append(name)
+        for name in evicted:
+            self._remove_file(name)
+
+    def _remove_file(self, name):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return len(self._memory)
+
+
+# общий для обработчиков запросов кэш результатов
+result_cache = ResultCache(RESULT_CACHE_MEMORY_MB * 1024 * 1024, RESULT_CACHE_DISK_MB * 1024 * 1024,
+                           RESULT_CACHE_DIR, enabled=RESULT_CACHE_ENABLED)
@@ -0,0 +1,36 @@
+import io
+import zipfile
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """Поток без перемотки, куда zipfile пишет архив. Записанные байты
+       забираются по частям, поэтому архив целиком в памяти не хранится"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(entries):
+    """Генератор частей zip-архива из пар (имя файла, байты). Файлы пишутся
+       без повторного сжатия (ZIP_STORED): изображения уже сжаты кодеком"""
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_STORED) as archive:
+        for file_name, data in entries:
+            archive.writestr(file_name, data)
+            chunk = buffer.pop()
+            if chunk:
+                yield chunk
+    # центральный каталог архива пишется при закрытии
+    yield buffer.pop()
@@ -1,16 +1,37 @@
-from fastapi.responses import HTMLResponse
-from fastapi import FastAPI, Request, File, UploadFile, Depends, Form
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+from fastapi import FastAPI, Request, File, UploadFile, Depends, Form, HTTPException
 from fastapi.templating import Jinja2Templates
+from starlette.datastructures import MutableHeaders
 
-from pydantic import BaseModel
-from typing import List, Generator
+from pydantic import BaseModel, NonNegativeInt
+from typing import Any, Dict, List, Generator, Optional, Union
+from contextlib import asynccontextmanager
 
 from sqlalchemy.orm import Session
+from database.blob_store import get_blob_store
 from database.database import Database
+from database.repository import IMAGE_REPOSITORIES, originals
+from database.sessions import (get_session_options, is_valid_session_id, new_session_id,
+                               set_session_options, touch_session)
 
+from image_processing.image_cache import decoded_cache
 from image_processing.image_singleton import ImageSingleton
-from image_processing.image_processing_factory import ImageProcessingFactory
+from image_processing.image_processing_factory import ImageProcessingFactory, image_info
+from image_processing.jobs import JobLimitReached, JobManager
+from image_processing.batch import augment_dataset, iter_dataset_images, spool_upload
+from image_processing.zip_stream import stream_zip
+from image_processing.pipeline import Pipeline
+from image_processing.image_processing_methods import COLOR_CORRECTION_OPTIONS, decode_db_to_cv
+from executors import EXECUTORS, ExecutorOverloaded, db_executor, processing_executor
+from metrics import (EXECUTOR_TASKS, HTTP_IN_FLIGHT, HTTP_REQUEST_SECONDS, count_bytes, render_metrics,
+                     track_stage)
+from image_processing.image_codecs import ImageEncoding
+from profiling import finish_profile, profile_mode, profile_name, save_profile, start_profile
+from settings import (IMAGE_CACHE_MAX_AGE, IMAGE_PAGE_SIZE, IMAGE_PAGE_MAX, OUTPUT_FORMAT, PNG_COMPRESSION,
+                      COLOR_CORRECTION_MAX_VARIANTS, SESSION_COOKIE, SESSION_TTL_SECONDS, UPLOAD_CHUNK_BYTES)
+import hashlib
 import os
+import time
 
 # определяем абсолютный путь, где хранится main.py
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -19,11 +40,30 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 TEMPLATES_DIR = os.path.join(BASE_DIR, "templates")
 templates = Jinja2Templates(directory=TEMPLATES_DIR)
 
+
+def render_template(request, name, context):
+    """Рендеринг шаблона Jinja с замером времени"""
+    with track_stage("render", name):
+        return templates.TemplateResponse(request, name, context)
+
+
 # создаем экземпляр базы данных
 db_instance = Database()
 
+# создаем очередь фоновых заданий генерации
+job_manager = JobManager(db_instance.SessionLocal)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Фоновая очистка БД во время работы сервера, остановка фоновых заданий"""
+    async with db_instance.lifespan(app, on_evicted=forget_originals):
+        yield
+        job_manager.shutdown()
+
+
 # создаем FastAPI приложение
-app = FastAPI(lifespan=db_instance.lifespan)
+app = FastAPI(lifespan=lifespan)
 
 
 # Pydantic модели, для валидации передачи данных из форм в программу
@@ -36,25 +76,93 @@ class RotateOptions(BaseModel):
         return cls(angle=angle, count=count)
 
 
+def parse_seed(seed):
+    """Зерно из поля формы: пустое поле - новые случайные значения при каждой генерации"""
+    if seed and not seed.isdigit():
+        raise HTTPException(status_code=400, detail="Зерно должно быть целым неотрицательным числом")
+    return int(seed) if seed else None
+
+
+def check_color_correction_options(options):
+    """Опции цветокоррекции из формы: неизвестная опция - ошибка запроса,
+       а не молча пропущенное изображение"""
+    unknown = [opt for opt in options if opt not in COLOR_CORRECTION_OPTIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Неизвестные опции цветокоррекции: {', '.join(unknown)}. "
+                                                    f"Доступны: {', '.join(COLOR_CORRECTION_OPTIONS)}")
+    return options
+
+
 class ColorCorrectionOptions(BaseModel):
     options: List[str]
+    variants: int = 1
+    seed: Optional[int] = None
 
     @classmethod
-    def as_form(cls, options: List[str] = Form(default=[])):
-        return cls(options=options)
+    def as_form(cls, options: List[str] = Form(default=[]), variants: int = Form(default=1),
+                seed: str = Form(default="")):
+        if not 1 <= variants <= COLOR_CORRECTION_MAX_VARIANTS:
+            raise HTTPException(status_code=400,
+                                detail=f"Количество вариантов должно быть от 1 до {COLOR_CORRECTION_MAX_VARIANTS}")
+        return cls(options=check_color_correction_options(options), variants=variants, seed=parse_seed(seed))
 
 
 class DistortionOptions(BaseModel):
     options: str
+    seed: Optional[int] = None
 
     @classmethod
-    def as_form(cls, options: str = Form(...)):
-        return cls(options=options)
+    def as_form(cls, options: str = Form(...), seed: str = Form(default="")):
+        return cls(options=options, seed=parse_seed(seed))
+
 
+class BatchOptions(BaseModel):
+    rotate_angle: int
+    rotate_count: int
+    color_correction_options: List[str]
+    distortion_options: str
+
+    @classmethod
+    def as_form(cls, rotate_angle: int = Form(default=0), rotate_count: int = Form(default=0),
+                color_correction_options: List[str] = Form(default=[]),
+                distortion_options: str = Form(default="")):
+        return cls(rotate_angle=rotate_angle, rotate_count=rotate_count,
+                   color_correction_options=check_color_correction_options(color_correction_options),
+                   distortion_options=distortion_options)
+
+
+class EncodingOptions(BaseModel):
+    output_format: str = OUTPUT_FORMAT
+    quality: Optional[int] = None
+    optimize: bool = False
+    png_compression: int = PNG_COMPRESSION
+    lossless: bool = False
+
+    @classmethod
+    def as_form(cls, output_format: str = Form(default=OUTPUT_FORMAT), quality: str = Form(default=""),
+                optimize: bool = Form(default=False), png_compression: int = Form(default=PNG_COMPRESSION),
+                lossless: bool = Form(default=False)):
+        # пустое поле качества на странице - качество формата по умолчанию
+        if quality and not quality.isdigit():
+            raise HTTPException(status_code=400, detail="Качество должно быть целым числом")
+        return cls(output_format=output_format, quality=int(quality) if quality else None, optimize=optimize,
+                   png_compression=png_compression, lossless=lossless)
+
+    def to_encoding(self):
+        """Настройки кодирования, 400 при недопустимом сочетании"""
+        try:
+            return ImageEncoding(**self.model_dump())
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+
+class PipelineRequest(BaseModel):
+    # каждая цепочка - список операций: имя или {"op": имя, параметры...}
+    branches: List[List[Union[str, Dict[str, Any]]]]
+    encoding: EncodingOptions = EncodingOptions()
+    # зерно генератора случайных операций, None - новые значения при каждом запросе
+    seed: Optional[NonNegativeInt] = None
 
-# задаем директорию для хранения аугментированных изображений
-SAVE_DIR = os.path.join(BASE_DIR, "augmented_images")
-os.makedirs(SAVE_DIR, exist_ok=True)
 
 # создаем экземпляр класса изображения
 img = ImageSingleton()
@@ -65,10 +173,11 @@ rotate_process = img_factory.create_new_process("rotate")
 color_correction_process = img_factory.create_new_process("color correction")
 distortion_process = img_factory.create_new_process("distortion")
 
-# глобальное хранение опций
-ROTATE_OPTIONS = {}
-COLOR_CORRECTION_OPTIONS = []
-DISTORTION_OPTIONS = "distortion"
+# опции по умолчанию, пока пользователь не задал свои; заданные опции
+# хранятся в сессии пользователя
+DEFAULT_ROTATE_OPTIONS = {}
+DEFAULT_COLOR_CORRECTION_OPTIONS = []
+DEFAULT_DISTORTION_OPTIONS = "distortion"
 
 
 def get_db() -> Generator[Session, None, None]:
@@ -80,193 +189,580 @@ def get_db() -> Generator[Session, None, None]:
         db.close()  # закрываем соединение после выполнения запроса, чтобы избежать утечек памяти
 
 
+# ===
+# === Сессии пользователей ===
+# ===
+# У каждого пользователя свой оригинал, результаты и опции. Они хранятся в БД
+# с привязкой к id сессии из cookie, поэтому пользователи не мешают друг
+# другу, а запросы могут обслуживать разные воркеры uvicorn
+@app.middleware("http")
+async def session_middleware(request: Request, call_next):
+    """Выдача cookie с id сессии новым пользователям. Срок cookie
+       продлевается на каждом запросе, как и срок сессии в БД"""
+    session_id = request.cookies.get(SESSION_COOKIE)
+    if not is_valid_session_id(session_id):
+        session_id = new_session_id()
+    request.state.session_id = session_id
+
+    response = await call_next(request)
+    response.set_cookie(SESSION_COOKIE, session_id, max_age=SESSION_TTL_SECONDS,
+                        httponly=True, samesite="lax")
+    return response
+
+
+def forget_originals(image_ids):
+    """Удаление из кэша декодированных оригиналов, удаленных фоновой очисткой"""
+    for image_id in image_ids:
+        decoded_cache.invalidate(image_id)
+
+
+async def active_session(request: Request, db: Session = Depends(get_db)) -> str:
+    """id сессии пользователя для страниц и генерации, продлевает срок сессии"""
+    session_id = request.state.session_id
+    await db_executor.run(touch_session, db, session_id)
+    return session_id
+
+
+def current_session(request: Request) -> str:
+    """id сессии пользователя без обращения к БД, для отдачи изображений"""
+    return request.state.session_id
+
+
+# ===
+# === Пулы для блокирующей работы ===
+# ===
+# Обработчики async, поэтому синхронные запросы SQLAlchemy и вычисления OpenCV
+# выполняются в отдельных пулах потоков, а event loop продолжает отвечать на
+# другие запросы
+@app.exception_handler(ExecutorOverloaded)
+async def executor_overloaded_handler(request: Request, exc: ExecutorOverloaded):
+    """Очередь генерации заполнена - просим повторить запрос позже"""
+    return PlainTextResponse("Сервер перегружен, повторите запрос позже", status_code=503,
+                             headers={"Retry-After": "5"})
+
+
+# ===
+# === Метрики ===
+# ===
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    """Время запросов по шаблону маршрута и число запросов в работе"""
+    HTTP_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        HTTP_IN_FLIGHT.dec()
+        # шаблон маршрута, а не путь: id в адресах не раздувают число меток
+        route = request.scope.get("route")
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, method=request.method,
+                                     route=route.path if route is not None else "unmatched", status=status)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Метрики в текстовом формате Prometheus: время этапов обработки по
+       операциям, байты изображений, запросы и задачи пулов в работе"""
+    for executor in EXECUTORS:
+        stats = executor.stats()
+        for state in ("queued", "running", "rejected"):
+            EXECUTOR_TASKS.set(stats[state], executor=executor.name, state=state)
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# ===
+# === Профилирование запросов ===
+# ===
+# Включается настройкой PROFILING_ENABLED: запрос с заголовком X-Profile: 1
+# или параметром ?profile=1 профилируется целиком, включая задачи пулов, и
+# профиль записывается в PROFILE_DIR. Имя файла возвращается в заголовке
+# X-Profile-File. PROFILE_AUTO_PERCENT профилирует долю запросов и сохраняет
+# профили тех, что дольше PROFILE_SLOW_MS
+class ProfilingMiddleware:
+    """ASGI-обертка вокруг всего запроса вместе с отдачей тела ответа (архивы,
+       изображения). Профиль останавливается в finally, даже если тело не было
+       отдано (клиент отключился) или обработка прервана, поэтому cProfile
+       потока event loop не остается включенным"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        request = Request(scope)
+        mode = profile_mode(request)
+        if mode is None:
+            return await self.app(scope, receive, send)
+
+        profile = start_profile(profile_name(request.method, request.url.path))
+
+        async def send_with_profile(message):
+            if message["type"] == "http.response.start" and mode == "requested":
+                MutableHeaders(scope=message).append("X-Profile-File", profile.file_name)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            if finish_profile(profile, mode):
+                # запись файла не блокирует event loop
+                await db_executor.run(save_profile, profile)
+
+
+app.add_middleware(ProfilingMiddleware)
+
+
+@app.get("/stats/executors")
+async def executors_stats():
+    """Состояние пулов: длина очереди, задачи в работе, отклоненные задачи"""
+    return {executor.name: executor.stats() for executor in EXECUTORS}
+
+
 # ===
 # === Главная страница и загрузка оригинального изображения ===
 # ===
+def archive_response(process, session_id):
+    """Потоковая отдача результатов обработки сессии zip-архивом. Строки
+       читаются из БД по мере записи архива в своих сессиях БД, сессия
+       запроса к этому моменту уже закрыта"""
+    entries = ((name, count_bytes("archive", data, process.kind))
+               for name, data in process.archive_entries(db_instance.SessionLocal, session_id))
+    return StreamingResponse(stream_zip(entries), media_type="application/zip", headers={
+        "Content-Disposition": f'attachment; filename="{process.kind}.zip"'
+    })
+
+
 @app.get("/", response_class=HTMLResponse)
-async def home(request: Request, db: Session = Depends(get_db)):
+async def home(request: Request, db: Session = Depends(get_db), session_id: str = Depends(active_session)):
     """Главная страница"""
-    return templates.TemplateResponse(request, "index.html", {
-        "orig_image": img.get_image(db)
+    return render_template(request, "index.html", {
+        "orig_image": await db_executor.run(img.get_image, db, session_id)
     })
 
 
+async def read_upload(file):
+    """Чтение загруженного файла частями с подсчетом sha256 содержимого на
+       ходу, тем же хэшем адресуются блобы. Возвращает байты и хэш"""
+    digest = hashlib.sha256()
+    chunks = []
+    while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+        digest.update(chunk)
+        chunks.append(chunk)
+    return count_bytes("upload", b"".join(chunks)), digest.hexdigest()
+
+
 @app.post("/")
 async def upload_image(request: Request, db: Session = Depends(get_db),
+                       session_id: str = Depends(active_session),
                        file: UploadFile = File(..., description="Только изображения")):
     """Выбор файла и загрузка"""
     # проверяем что файл точно изображение
     if not file.content_type.startswith("image/"):
-        return templates.TemplateResponse(request, "index.html", {
+        return render_template(request, "index.html", {
             "error": "Файл не является изображением",
-            "orig_image": img.get_image(db)
+            "orig_image": await db_executor.run(img.get_image, db, session_id)
         })
-    image_data = await file.read()
+    image_data, content_hash = await read_upload(file)
 
-    # добавляем изображение в базу данных
-    img.set_image(db, file.filename, image_data, file.content_type)
+    # добавляем изображение в базу данных; повторно загруженное то же
+    # изображение остается вместе с результатами обработки
+    reused = await processing_executor.run(img.set_image, db, session_id, file.filename, image_data,
+                                           file.content_type, content_hash)
 
-    return templates.TemplateResponse(request, "index.html", {
-        "orig_image": img.get_image(db)
+    return render_template(request, "index.html", {
+        "orig_image": await db_executor.run(img.get_image, db, session_id),
+        "notice": "Это изображение уже загружено, результаты обработки сохранены" if reused else None
     })
 
 
+# ===
+# === Отдача изображений в бинарном виде ===
+# ===
+def etag_matches(if_none_match, etag):
+    """Проверка заголовка If-None-Match на совпадение с ETag изображения"""
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+
+def find_image_entry(db, kind, image_id, session_id):
+    """Поиск строки изображения сессии по виду и id, 404 если такой нет"""
+    repository = IMAGE_REPOSITORIES.get(kind)
+    if repository is None:
+        raise HTTPException(status_code=404, detail="Неизвестный вид изображений")
+
+    # изображения других пользователей для этой сессии не существуют
+    image_entry = repository.get(db, session_id, image_id)
+    if image_entry is None:
+        raise HTTPException(status_code=404, detail="Изображение не найдено")
+    return image_entry
+
+
+async def image_response(request, mime_type, content_hash, load_data):
+    """Ответ с байтами изображения и заголовками ETag/Cache-Control. Если у
+       браузера уже есть эта версия - пустой ответ 304 без чтения байтов"""
+    etag = f'"{content_hash}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"private, max-age={IMAGE_CACHE_MAX_AGE}"
+    }
+
+    # браузер уже хранит эту версию изображения
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    image_data = count_bytes("serve", await db_executor.run(load_data))
+    return Response(content=image_data, media_type=mime_type, headers=headers)
+
+
+def list_image_entries(db, kind, session_id, limit, after_id):
+    """Страница метаданных изображений сессии без чтения байтов"""
+    repository = IMAGE_REPOSITORIES.get(kind)
+    if repository is None:
+        raise HTTPException(status_code=404, detail="Неизвестный вид изображений")
+    return [image_info(kind, row) for row in repository.page(db, session_id, limit, after_id)]
+
+
+@app.get("/images/{kind}")
+async def list_images(kind: str, limit: int = IMAGE_PAGE_SIZE, after: Optional[int] = None,
+                      db: Session = Depends(get_db), session_id: str = Depends(current_session)):
+    """Список изображений сессии постранично: не больше limit штук с id
+       больше after. Для следующей страницы after берется из next_after"""
+    if not 1 <= limit <= IMAGE_PAGE_MAX:
+        raise HTTPException(status_code=400, detail=f"limit должен быть от 1 до {IMAGE_PAGE_MAX}")
+    images = await db_executor.run(list_image_entries, db, kind, session_id, limit, after)
+    return {
+        "images": images,
+        "next_after": images[-1]["id"] if len(images) == limit else None
+    }
+
+
+@app.get("/images/{kind}/{image_id}")
+async def get_image_data(request: Request, kind: str, image_id: int, db: Session = Depends(get_db),
+                         session_id: str = Depends(current_session)):
+    """Отдача байтов изображения с поддержкой ETag и условных GET-запросов"""
+    image_entry = await db_executor.run(find_image_entry, db, kind, image_id, session_id)
+    return await image_response(request, image_entry.mime_type, image_entry.content_hash,
+                                lambda: image_entry.image_data)
+
+
+@app.get("/images/{kind}/{image_id}/preview")
+async def get_image_preview(request: Request, kind: str, image_id: int, db: Session = Depends(get_db),
+                            session_id: str = Depends(current_session)):
+    """Отдача превью изображения для галереи"""
+    image_entry = await db_executor.run(find_image_entry, db, kind, image_id, session_id)
+    if getattr(image_entry, "preview_hash", None) is None:
+        raise HTTPException(status_code=404, detail="Превью не найдено")
+    return await image_response(request, "image/jpeg", image_entry.preview_hash,
+                                lambda: image_entry.preview_data)
+
+
 # ===
 # === Поворот изображения ===
 # ===
 @app.get("/rotate", response_class=HTMLResponse)
-async def rotate(request: Request, db: Session = Depends(get_db)):
+async def rotate(request: Request, db: Session = Depends(get_db), session_id: str = Depends(active_session)):
     """Страница Поворот"""
-    global ROTATE_OPTIONS
-
-    return templates.TemplateResponse(request, "rotate.html", {
-        "rotate_options": ROTATE_OPTIONS,
-        "rotate_images": rotate_process.get_images(db)
+    return render_template(request, "rotate.html", {
+        "rotate_options": await db_executor.run(get_session_options, db, session_id, "rotate",
+                                                DEFAULT_ROTATE_OPTIONS),
+        "rotate_images": await db_executor.run(rotate_process.get_images, db, session_id)
     })
 
 
+def rotate_options_error(options):
+    """Проверка значений поворота, введенных пользователем. Возвращает текст
+       предупреждения или None, если значения допустимы"""
+    if options["count"] < 1:
+        return "Вы пытаетесь повернуть ничто"
+    if options["count"] > 100:
+        return "Вы пытаетесь сгенерировать слишком много изображений"
+    if options["angle"] == 0:
+        return "Вы пытаетесь сгенерировать копии картинок без поворота"
+    return None
+
+
 @app.post("/do_rotate")
-async def do_rotate(request: Request, db: Session = Depends(get_db),
-                    options: RotateOptions = Depends(RotateOptions.as_form)):
+async def do_rotate(request: Request, db: Session = Depends(get_db), session_id: str = Depends(active_session),
+                    options: RotateOptions = Depends(RotateOptions.as_form),
+                    encoding: EncodingOptions = Depends(EncodingOptions.as_form)):
     """Кнопка Сгенерировать"""
-    global ROTATE_OPTIONS
-
-    # берем опции из формы
-    ROTATE_OPTIONS = options.model_dump()
+    # берем опции из формы и запоминаем их в сессии
+    rotate_options = options.model_dump()
+    await db_executor.run(set_session_options, db, session_id, "rotate", rotate_options)
 
     # проверяем значения введенных пользователем и выводим предупреждения для некоторых значений
-    if ROTATE_OPTIONS["count"] < 1:
-        return templates.TemplateResponse(request, "rotate.html", {
-            "rotate_options": ROTATE_OPTIONS,
-            "error": "Вы пытаетесь повернуть ничто",
-            "rotate_images": rotate_process.get_images(db)
-        })
-    if ROTATE_OPTIONS["count"] > 100:
-        return templates.TemplateResponse(request, "rotate.html", {
-            "rotate_options": ROTATE_OPTIONS,
-            "error": "Вы пытаетесь сгенерировать слишком много изображений",
-            "rotate_images": rotate_process.get_images(db)
-        })
-    if ROTATE_OPTIONS["angle"] == 0:
-        return templates.TemplateResponse(request, "rotate.html", {
-            "rotate_options": ROTATE_OPTIONS,
-            "error": "Вы пытаетесь сгенерировать копии картинок без поворота",
-            "rotate_images": rotate_process.get_images(db)
+    error = rotate_options_error(rotate_options)
+    if error:
+        return render_template(request, "rotate.html", {
+            "rotate_options": rotate_options,
+            "error": error,
+            "rotate_images": await db_executor.run(rotate_process.get_images, db, session_id)
         })
 
     # поворачиваем изображения и записываем в базу данных полученные изображения
-    rotate_process.generate_images(db, ROTATE_OPTIONS)
+    await processing_executor.run(rotate_process.generate_images, db, session_id, rotate_options,
+                                  encoding.to_encoding())
 
-    return templates.TemplateResponse(request, "rotate.html", {
-        "rotate_options": ROTATE_OPTIONS,
-        "rotate_images": rotate_process.get_images(db)
+    return render_template(request, "rotate.html", {
+        "rotate_options": rotate_options,
+        "rotate_images": await db_executor.run(rotate_process.get_images, db, session_id)
     })
 
 
 @app.post("/save_rotate")
-async def save_rotate(request: Request, db: Session = Depends(get_db),
-                      save_dir=SAVE_DIR):
-    """Кнопка Сохранить"""
-    global ROTATE_OPTIONS
-
-    # сохраняем повернутые изображения на жесткий диск
-    rotate_process.save_images(db, save_dir)
-
-    return templates.TemplateResponse(request, "rotate.html", {
-        "rotate_options": ROTATE_OPTIONS,
-        "rotate_images": rotate_process.get_images(db)
-    })
+async def save_rotate(session_id: str = Depends(active_session)):
+    """Кнопка Сохранить: скачивание результатов zip-архивом"""
+    return archive_response(rotate_process, session_id)
 
 
 # ===
 # === Цветокоррекция изображения ===
 # ===
 @app.get("/color_correction", response_class=HTMLResponse)
-async def color_correction(request: Request, db: Session = Depends(get_db)):
+async def color_correction(request: Request, db: Session = Depends(get_db),
+                           session_id: str = Depends(active_session)):
     """Страница Цветокоррекции"""
-    global COLOR_CORRECTION_OPTIONS
-
-    return templates.TemplateResponse(request, "color_correction.html", {
-        "color_correction_options": COLOR_CORRECTION_OPTIONS,
-        "color_correction_images": color_correction_process.get_images(db)
+    return render_template(request, "color_correction.html", {
+        "color_correction_options": await db_executor.run(get_session_options, db, session_id, "color_correction",
+                                                          DEFAULT_COLOR_CORRECTION_OPTIONS),
+        "color_correction_images": await db_executor.run(color_correction_process.get_images, db, session_id)
     })
 
 
 @app.post("/do_color_correction")
 async def do_color_correction(request: Request, db: Session = Depends(get_db),
-                              options: ColorCorrectionOptions = Depends(ColorCorrectionOptions.as_form)):
+                              session_id: str = Depends(active_session),
+                              options: ColorCorrectionOptions = Depends(ColorCorrectionOptions.as_form),
+                              encoding: EncodingOptions = Depends(EncodingOptions.as_form)):
     """Кнопка Сгенерировать"""
-    global COLOR_CORRECTION_OPTIONS
-
-    # берем опции из формы
-    COLOR_CORRECTION_OPTIONS = options.options
+    # берем опции из формы и запоминаем их в сессии
+    color_correction_options = options.options
+    await db_executor.run(set_session_options, db, session_id, "color_correction", color_correction_options)
 
     # делаем цветокоррекцию изображения и записываем в базу данных полученные изображения
-    color_correction_process.generate_images(db, COLOR_CORRECTION_OPTIONS)
+    await processing_executor.run(color_correction_process.generate_images, db, session_id,
+                                  color_correction_options, encoding.to_encoding(), options.seed, options.variants)
 
-    return templates.TemplateResponse(request, "color_correction.html", {
-        "color_correction_options": COLOR_CORRECTION_OPTIONS,
-        "color_correction_images": color_correction_process.get_images(db)
+    return render_template(request, "color_correction.html", {
+        "color_correction_options": color_correction_options,
+        "color_correction_images": await db_executor.run(color_correction_process.get_images, db, session_id)
     })
 
 
 @app.post("/save_color_correction")
-async def save_color_correction(request: Request, db: Session = Depends(get_db),
-                                save_dir=SAVE_DIR):
-    """Кнопка Сохранить"""
-    global COLOR_CORRECTION_OPTIONS
-
-    # сохраняем изображения с цветокоррекцией на жесткий диск
-    color_correction_process.save_images(db, save_dir)
-
-    return templates.TemplateResponse(request, "color_correction.html", {
-        "color_correction_options": COLOR_CORRECTION_OPTIONS,
-        "color_correction_images": color_correction_process.get_images(db)
-    })
+async def save_color_correction(session_id: str = Depends(active_session)):
+    """Кнопка Сохранить: скачивание результатов zip-архивом"""
+    return archive_response(color_correction_process, session_id)
 
 
 # ===
 # === Искажение изображения ===
 # ===
 @app.get("/distortion", response_class=HTMLResponse)
-async def distortion(request: Request, db: Session = Depends(get_db)):
+async def distortion(request: Request, db: Session = Depends(get_db), session_id: str = Depends(active_session)):
     """Страница Искажение"""
-    global DISTORTION_OPTIONS
-
-    return templates.TemplateResponse(request, "distortion.html", {
-        "distortion_options": DISTORTION_OPTIONS,
-        "distortion_images": distortion_process.get_images(db)
+    return render_template(request, "distortion.html", {
+        "distortion_options": await db_executor.run(get_session_options, db, session_id, "distortion",
+                                                    DEFAULT_DISTORTION_OPTIONS),
+        "distortion_images": await db_executor.run(distortion_process.get_images, db, session_id)
     })
 
 
 @app.post("/do_distortion")
 async def do_distortion(request: Request, db: Session = Depends(get_db),
-                        options: DistortionOptions = Depends(DistortionOptions.as_form)):
+                        session_id: str = Depends(active_session),
+                        options: DistortionOptions = Depends(DistortionOptions.as_form),
+                        encoding: EncodingOptions = Depends(EncodingOptions.as_form)):
     """Кнопка Сгенерировать"""
-    global DISTORTION_OPTIONS
-
-    # берем опции из формы
-    DISTORTION_OPTIONS = options.options
+    # берем опции из формы и запоминаем их в сессии
+    distortion_options = options.options
+    await db_executor.run(set_session_options, db, session_id, "distortion", distortion_options)
 
     # делаем искажения изображения и записываем в базу данных полученные изображения
-    distortion_process.generate_images(db, DISTORTION_OPTIONS)
+    await processing_executor.run(distortion_process.generate_images, db, session_id, distortion_options,
+                                  encoding.to_encoding(), options.seed)
 
-    return templates.TemplateResponse(request, "distortion.html", {
-        "distortion_options": DISTORTION_OPTIONS,
-        "distortion_images": distortion_process.get_images(db)
+    return render_template(request, "distortion.html", {
+        "distortion_options": distortion_options,
+        "distortion_images": await db_executor.run(distortion_process.get_images, db, session_id)
     })
 
 
 @app.post("/save_distortion")
-async def save_distortion(request: Request, db: Session = Depends(get_db),
-                          save_dir=SAVE_DIR):
-    """Кнопка Сохранить"""
-    global DISTORTION_OPTIONS
+async def save_distortion(session_id: str = Depends(active_session)):
+    """Кнопка Сохранить: скачивание результатов zip-архивом"""
+    return archive_response(distortion_process, session_id)
+
+
+# ===
+# === Фоновые задания генерации ===
+# ===
+# Задания хранятся в памяти процесса, который их принял: при нескольких
+# воркерах uvicorn статус и результаты задания доступны только на том же
+# воркере (один воркер или привязка клиента к воркеру на балансировщике)
+async def submit_job(db, session_id, process, options, encoding, seed=None, variants=1):
+    """Постановка задания в очередь, ответ с id задания сразу после постановки"""
+    try:
+        job = await processing_executor.run(job_manager.submit, db, session_id, process, options,
+                                            encoding.to_encoding(), seed, variants)
+    except JobLimitReached as exc:
+        raise HTTPException(status_code=429, detail=str(exc))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+    return JSONResponse(status_code=202, content={
+        "job_id": job.id,
+        "status_url": f"/jobs/{job.id}"
+    })
+
+
+def find_job(job_id, session_id):
+    """Поиск задания сессии по id, 404 если такого нет"""
+    job = job_manager.get(job_id)
+    if job is None or job.session_id != session_id:
+        raise HTTPException(status_code=404, detail="Задание не найдено")
+    return job
+
+
+@app.post("/jobs/rotate", status_code=202)
+async def submit_rotate_job(db: Session = Depends(get_db), session_id: str = Depends(active_session),
+                            options: RotateOptions = Depends(RotateOptions.as_form),
+                            encoding: EncodingOptions = Depends(EncodingOptions.as_form)):
+    """Фоновое задание поворота"""
+    options = options.model_dump()
+    error = rotate_options_error(options)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
+    return await submit_job(db, session_id, rotate_process, options, encoding)
+
+
+@app.post("/jobs/color_correction", status_code=202)
+async def submit_color_correction_job(db: Session = Depends(get_db), session_id: str = Depends(active_session),
+                                      options: ColorCorrectionOptions = Depends(ColorCorrectionOptions.as_form),
+                                      encoding: EncodingOptions = Depends(EncodingOptions.as_form)):
+    """Фоновое задание цветокоррекции"""
+    return await submit_job(db, session_id, color_correction_process, options.options, encoding,
+                            options.seed, options.variants)
+
+
+@app.post("/jobs/distortion", status_code=202)
+async def submit_distortion_job(db: Session = Depends(get_db), session_id: str = Depends(active_session),
+                                options: DistortionOptions = Depends(DistortionOptions.as_form),
+                                encoding: EncodingOptions = Depends(EncodingOptions.as_form)):
+    """Фоновое задание искажения"""
+    return await submit_job(db, session_id, distortion_process, options.options, encoding, options.seed)
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str, session_id: str = Depends(current_session)):
+    """Статус задания: прогресс, адреса уже готовых изображений"""
+    return find_job(job_id, session_id).status_info()
+
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str, session_id: str = Depends(current_session)):
+    """Отмена задания"""
+    find_job(job_id, session_id)
+    return job_manager.cancel(job_id).status_info()
+
+
+@app.get("/jobs/{job_id}/results/{task_index}/{image_index}")
+async def job_result(job_id: str, task_index: int, image_index: int,
+                     session_id: str = Depends(current_session)):
+    """Готовое изображение задания, доступно до завершения всего задания"""
+    job = find_job(job_id, session_id)
+    image = job.image(task_index, image_index)
+    if image is None:
+        raise HTTPException(status_code=404, detail="Изображение еще не готово")
+    stored, image_data = image
+    if stored:
+        # результаты записанного задания читаются из хранилища блобов
+        image_data = await db_executor.run(get_blob_store().get, image_data)
+        if image_data is None:
+            raise HTTPException(status_code=404, detail="Изображение задания уже удалено")
+    return Response(content=image_data, media_type=job.encoding.mime_type)
+
+
+# ===
+# === Пакетная обработка набора изображений ===
+# ===
+@app.post("/batch")
+async def batch(options: BatchOptions = Depends(BatchOptions.as_form),
+                encoding: EncodingOptions = Depends(EncodingOptions.as_form),
+                files: List[UploadFile] = File(..., description="Изображения или zip-архивы с изображениями")):
+    """Применение выбранных обработок ко всем изображениям набора. Архив с
+       результатами отдается по мере обработки, не дожидаясь всего набора"""
+    processes = []
+    if options.rotate_count:
+        rotate_options = {"angle": options.rotate_angle, "count": options.rotate_count}
+        error = rotate_options_error(rotate_options)
+        if error:
+            raise HTTPException(status_code=400, detail=error)
+        processes.append((rotate_process, rotate_options))
+    if options.color_correction_options:
+        processes.append((color_correction_process, options.color_correction_options))
+    if options.distortion_options:
+        processes.append((distortion_process, options.distortion_options))
+    if not processes:
+        raise HTTPException(status_code=400, detail="Не выбрано ни одной обработки")
+    image_encoding = encoding.to_encoding()
+
+    # файлы формы закрываются после возврата ответа, копируем их во временные файлы
+    spooled = [(file.filename, await db_executor.run(spool_upload, file.file)) for file in files]
+
+    def archive_chunks():
+        try:
+            yield from stream_zip(augment_dataset(iter_dataset_images(spooled), processes,
+                                                        encoding=image_encoding))
+        finally:
+            for _, file_obj in spooled:
+                file_obj.close()
+
+    return StreamingResponse(archive_chunks(), media_type="application/zip", headers={
+        "Content-Disposition": 'attachment; filename="augmented_dataset.zip"'
+    })
+
+
+# ===
+# === Цепочки операций над оригиналом ===
+# ===
+def load_original_array(db, session_id):
+    """Имя и декодированный массив загруженного оригинала сессии, None если его нет"""
+    orig_image = originals.first(db, session_id)
+    if orig_image is None:
+        return None
+    image_array = decode_db_to_cv(orig_image)
+    if image_array is None:
+        return None
+    return orig_image.file_name, image_array
+
+
+@app.post("/pipeline")
+async def run_pipeline(request: PipelineRequest, db: Session = Depends(get_db),
+                       session_id: str = Depends(active_session)):
+    """Применение цепочек операций к оригиналу. Промежуточные результаты не
+       кодируются, общие начала цепочек вычисляются один раз. Результаты
+       отдаются zip-архивом в порядке цепочек"""
+    try:
+        pipeline = Pipeline(request.branches)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    encoding = request.encoding.to_encoding()
+
+    original = await db_executor.run(load_original_array, db, session_id)
+    if original is None:
+        raise HTTPException(status_code=404, detail="Оригинальное изображение не загружено")
+    file_name, image_array = original
 
-    # сохраняем изображения с искажениями на жесткий диск
-    distortion_process.save_images(db, save_dir)
+    changed_images = await processing_executor.run(pipeline.run, image_array, encoding, seed=request.seed)
 
-    return templates.TemplateResponse(request, "distortion.html", {
-        "distortion_options": DISTORTION_OPTIONS,
-        "distortion_images": distortion_process.get_images(db)
+    entries = ((f"{file_name}_pipeline_{i + 1}{encoding.extension}", data) for i, data in enumerate(changed_images))
+    return StreamingResponse(stream_zip(entries), media_type="application/zip", headers={
+        "Content-Disposition": 'attachment; filename="pipeline.zip"'
     })
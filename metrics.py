@@ -0,0 +1,165 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Метрики в текстовом формате Prometheus (GET /metrics) без внешних
+# зависимостей. Значения хранятся в памяти процесса: у каждого воркера
+# uvicorn свои метрики, а работа в пулах процессов (поворот в режиме
+# process, фоновые задания, пакетная обработка) в них не попадает
+
+
+class Metric:
+    """Семейство значений одной метрики с набором меток"""
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Метрика {self.name} ожидает метки {self.labelnames}, получены {sorted(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+    def samples(self):
+        """Строки (имя, метки, значение) для вывода"""
+        with self._lock:
+            return [(self.name, self._format_labels(key), value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Монотонно растущий счетчик"""
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Текущее значение, например число задач в работе"""
+    type = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """Распределение значений по корзинам с суммой и количеством"""
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=None):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets or DEFAULT_BUCKETS))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        samples = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                samples.append((self.name + "_bucket", self._format_labels(key, [("le", le)]), cumulative))
+            samples.append((self.name + "_sum", self._format_labels(key), total))
+            samples.append((self.name + "_count", self._format_labels(key), cumulative))
+        return samples
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# корзины времени в секундах: от быстрых операций над превью до генерации больших наборов
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REGISTRY = []
+
+
+def render_metrics():
+    """Все метрики в текстовом формате Prometheus"""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+# ===
+# === Метрики сервиса ===
+# ===
+STAGE_SECONDS = Histogram("image_stage_seconds", "Время этапа обработки изображений",
+                          ("stage", "operation"))
+STAGE_IN_FLIGHT = Gauge("image_stage_in_flight", "Этапы обработки изображений в работе",
+                        ("stage", "operation"))
+IMAGE_BYTES = Counter("image_bytes_total", "Байты изображений по этапам", ("stage", "operation"))
+HTTP_REQUEST_SECONDS = Histogram("http_request_seconds", "Время обработки HTTP-запроса",
+                                 ("method", "route", "status"))
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP-запросы в работе")
+EXECUTOR_TASKS = Gauge("executor_tasks", "Задачи пулов блокирующей работы", ("executor", "state"))
+RESULT_CACHE_REQUESTS = Counter("result_cache_requests_total", "Обращения к кэшу результатов",
+                                ("result", "tier"))
+
+
+@contextmanager
+def track_stage(stage, operation=""):
+    """Замер этапа: время в гистограмму, этап в работе - в gauge"""
+    STAGE_IN_FLIGHT.inc(stage=stage, operation=operation)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage, operation=operation)
+        STAGE_IN_FLIGHT.dec(stage=stage, operation=operation)
+
+
+def timed(stage, operation=""):
+    """Декоратор замера функции как этапа stage"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with track_stage(stage, operation):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_bytes(stage, data, operation=""):
+    """Учет байтов изображения на этапе stage, возвращает data без изменений"""
+    if data is not None:
+        IMAGE_BYTES.inc(len(data), stage=stage, operation=operation)
+    return data
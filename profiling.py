@@ -0,0 +1,258 @@
+import cProfile
+import contextvars
+import json
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from settings import (PROFILE_AUTO_PERCENT, PROFILE_DIR, PROFILE_FORMAT, PROFILE_MAX_FILES,
+                      PROFILE_SAMPLE_INTERVAL_MS, PROFILE_SLOW_MS, PROFILING_ENABLED, PROFILING_TOKEN)
+
+# Профилирование отдельных запросов. Работа запроса идет в потоке event loop
+# (маршрутизация, шаблоны) и в пулах db_executor/processing_executor (SQLAlchemy,
+# декодирование, OpenCV, кодирование), поэтому профиль собирается со всех
+# потоков, выполняющих задачи запроса: пулы получают профиль через contextvars.
+# Вложенные пулы (параллельный поворот, пулы процессов) в профиль не попадают.
+# Поток event loop общий для всех запросов, поэтому его часть профиля включает
+# и работу других запросов, выполнявшихся в то же время
+
+PROFILE_FORMATS = ("pstats", "speedscope")
+
+_current_profile = contextvars.ContextVar("request_profile", default=None)
+
+# cProfile в потоке event loop может быть включен только одним запросом сразу
+_loop_profile_busy = False
+
+
+def current_profile():
+    """Профиль текущего запроса или None"""
+    return _current_profile.get()
+
+
+def profile_mode(request):
+    """Нужно ли профилировать запрос: "requested" - по заголовку или
+       параметру, "auto" - случайная выборка, None - не профилировать"""
+    if PROFILING_ENABLED:
+        requested = request.headers.get("x-profile") or request.query_params.get("profile")
+        if requested not in (None, "", "0"):
+            if not PROFILING_TOKEN or request.headers.get("x-profile-token") == PROFILING_TOKEN:
+                return "requested"
+    if PROFILE_AUTO_PERCENT > 0 and random.random() * 100 < PROFILE_AUTO_PERCENT:
+        return "auto"
+    return None
+
+
+class RequestProfile:
+    """Профиль одного запроса: cProfile по потокам (pstats) или
+       семплирование стеков потоков запроса (speedscope)"""
+
+    def __init__(self, name, profile_format=None, sample_interval=None):
+        self.name = name
+        self.format = profile_format or PROFILE_FORMAT
+        if self.format not in PROFILE_FORMATS:
+            raise ValueError(f"Неизвестный формат профиля: {self.format}. Доступны: {', '.join(PROFILE_FORMATS)}")
+        self.sample_interval = (PROFILE_SAMPLE_INTERVAL_MS / 1000 if sample_interval is None
+                                else sample_interval)
+        self.file_name = name + (".prof" if self.format == "pstats" else ".speedscope.json")
+        self.started = None
+        self.elapsed = None
+        self._lock = threading.Lock()
+        self._profiles = []  # cProfile.Profile завершенных участков
+        self._threads = {}  # id потока -> число участков запроса в нем
+        self._samples = {}  # id потока -> [(стек, вес)]
+        self._loop_profile = None
+        self._sampler = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Начало профилирования в потоке event loop"""
+        global _loop_profile_busy
+        self.started = time.perf_counter()
+        if self.format == "pstats":
+            if not _loop_profile_busy:
+                self._loop_profile = _enable_profile()
+                _loop_profile_busy = self._loop_profile is not None
+        else:
+            self._enter_thread()
+            self._sampler = threading.Thread(target=self._sample, name="profile-sampler", daemon=True)
+            self._sampler.start()
+
+    def finish(self):
+        """Завершение профилирования, вызывается в том же потоке, что и start"""
+        global _loop_profile_busy
+        self.elapsed = time.perf_counter() - self.started
+        if self._loop_profile is not None:
+            self._loop_profile.disable()
+            self._profiles.append(self._loop_profile)
+            self._loop_profile = None
+            _loop_profile_busy = False
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self._exit_thread()
+
+    @contextmanager
+    def thread(self):
+        """Профилирование участка запроса в текущем потоке пула"""
+        if self.format == "pstats":
+            profile = _enable_profile()
+            try:
+                yield
+            finally:
+                if profile is not None:
+                    profile.disable()
+                    with self._lock:
+                        self._profiles.append(profile)
+        else:
+            self._enter_thread()
+            try:
+                yield
+            finally:
+                self._exit_thread()
+
+    def _enter_thread(self):
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads[ident] = self._threads.get(ident, 0) + 1
+
+    def _exit_thread(self):
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads[ident] -= 1
+            if not self._threads[ident]:
+                del self._threads[ident]
+
+    def _sample(self):
+        """Поток семплирования: стеки потоков, занятых запросом, с весом
+           по фактическому времени между замерами"""
+        previous = time.perf_counter()
+        while not self._stop.wait(self.sample_interval):
+            now = time.perf_counter()
+            weight, previous = now - previous, now
+            frames = sys._current_frames()
+            with self._lock:
+                idents = list(self._threads)
+            for ident in idents:
+                frame = frames.get(ident)
+                if frame is not None:
+                    self._samples.setdefault(ident, []).append((_stack(frame), weight))
+
+    def save(self, directory=None):
+        """Запись профиля в файл, возвращает путь или None, если данных нет"""
+        directory = directory or PROFILE_DIR
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.file_name)
+        if self.format == "pstats":
+            profiles = [profile for profile in self._profiles if profile.getstats()]
+            if not profiles:
+                return None
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(path)
+        else:
+            if not self._samples:
+                return None
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(self._speedscope(), file)
+        prune_profiles(directory)
+        return path
+
+    def _speedscope(self):
+        """Профиль в формате speedscope: по одному профилю на поток"""
+        frames, frame_index = [], {}
+        profiles = []
+        main_ident = threading.main_thread().ident
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, samples in self._samples.items():
+            stacks, weights = [], []
+            for stack, weight in samples:
+                indexes = []
+                for key in stack:
+                    if key not in frame_index:
+                        frame_index[key] = len(frames)
+                        frames.append({"name": key[0], "file": key[1], "line": key[2]})
+                    indexes.append(frame_index[key])
+                stacks.append(indexes)
+                weights.append(weight)
+            name = "event loop" if ident == main_ident else thread_names.get(ident, str(ident))
+            profiles.append({"type": "sampled", "name": name, "unit": "seconds", "startValue": 0,
+                             "endValue": sum(weights), "samples": stacks, "weights": weights})
+        return {"$schema": "https://www.speedscope.app/file-format-schema.json", "name": self.name,
+                "exporter": "image_augmentation_service", "shared": {"frames": frames}, "profiles": profiles}
+
+
+def _enable_profile():
+    """Включение cProfile в текущем потоке, None если профилировщик уже занят"""
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        return None
+    return profile
+
+
+def _stack(frame):
+    """Стек от корня к текущей функции как ключи (функция, файл, строка)"""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def profile_name(method, path):
+    """Имя файла профиля: время, метод и путь запроса"""
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", path).strip("_") or "root"
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}-{method}-{slug}"
+
+
+def prune_profiles(directory):
+    """Удаление самых старых профилей сверх PROFILE_MAX_FILES"""
+    if PROFILE_MAX_FILES <= 0:
+        return
+    paths = [os.path.join(directory, name) for name in os.listdir(directory)
+             if name.endswith((".prof", ".speedscope.json"))]
+    if len(paths) <= PROFILE_MAX_FILES:
+        return
+    paths.sort(key=os.path.getmtime)
+    for path in paths[:len(paths) - PROFILE_MAX_FILES]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def start_profile(name):
+    """Создание и запуск профиля запроса, он становится текущим в контексте"""
+    profile = RequestProfile(name)
+    profile.start()
+    _current_profile.set(profile)
+    return profile
+
+
+def finish_profile(profile, mode):
+    """Остановка профиля в потоке event loop, он перестает быть текущим.
+       Возвращает, нужно ли сохранять профиль: автоматический профиль
+       сохраняется только для медленного запроса"""
+    profile.finish()
+    _current_profile.set(None)
+    return mode != "auto" or profile.elapsed * 1000 >= PROFILE_SLOW_MS
+
+
+def save_profile(profile):
+    """Запись профиля в файл, возвращает путь или None. Работает с диском,
+       поэтому вызывается из пула, а не в потоке event loop"""
+    try:
+        return profile.save()
+    except OSError as exc:
+        print(f"Ошибка записи профиля {profile.file_name}: {exc}")
+        return None
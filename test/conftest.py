@@ -0,0 +1,9 @@
+import os
+
+# Настройки окружения для тестов. conftest.py загружается до модулей тестов,
+# поэтому настройки действуют до первого импорта settings и database
+
+# байты изображений в тестах храним в памяти, а не в папке database/blobs
+os.environ.setdefault("BLOB_STORE", "memory")
+# кэш результатов в тестах держим только в памяти, а не в папке result_cache
+os.environ.setdefault("RESULT_CACHE_DISK_MB", "0")
@@ -0,0 +1,55 @@
+import sys
+import os
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from database.blob_store import FileSystemBlobStore, MemoryBlobStore, hash_blob
+
+
+@pytest.fixture(params=["filesystem", "memory"])
+def store(request, tmp_path):
+    if request.param == "filesystem":
+        return FileSystemBlobStore(str(tmp_path / "blobs"))
+    return MemoryBlobStore()
+
+
+# === Тест записи и чтения блоба по хэшу ===
+def test_put_get(store):
+    content_hash = store.put(b"image bytes")
+
+    assert content_hash == hash_blob(b"image bytes")
+    assert store.get(content_hash) == b"image bytes"
+    assert store.get(hash_blob(b"missing")) is None
+
+
+# === Тест хранения одинаковых данных в одном экземпляре ===
+def test_identical_data_stored_once(store):
+    first = store.put(b"same output")
+    second = store.put(b"same output")
+
+    assert first == second
+    assert list(store.stored_hashes()) == [first]
+
+
+# === Тест сборки мусора ===
+def test_collect_garbage(store):
+    kept = store.put(b"referenced")
+    dropped = store.put(b"orphan")
+
+    # недавно записанные блобы защищены интервалом ожидания
+    assert store.collect_garbage({kept}) == 0
+
+    assert store.collect_garbage({kept}, grace_seconds=0) == 1
+    assert store.get(kept) == b"referenced"
+    assert store.get(dropped) is None
+
+
+# === Тест продления блоба без повторной записи ===
+def test_touch(store):
+    content_hash = store.put(b"uploaded twice")
+
+    assert store.touch(content_hash)
+    assert not store.touch(hash_blob(b"missing"))
+    # продленный блоб снова защищен интервалом ожидания
+    assert store.collect_garbage(set()) == 0
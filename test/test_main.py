@@ -1,11 +1,13 @@
 import sys
 import os
 import pytest
+import re
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../database')))
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../image_processing')))
 
+
 from fastapi.testclient import TestClient
 from main import app, BASE_DIR
 from database.database import Database
@@ -43,6 +45,47 @@ def test_upload_image():
         assert response.status_code == 200
 
 
+# === Тест кэша декодированного оригинала ===
+def test_decoded_cache_filled_on_upload():
+    from image_processing.image_cache import decoded_cache
+    from image_processing.image_processing_methods import decode_db_to_cv
+    from database.database_models import ImageDB
+
+    db = Database().SessionLocal()
+    try:
+        orig_image = db.query(ImageDB).filter(ImageDB.session_id == client.cookies.get("session_id")).first()
+        cached = decoded_cache.get(orig_image.id, orig_image.content_hash)
+
+        assert cached is not None
+        assert not cached.flags.writeable
+        # повторное декодирование возвращает тот же массив из кэша
+        assert decode_db_to_cv(orig_image) is cached
+    finally:
+        db.close()
+
+
+# === Тест отдачи изображения по адресу и условного GET ===
+def test_get_image_data():
+    page = client.get("/")
+    url = re.search(r'src="(/images/original/[^"]+)"', page.text).group(1)
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/png"
+    assert "max-age" in response.headers["cache-control"]
+
+    etag = response.headers["etag"]
+    not_modified = client.get(url, headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+
+
+# === Тест запроса несуществующего изображения ===
+def test_get_image_data_not_found():
+    assert client.get("/images/unknown/1").status_code == 404
+    assert client.get("/images/rotate/100000").status_code == 404
+
+
 # === Тест загрузки НЕ изображения ===
 def test_upload_invalid_file():
     files = {"file": ("test.txt", b"Just a text file", "text/plain")}
@@ -67,6 +110,22 @@ def test_do_rotate():
     assert response.status_code == 200
 
 
+# === Тест превью повернутых изображений в галерее ===
+def test_rotate_previews():
+    import cv2
+    import numpy as np
+    from settings import PREVIEW_MAX_EDGE
+
+    page = client.get("/rotate")
+    preview_urls = re.findall(r'src="(/images/rotate/\d+/preview[^"]*)"', page.text)
+    assert len(preview_urls) == 5
+
+    response = client.get(preview_urls[0])
+    assert response.status_code == 200
+    preview = cv2.imdecode(np.frombuffer(response.content, np.uint8), cv2.IMREAD_COLOR)
+    assert max(preview.shape[:2]) <= PREVIEW_MAX_EDGE
+
+
 # === Тест валидации count (слишком большое значение) ===
 def test_do_rotate_invalid_count():
     options = {"angle": 10, "count": 150}  # count > 100
@@ -79,9 +138,23 @@ def test_do_rotate_invalid_count():
 
 # === Тест сохранения повернутых изображений ===
 def test_save_rotate():
+    import io
+    import zipfile
+
     response = client.post("/save_rotate")
 
     assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+    assert 'filename="rotate.zip"' in response.headers["content-disposition"]
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert archive.namelist() == [f"bus_rotate_{angle}_degrees.jpg" for angle in (10, 20, 30, 40, 50)]
+    assert all(info.compress_type == zipfile.ZIP_STORED for info in archive.infolist())
+
+    # чтение порциями меньше числа строк дает те же файлы
+    from main import rotate_process
+    session_id = client.cookies.get("session_id")
+    entries = list(rotate_process.archive_entries(Database().SessionLocal, session_id, batch_size=2))
+    assert [name for name, _ in entries] == archive.namelist()
 
 
 # === Тест страницы цветокоррекции ===
@@ -102,9 +175,13 @@ def test_do_color_correction():
 
 # === Тест сохранения изображений с цветокоррекцией ===
 def test_save_color_correction():
+    import io
+    import zipfile
+
     response = client.post("/save_color_correction")
 
     assert response.status_code == 200
+    assert len(zipfile.ZipFile(io.BytesIO(response.content)).namelist()) == 6
 
 
 # === Тест страницы искажения изображения ===
@@ -159,3 +236,683 @@ def test_save_distortion_noise():
     response = client.post("/save_distortion")
 
     assert response.status_code == 200
+
+
+# === Тест состояния пулов блокирующей работы ===
+def test_executors_stats():
+    response = client.get("/stats/executors")
+
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["processing"]["completed"] > 0
+    assert stats["db"]["queued"] == 0
+
+
+# === Тест отклонения задач при заполненной очереди ===
+def test_executor_overloaded():
+    import asyncio
+    from executors import BoundedExecutor, ExecutorOverloaded
+
+    executor = BoundedExecutor("test", max_workers=1, max_queue=0)
+    with pytest.raises(ExecutorOverloaded):
+        asyncio.run(executor.run(lambda: None))
+    assert executor.stats()["rejected"] == 1
+    executor.shutdown()
+
+
+# === Тест отмены задачи, ожидающей в очереди пула ===
+def test_executor_cancelled_while_queued():
+    import asyncio
+    import threading
+    from executors import BoundedExecutor
+
+    executor = BoundedExecutor("test", max_workers=1, max_queue=1)
+    release = threading.Event()
+
+    async def scenario():
+        busy = asyncio.ensure_future(executor.run(release.wait))
+        await asyncio.sleep(0.05)
+        queued = asyncio.ensure_future(executor.run(lambda: None))
+        await asyncio.sleep(0.05)
+        assert executor.stats()["queued"] == 1
+        # клиент отключился, пока задача ждала в очереди
+        queued.cancel()
+        await asyncio.sleep(0.05)
+        release.set()
+        await busy
+
+    asyncio.run(scenario())
+    stats = executor.stats()
+    assert stats["queued"] == 0 and stats["running"] == 0 and stats["completed"] == 1
+    executor.shutdown()
+
+
+# === Тест фонового задания поворота ===
+def test_rotate_job():
+    import time
+
+    response = client.post("/jobs/rotate", data={"angle": 15, "count": 4})
+    assert response.status_code == 202
+    status_url = response.json()["status_url"]
+
+    # опрашиваем статус, пока задание не завершится
+    deadline = time.time() + 60
+    status = client.get(status_url).json()
+    while status["status"] in ("queued", "running") and time.time() < deadline:
+        time.sleep(0.2)
+        status = client.get(status_url).json()
+
+    assert status["status"] == "done"
+    assert status["done"] == status["total"] == 4
+    assert client.get(status["results"][0]).status_code == 200
+
+    page = client.get("/rotate")
+    assert len(re.findall(r'src="(/images/rotate/\d+/preview[^"]*)"', page.text)) == 4
+
+
+# === Тест фонового задания цветокоррекции с зерном и вариантами ===
+def test_color_correction_job_seed():
+    import io
+    import time
+    import zipfile
+    from main import job_manager
+
+    data = {"options": ["grayscale", "brightness"], "variants": 2, "seed": "11"}
+    assert client.post("/do_color_correction", data=data).status_code == 200
+    archive = zipfile.ZipFile(io.BytesIO(client.post("/save_color_correction").content))
+    expected = [archive.read(name) for name in archive.namelist()]
+
+    response = client.post("/jobs/color_correction", data=data)
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+    deadline = time.time() + 60
+    status = client.get(f"/jobs/{job_id}").json()
+    while status["status"] in ("queued", "running") and time.time() < deadline:
+        time.sleep(0.2)
+        status = client.get(f"/jobs/{job_id}").json()
+
+    # задание дает те же изображения, что и генерация с тем же зерном
+    assert status["status"] == "done"
+    assert [client.get(url).content for url in status["results"]] == expected
+    # после записи в БД задание не держит байты изображений в памяти
+    job = job_manager.get(job_id)
+    stored, results = job.results
+    assert stored
+    assert all(isinstance(content_hash, str) for images in results for content_hash in images)
+    assert client.get(f"/jobs/{job_id}/results/0/100").status_code == 404
+
+
+# === Тест подключения к разделяемой памяти на время задачи ===
+def test_run_attached():
+    import numpy as np
+    from image_processing.parallel import run_attached, share_array
+
+    image_array = np.arange(24, dtype=np.uint8).reshape(2, 4, 3)
+    with share_array(image_array) as handle:
+        assert run_attached(handle, lambda shared, k: int(shared.sum()) * k, 2) == int(image_array.sum()) * 2
+        assert run_attached(handle, lambda shared: shared.tobytes()) == image_array.tobytes()
+
+
+# === Тест валидации параметров фонового задания ===
+def test_rotate_job_invalid_options():
+    response = client.post("/jobs/rotate", data={"angle": 0, "count": 4})
+
+    assert response.status_code == 400
+    assert client.get("/jobs/unknown").status_code == 404
+
+
+# === Тест пакетной обработки архива и отдельного файла ===
+def test_batch():
+    import io
+    import zipfile
+
+    with open(os.path.join(BASE_DIR, "test/bus.jpg"), "rb") as image_file:
+        image_content = image_file.read()
+
+    dataset = io.BytesIO()
+    with zipfile.ZipFile(dataset, "w") as archive:
+        archive.writestr("buses/bus1.jpg", image_content)
+        archive.writestr("buses/readme.txt", "не изображение")
+
+    files = [("files", ("dataset.zip", dataset.getvalue(), "application/zip")),
+             ("files", ("bus2.jpg", image_content, "image/jpeg"))]
+    data = {"rotate_angle": 30, "rotate_count": 2, "color_correction_options": ["grayscale"]}
+    response = client.post("/batch", data=data, files=files)
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+    names = zipfile.ZipFile(io.BytesIO(response.content)).namelist()
+    assert names == ["buses/bus1_rotate_30_degrees.jpg", "buses/bus1_rotate_60_degrees.jpg",
+                     "buses/bus1_color_correction_grayscale.jpg",
+                     "bus2_rotate_30_degrees.jpg", "bus2_rotate_60_degrees.jpg",
+                     "bus2_color_correction_grayscale.jpg"]
+
+
+# === Тест пакетной обработки без выбранных обработок ===
+def test_batch_without_options():
+    files = [("files", ("bus.jpg", b"data", "image/jpeg"))]
+
+    response = client.post("/batch", files=files)
+
+    assert response.status_code == 400
+
+
+# === Тест цепочек операций с общим началом ===
+def test_pipeline():
+    import io
+    import zipfile
+    from image_processing.pipeline import Pipeline
+
+    branches = [["grayscale", {"op": "brightness", "beta": 10}],
+                ["grayscale", {"op": "brightness", "beta": -10}],
+                ["grayscale"],
+                [{"op": "rotate", "angle": 90}, {"op": "gaussian_blur", "ksize": 3}]]
+    # общий шаг grayscale выполняется один раз
+    assert Pipeline(branches).count_operations() == 5
+
+    response = client.post("/pipeline", json={"branches": branches})
+
+    assert response.status_code == 200
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert archive.namelist() == [f"bus_pipeline_{i}.jpg" for i in range(1, 5)]
+
+
+# === Тест цепочки с неизвестной операцией ===
+def test_pipeline_invalid_operation():
+    response = client.post("/pipeline", json={"branches": [["grayscale", "unknown"]]})
+    assert response.status_code == 400
+
+    response = client.post("/pipeline", json={"branches": [[{"op": "rotate", "degrees": 5}]]})
+    assert response.status_code == 400
+
+    # неверные типы и диапазоны параметров - ошибка запроса, а не исключение обработки
+    for step in ({"op": "median_blur", "ksize": 4}, {"op": "rotate", "angle": "x"}, {"op": "rotate", "angle": {"a": 1}},
+                 {"op": "gaussian_blur", "ksize": [3, 3]}, {"op": "elastic", "sigma": 0}, {"op": ["rotate"]},
+                 {"op": "perspective", "rng": 1}):
+        response = client.post("/pipeline", json={"branches": [[step]]})
+        assert response.status_code == 400, step
+    assert "ksize" in client.post("/pipeline", json={"branches": [[{"op": "median_blur", "ksize": 4}]]}).text
+    response = client.post("/pipeline", content='{"branches": [[{"op": "salt_and_pepper", "amount": NaN}]]}',
+                           headers={"Content-Type": "application/json"})
+    assert response.status_code in (400, 422)
+
+    # слишком длинная цепочка и слишком много цепочек - ошибка запроса
+    from settings import PIPELINE_MAX_BRANCHES, PIPELINE_MAX_STEPS
+    assert client.post("/pipeline", json={"branches": [["flip"] * 1500]}).status_code == 400
+    assert client.post("/pipeline", json={"branches": [["flip"]] * (PIPELINE_MAX_BRANCHES + 1)}).status_code == 400
+    response = client.post("/pipeline", json={"branches": [["flip"] * PIPELINE_MAX_STEPS]})
+    assert response.status_code == 200
+
+
+# === Тест выбора формата результатов ===
+def test_output_format():
+    import io
+    import zipfile
+
+    response = client.post("/do_rotate", data={"angle": 45, "count": 2, "output_format": "png", "quality": ""})
+    assert response.status_code == 200
+
+    url = re.search(r'href="(/images/rotate/[^"]+)"', response.text).group(1)
+    assert client.get(url).headers["content-type"] == "image/png"
+
+    names = zipfile.ZipFile(io.BytesIO(client.post("/save_rotate").content)).namelist()
+    assert names == ["bus_rotate_45_degrees.png", "bus_rotate_90_degrees.png"]
+
+    response = client.post("/pipeline", json={"branches": [["flip"]],
+                                              "encoding": {"output_format": "webp", "lossless": True}})
+    assert zipfile.ZipFile(io.BytesIO(response.content)).namelist() == ["bus_pipeline_1.webp"]
+
+
+# === Тест недопустимых настроек кодирования ===
+def test_output_format_invalid():
+    data = {"angle": 45, "count": 2}
+
+    assert client.post("/do_rotate", data={**data, "output_format": "gif"}).status_code == 400
+    assert client.post("/do_rotate", data={**data, "output_format": "jpeg", "lossless": "true"}).status_code == 400
+    assert client.post("/do_rotate", data={**data, "quality": "high"}).status_code == 400
+
+
+# === Тест ядер шума ===
+def test_noise_kernels():
+    import numpy as np
+    from image_processing.image_processing_methods import distortion_array_images, gaussian_noise_array
+
+    # отрицательный шум насыщается в 0, а не переполняется до 255
+    black = np.zeros((64, 64, 3), dtype=np.uint8)
+    noisy = gaussian_noise_array(black, mean=0, sigma=10, rng=np.random.default_rng(0))
+    assert noisy.max() < 100
+    assert (noisy == 0).mean() > 0.4
+
+    # оригинал не меняется, с одним зерном результаты повторяются
+    gray = np.full((64, 64, 3), 128, dtype=np.uint8)
+    gray.flags.writeable = False
+    first = distortion_array_images(gray, "noise", seed=7)
+    assert (gray == 128).all()
+    assert first == distortion_array_images(gray, "noise", seed=7)
+    assert first != distortion_array_images(gray, "noise", seed=8)
+
+
+# === Тест повторяемости искажений с зерном ===
+def test_distortion_seed():
+    pages = [client.post("/do_distortion", data={"options": "noise", "seed": "42"}) for _ in range(2)]
+    assert all(page.status_code == 200 for page in pages)
+
+    urls = [re.findall(r'href="(/images/distortion/[^"]+)"', page.text) for page in pages]
+    # одинаковое содержимое дает одинаковый хэш в адресе
+    assert [url.split("?v=")[1] for url in urls[0]] == [url.split("?v=")[1] for url in urls[1]]
+
+
+# === Тест нескольких вариантов цветокоррекции ===
+def test_color_correction_variants():
+    import io
+    import zipfile
+
+    data = {"options": ["grayscale", "brightness"], "variants": 3, "seed": "5"}
+    response = client.post("/do_color_correction", data=data)
+    assert response.status_code == 200
+
+    archive = zipfile.ZipFile(io.BytesIO(client.post("/save_color_correction").content))
+    assert archive.namelist() == [f"bus_color_correction_{opt}_{i}.jpg"
+                                  for opt in ("grayscale", "brightness") for i in (1, 2, 3)]
+    contents = [archive.read(name) for name in archive.namelist()]
+    # оттенки серого не случайны, яркость у вариантов разная
+    assert len(set(contents[:3])) == 1
+    assert len(set(contents[3:])) == 3
+
+    assert client.post("/do_color_correction", data={**data, "variants": 100}).status_code == 400
+    # неизвестная опция - ошибка запроса, а не пропущенное изображение и сдвинутые имена
+    response = client.post("/do_color_correction", data={"options": ["bogus", "hue"], "variants": 3})
+    assert response.status_code == 400
+    assert "bogus" in response.text
+    assert client.post("/jobs/color_correction", data={"options": ["bogus"]}).status_code == 400
+    assert client.post("/batch", data={"color_correction_options": ["bogus"]},
+                       files=[("files", ("bus.jpg", b"data", "image/jpeg"))]).status_code == 400
+
+    # число вариантов передается явно, а не вычисляется по количеству изображений
+    from main import color_correction_process
+    from types import SimpleNamespace
+    names = color_correction_process.file_names(SimpleNamespace(file_name="bus"), ["bogus", "hue"], [b""] * 3, 3)
+    assert names == ["bus_color_correction_hue_1", "bus_color_correction_hue_2", "bus_color_correction_hue_3"]
+
+
+# === Тест изоляции пользователей по сессиям ===
+def test_sessions_isolated():
+    other = TestClient(app)
+
+    # у второго пользователя нет оригинала и результатов первого
+    original = re.search(r'src="(/images/original/[^"]+)"', client.get("/").text).group(1)
+    page = client.get("/rotate")
+    url = re.search(r'href="(/images/rotate/[^"]+)"', page.text).group(1)
+    assert other.get("/").status_code == 200
+    assert 'src="/images/original/' not in other.get("/").text
+    assert 'href="/images/rotate/' not in other.get("/rotate").text
+    assert other.get(url).status_code == 404
+    assert client.get(url).status_code == 200
+    assert other.cookies.get("session_id") != client.cookies.get("session_id")
+
+    # загрузка вторым пользователем не заменяет оригинал первого
+    with open(os.path.join(BASE_DIR, "test/bus.jpg"), "rb") as image:
+        other.post("/", files={"file": ("other.jpg", image, "image/jpeg")})
+    other.post("/do_rotate", data={"angle": 90, "count": 1})
+    assert original in client.get("/").text
+    other_original = re.search(r'src="(/images/original/[^"]+)"', other.get("/").text).group(1)
+    assert other_original != original
+    assert client.get(other_original).status_code == 404
+    assert len(re.findall(r'href="/images/rotate/', other.get("/rotate").text)) == 1
+    assert client.get(url).status_code == 200
+
+
+# === Тест удаления сессий с истекшим сроком ===
+def test_expire_sessions():
+    from database.database_models import WorkspaceSession
+    from database.repository import originals
+    from database.sessions import expire_sessions
+
+    other = TestClient(app)
+    with open(os.path.join(BASE_DIR, "test/bus.jpg"), "rb") as image:
+        other.post("/", files={"file": ("expired.jpg", image, "image/jpeg")})
+    session_id = other.cookies.get("session_id")
+
+    db = Database().SessionLocal()
+    try:
+        # сессия без обращений дольше срока жизни удаляется вместе с изображениями
+        db.query(WorkspaceSession).filter(WorkspaceSession.id == session_id).update({"last_seen": 0})
+        db.commit()
+        expired = expire_sessions(db, ttl=3600)
+
+        assert len(expired) == 1
+        assert db.get(WorkspaceSession, session_id) is None
+        assert not originals.exists(db, session_id)
+        assert originals.exists(db, client.cookies.get("session_id"))
+        # сессия текущего пользователя не затронута
+        assert db.get(WorkspaceSession, client.cookies.get("session_id")) is not None
+    finally:
+        db.close()
+
+
+# === Тест постраничного списка изображений без чтения байтов ===
+def test_list_images_pages(monkeypatch):
+    from database.blob_store import get_blob_store
+
+    client.post("/do_rotate", data={"angle": 10, "count": 5})
+
+    # список строится по метаданным, хранилище блобов не читается
+    reads = []
+    store = get_blob_store()
+    original_get = store.get
+    monkeypatch.setattr(store, "get", lambda content_hash: reads.append(content_hash) or original_get(content_hash))
+
+    first = client.get("/images/rotate", params={"limit": 2}).json()
+    second = client.get("/images/rotate", params={"limit": 2, "after": first["next_after"]}).json()
+    last = client.get("/images/rotate", params={"limit": 2, "after": second["next_after"]}).json()
+    assert reads == []
+
+    names = [image["file_name"] for page in (first, second, last) for image in page["images"]]
+    assert names == [f"bus_rotate_{angle}_degrees" for angle in (10, 20, 30, 40, 50)]
+    assert last["next_after"] is None
+
+    # чужие и неизвестные виды изображений не отдаются
+    assert TestClient(app).get("/images/rotate").json()["images"] == []
+    assert client.get("/images/unknown").status_code == 404
+    assert client.get("/images/rotate", params={"limit": 0}).status_code == 400
+
+
+# === Тест потоковой записи поворотов порциями INSERT ===
+def test_store_images_streaming(monkeypatch):
+    import numpy as np
+    from main import rotate_process
+    from database.repository import originals
+    from image_processing.image_processing_methods import iter_rotate_array_images, rotate_array_images
+
+    # генератор дает те же изображения в том же порядке, что и список
+    image_array = np.random.default_rng(0).integers(0, 255, (64, 48, 3), dtype=np.uint8)
+    for pool in ("serial", "thread"):
+        assert list(iter_rotate_array_images(image_array, 30, 5, workers=2, pool=pool)) == \
+               rotate_array_images(image_array, 30, 5, workers=2, pool=pool)
+
+    db = Database().SessionLocal()
+    try:
+        session_id = client.cookies.get("session_id")
+        orig_image = originals.first(db, session_id)
+        options = {"angle": 45, "count": 5}
+        images = iter_rotate_array_images(image_array, 45, 5, pool="serial")
+
+        # блокировка записи берется только после кодирования и превью всех изображений
+        consumed = []
+        def encoded():
+            for image in images:
+                consumed.append(image)
+                yield image
+        delete = rotate_process.repository.delete
+        def checked_delete(db, session_id):
+            assert len(consumed) == 5
+            return delete(db, session_id)
+        monkeypatch.setattr(rotate_process.repository, "delete", checked_delete)
+        rotate_process.store_images(db, orig_image, options, encoded(), batch_size=2)
+
+        # прежние результаты заменены, все порции записаны одной транзакцией
+        rows = rotate_process.repository.page(db, session_id)
+        assert [row.file_name for row in rows] == [f"bus_rotate_{angle}_degrees" for angle in (45, 90, 135, 180, 225)]
+        assert all(row.preview_hash for row in rows)
+        assert rows[0].image_data == rotate_array_images(image_array, 45, 1, pool="serial")[0]
+    finally:
+        db.close()
+
+
+# === Тест фоновой очистки по сроку хранения и ограничению строк ===
+def test_eviction():
+    from sqlalchemy import text
+    from database.eviction import EvictionTask, evict
+    from database.repository import IMAGE_REPOSITORIES, originals
+    from database.sessions import get_session_options
+
+    other = TestClient(app)
+    with open(os.path.join(BASE_DIR, "test/bus.jpg"), "rb") as image:
+        other.post("/", files={"file": ("old.jpg", image, "image/jpeg")})
+    other.post("/do_rotate", data={"angle": 30, "count": 2})
+    other.post("/do_distortion", data={"options": "blur"})
+    other_id, client_id = other.cookies.get("session_id"), client.cookies.get("session_id")
+    rotate, distortion = IMAGE_REPOSITORIES["rotate"], IMAGE_REPOSITORIES["distortion"]
+
+    database = Database()
+    db = database.SessionLocal()
+    try:
+        # повороты другой сессии старше срока хранения таблицы
+        db.query(rotate.model).filter(rotate.model.session_id == other_id).update({"created_at": 0})
+        db.commit()
+        evict(db, ttl_seconds={"rotate": 3600}, max_rows={})
+        assert rotate.count(db, other_id) == 0
+        assert rotate.exists(db, client_id)
+
+        # сверх ограничения таблицы удаляются самые старые строки
+        evict(db, ttl_seconds={}, max_rows={"distortion": 3})
+        assert distortion.count(db, other_id) == 3
+        assert not distortion.exists(db, client_id)
+
+        # оригинал старше срока удаляется вместе с результатами сессии, опции остаются
+        db.query(originals.model).filter(originals.model.session_id == other_id).update({"created_at": 0})
+        db.commit()
+        removed = evict(db, ttl_seconds={"original": 3600}, max_rows={})
+        assert len(removed) == 1
+        assert not originals.exists(db, other_id) and not distortion.exists(db, other_id)
+        assert originals.exists(db, client_id)
+        assert get_session_options(db, other_id, "distortion") == "blur"
+    finally:
+        db.close()
+
+    # проход фоновой задачи с настройками по умолчанию и возврат страниц файла
+    forgotten = []
+    assert EvictionTask(database, on_evicted=forgotten.extend).run_once() == forgotten
+    with database.engine.connect() as conn:
+        assert conn.execute(text("PRAGMA auto_vacuum")).scalar() == 2
+        assert conn.execute(text("PRAGMA freelist_count")).scalar() == 0
+
+
+# === Тест метрик в формате Prometheus ===
+def test_metrics():
+    from metrics import Histogram, REGISTRY
+
+    client.post("/do_rotate", data={"angle": 90, "count": 2})
+    client.get(re.search(r'href="(/images/rotate/[^"]+)"', client.get("/rotate").text).group(1))
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    for line in ('# TYPE image_stage_seconds histogram',
+                 'image_stage_seconds_count{stage="transform",operation="rotate"}',
+                 'image_stage_seconds_count{stage="generate",operation="rotate"}',
+                 'image_stage_seconds_count{stage="db_write",operation="rotate"}',
+                 'image_stage_seconds_count{stage="render",operation="rotate.html"}',
+                 'image_bytes_total{stage="encode",operation="jpeg"}',
+                 'image_bytes_total{stage="serve",operation=""}',
+                 'image_stage_in_flight{stage="transform",operation="rotate"} 0',
+                 'http_request_seconds_count{method="GET",route="/images/{kind}/{image_id}",status="200"}',
+                 'executor_tasks{executor="processing",state="queued"} 0'):
+        assert line in text
+
+    # корзины гистограммы накопительные, +Inf равна количеству
+    histogram = Histogram("test_seconds", "Тестовая гистограмма", ("stage",), buckets=(0.1, 1))
+    REGISTRY.remove(histogram)
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, stage="a")
+    assert histogram.render().splitlines()[2:] == [
+        'test_seconds_bucket{stage="a",le="0.1"} 1',
+        'test_seconds_bucket{stage="a",le="1"} 2',
+        'test_seconds_bucket{stage="a",le="+Inf"} 3',
+        'test_seconds_sum{stage="a"} 5.55',
+        'test_seconds_count{stage="a"} 3',
+    ]
+
+
+# === Тест профилирования запросов ===
+def test_profiling(monkeypatch, tmp_path):
+    import json
+    import pstats
+    import profiling
+
+    # без настройки администратора запрос не профилируется
+    response = client.post("/do_distortion?profile=1", data={"options": "blur"})
+    assert "X-Profile-File" not in response.headers
+
+    monkeypatch.setattr(profiling, "PROFILING_ENABLED", True)
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    response = client.post("/do_distortion", data={"options": "blur"}, headers={"X-Profile": "1"})
+    assert response.status_code == 200
+    stats = pstats.Stats(str(tmp_path / response.headers["X-Profile-File"]))
+    # в профиль попадает и работа в пулах, и рендеринг шаблона в потоке event loop
+    functions = {name for _, _, name in stats.stats}
+    assert {"distortion_images", "store_images", "render_template"} <= functions
+
+    monkeypatch.setattr(profiling, "PROFILE_FORMAT", "speedscope")
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE_INTERVAL_MS", 1)
+    response = client.post("/save_distortion?profile=1")
+    assert response.status_code == 200
+    with open(tmp_path / response.headers["X-Profile-File"], encoding="utf-8") as file:
+        profile = json.load(file)
+    assert profile["profiles"] and profile["shared"]["frames"]
+    assert all(len(item["samples"]) == len(item["weights"]) for item in profile["profiles"])
+
+    # профиль останавливается и записывается, даже если ответ не удалось отдать
+    import asyncio
+    from main import ProfilingMiddleware
+    monkeypatch.setattr(profiling, "PROFILE_FORMAT", "pstats")
+
+    async def endpoint(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+
+    async def disconnected(message):
+        raise OSError("клиент отключился")
+
+    files = set(os.listdir(tmp_path))
+    scope = {"type": "http", "method": "GET", "path": "/", "query_string": b"profile=1", "headers": []}
+    with pytest.raises(OSError):
+        asyncio.run(ProfilingMiddleware(endpoint)(scope, None, disconnected))
+    assert not profiling._loop_profile_busy
+    assert len(os.listdir(tmp_path)) == len(files) + 1
+
+    # с токеном администратора запрос без токена не профилируется
+    monkeypatch.setattr(profiling, "PROFILING_TOKEN", "secret")
+    assert "X-Profile-File" not in client.get("/?profile=1").headers
+    assert "X-Profile-File" in client.get("/?profile=1", headers={"X-Profile-Token": "secret"}).headers
+
+    # автоматически сохраняются только профили медленных запросов
+    monkeypatch.setattr(profiling, "PROFILE_AUTO_PERCENT", 100)
+    monkeypatch.setattr(profiling, "PROFILE_SLOW_MS", 60 * 1000)
+    files = set(os.listdir(tmp_path))
+    client.get("/rotate")
+    assert set(os.listdir(tmp_path)) == files
+    monkeypatch.setattr(profiling, "PROFILE_SLOW_MS", 0)
+    client.get("/rotate")
+    assert len(os.listdir(tmp_path)) == len(files) + 1
+
+
+# === Тест кэша результатов детерминированных операций ===
+def test_result_cache(monkeypatch, tmp_path):
+    import numpy as np
+    import image_processing.image_processing_methods as methods
+    from image_processing.image_codecs import ImageEncoding
+    from image_processing.result_cache import ResultCache
+
+    cache = ResultCache(10 * 2 ** 20, 10 * 2 ** 20, str(tmp_path))
+    monkeypatch.setattr(methods, "result_cache", cache)
+    image_array = np.random.default_rng(0).integers(0, 256, (64, 96, 3), dtype=np.uint8)
+
+    # повороты на встречавшиеся углы не вычисляются повторно
+    calls = []
+    rotate_and_encode = methods._rotate_and_encode
+    monkeypatch.setattr(methods, "_rotate_and_encode",
+                        lambda arr, angle, encoding=None: calls.append(angle) or rotate_and_encode(arr, angle, encoding))
+    first = methods.rotate_array_images(image_array, 30, 3, pool="serial", content_hash="h")
+    assert methods.rotate_array_images(image_array, 15, 4, pool="serial", content_hash="h")[1::2] == first[:2]
+    assert list(methods.iter_rotate_array_images(image_array, 30, 3, pool="serial", content_hash="h")) == first
+    assert calls == [30, 60, 90, 15, 45]
+
+    # без хэша оригинала кэш не используется
+    methods.rotate_array_images(image_array, 30, 1, pool="serial")
+    assert calls[-1] == 30
+
+    colors = methods.color_correction_array_images(image_array, ["grayscale", "brightness"], variants=2, seed=3,
+                                                   content_hash="h")
+    gray = methods.color_correction_array_images(image_array, ["inversion", "grayscale"], content_hash="h")
+    blur = methods.distortion_array_images(image_array, "blur", content_hash="h")
+    deformed = methods.distortion_array_images(image_array, "distortion", seed=5, content_hash="h")
+    methods.distortion_array_images(image_array, "distortion", content_hash="h")
+
+    # повторные запросы не преобразуют и не кодируют изображения
+    def fail(*args, **kwargs):
+        raise AssertionError("результат должен браться из кэша")
+    monkeypatch.setattr(methods, "encode_arrays", lambda arrays, encoding=None: fail() if arrays else [])
+    for name in ("grayscale_array", "flip_array", "gaussian_blur_array", "elastic_array"):
+        monkeypatch.setattr(methods, name, fail)
+    monkeypatch.setattr(methods.ColorCorrectionEngine, "grayscale", fail)
+    monkeypatch.setattr(methods.ColorCorrectionEngine, "inversion", fail)
+    assert methods.color_correction_array_images(image_array, ["grayscale", "brightness"], variants=2, seed=3,
+                                                 content_hash="h") == colors
+    assert methods.color_correction_array_images(image_array, ["inversion", "grayscale"], content_hash="h") == gray
+    assert methods.distortion_array_images(image_array, "blur", seed=9, content_hash="h") == blur
+    assert methods.distortion_array_images(image_array, "distortion", seed=5, content_hash="h") == deformed
+    # другое кодирование - другой ключ
+    with pytest.raises(AssertionError):
+        methods.distortion_array_images(image_array, "blur", encoding=ImageEncoding("png"), content_hash="h")
+
+    # дисковый уровень переживает перезапуск и читается другим процессом
+    restarted = ResultCache(10 * 2 ** 20, 10 * 2 ** 20, str(tmp_path))
+    assert restarted.get(ResultCache.key("h", "rotate", 30.0, index=0)) == first[0]
+
+    # вытеснение давно не используемых результатов в памяти и на диске
+    small = ResultCache(8, 8, str(tmp_path / "small"))
+    for key in ("a", "b", "c"):
+        small.put(key, b"1234")
+    assert small.memory_bytes == 8 and small.disk_bytes == 8
+    assert list(small._memory) == ["b", "c"]
+    assert not os.path.exists(tmp_path / "small" / "a" / "a") and os.path.exists(tmp_path / "small" / "c" / "c")
+    small.clear()
+    assert small.get("b") is None
+
+    # качество по умолчанию из настроек входит в ключ, как и явно заданное
+    import image_processing.image_codecs as image_codecs
+    default_key = ResultCache.key("h", "rotate", 30.0)
+    assert default_key == ResultCache.key("h", "rotate", 30.0, ImageEncoding("jpeg", quality=image_codecs.JPEG_QUALITY))
+    monkeypatch.setattr(image_codecs, "JPEG_QUALITY", image_codecs.JPEG_QUALITY - 10)
+    assert ResultCache.key("h", "rotate", 30.0) != default_key
+
+
+# === Тест повторной загрузки того же изображения ===
+def test_upload_duplicate(monkeypatch):
+    import image_processing.image_singleton as image_singleton
+    from database.blob_store import get_blob_store
+
+    def upload(user, path):
+        with open(os.path.join(BASE_DIR, path), "rb") as image:
+            return user.post("/", files={"file": (os.path.basename(path), image, "image/jpeg")})
+
+    user = TestClient(app)
+    upload(user, "test/bus.jpg")
+    user.post("/do_rotate", data={"angle": 45, "count": 2})
+    original = re.search(r'src="(/images/original/[^"]+)"', user.get("/").text).group(1)
+    rotated = re.findall(r'href="(/images/rotate/[^"]+)"', user.get("/rotate").text)
+    assert len(rotated) == 2
+
+    # тот же файл: оригинал и результаты остаются, байты не декодируются и не записываются
+    def fail(*args, **kwargs):
+        raise AssertionError("повторная загрузка не должна декодировать и записывать изображение")
+    monkeypatch.setattr(image_singleton, "decode_bytes_to_cv", fail)
+    monkeypatch.setattr(get_blob_store(), "put", fail)
+    response = upload(user, "test/bus.jpg")
+    assert "уже загружено" in response.text
+    assert original in response.text
+    assert re.findall(r'href="(/images/rotate/[^"]+)"', user.get("/rotate").text) == rotated
+
+    # то же содержимое в другой сессии: своя строка, но массив и блоб переиспользуются
+    other = TestClient(app)
+    response = upload(other, "test/bus.jpg")
+    assert "уже загружено" not in response.text
+    assert re.search(r'src="(/images/original/[^"]+)"', response.text).group(1) != original
+    monkeypatch.undo()
+
+    # другое изображение заменяет оригинал и очищает результаты
+    response = upload(user, "test/images_for_manual_testing/kitty.jpg")
+    assert "уже загружено" not in response.text
+    assert original not in response.text
+    assert 'href="/images/rotate/' not in user.get("/rotate").text